@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""JSON解码吞吐基准：对比旧的 json.loads(line.strip()) 与各解码后端"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+import unicodedata
+
+import restore_chat
+from restore_chat import ChatRestorer, decode_record, set_json_backend
+
+
+def build_session(source, lines):
+    """循环复制 source 的记录，生成约 lines 行的大会话文件，返回临时文件路径"""
+    with open(source, 'rb') as f:
+        records = [line if line.endswith(b'\n') else line + b'\n' for line in f if line.strip()]
+    fd, path = tempfile.mkstemp(suffix='.jsonl', prefix='bench_')
+    with os.fdopen(fd, 'wb') as out:
+        out.writelines(itertools.islice(itertools.cycle(records), lines))
+    return path
+
+
+def decode_legacy(path):
+    """旧实现：文本模式读取，每行 strip 后用标准库 json 解码"""
+    count = 0
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                json.loads(line.strip())
+            except ValueError:
+                pass
+            count += 1
+    return count
+
+
+def decode_bytes(path):
+    """新实现：二进制读取，直接交给当前解码后端"""
+    count = 0
+    with open(path, 'rb') as f:
+        for line_num, line in enumerate(f, 1):
+            decode_record(line, line_num)
+            count += 1
+    return count
+
+
+def load_session(path):
+    """完整的 ChatRestorer.load_data"""
+    restorer = ChatRestorer(path)
+    restorer.load_data()
+    return len(restorer.messages)
+
+
+def pad(text, width):
+    """按终端显示宽度（中文占两格）左对齐"""
+    display = sum(2 if unicodedata.east_asian_width(c) in 'WF' else 1 for c in text)
+    return text + ' ' * max(width - display, 0)
+
+
+def best_of(func, path, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(path)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='JSON解码吞吐基准（行/秒）')
+    parser.add_argument('jsonl_file', nargs='?', default='97f80fb9-e757-45e8-854b-1a6985a5a4bc.jsonl',
+                        help='用于生成大会话的样本文件（默认: 97f80fb9-...jsonl）')
+    parser.add_argument('-n', '--lines', type=int, default=100000, help='生成的会话行数（默认: 100000）')
+    parser.add_argument('--repeat', type=int, default=3, help='每项重复次数，取最快一次（默认: 3）')
+    parser.add_argument('--as-is', action='store_true', help='直接使用输入文件，不复制扩充')
+    args = parser.parse_args()
+
+    path = args.jsonl_file if args.as_is else build_session(args.jsonl_file, args.lines)
+    try:
+        with open(path, 'rb') as f:
+            lines = sum(1 for _ in f)
+        size_mb = os.path.getsize(path) / 1024 / 1024
+        print(f"📄 会话: {path}（{lines} 行，{size_mb:.1f} MB）")
+        print(f"🔌 可用后端: {', '.join(restore_chat.JSON_BACKENDS)}")
+        print()
+
+        rows = [('json + strip（旧实现）', '解码', best_of(decode_legacy, path, args.repeat))]
+        for name in restore_chat.JSON_BACKENDS:
+            set_json_backend(name)
+            rows.append((f'{name}（bytes）', '解码', best_of(decode_bytes, path, args.repeat)))
+            rows.append((f'{name}（bytes）', 'load_data', best_of(load_session, path, args.repeat)))
+        set_json_backend()
+
+        baseline = rows[0][2]
+        print(f"{pad('方式', 26)}{pad('阶段', 12)}{'行/秒':>12}{'MB/s':>10}{'加速比':>7}")
+        print('-' * 70)
+        for name, stage, seconds in rows:
+            print(f"{pad(name, 26)}{pad(stage, 12)}{lines / seconds:>14,.0f}{size_mb / seconds:>10.1f}{baseline / seconds:>7.2f}x")
+    finally:
+        if not args.as_is:
+            os.unlink(path)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""还原流程基准：生成逼真的合成会话，测量各阶段与批处理的吞吐（MB/s）和峰值内存（RSS）"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from bench_decode import pad
+
+WORDS = ('数据 处理 函数 文件 会话 模型 参数 结果 输出 缓存 the of and to in is that for with '
+         'padding attention token request response parser index buffer stream render').split()
+TOOLS = ('Read', 'Bash', 'Edit', 'Grep', 'Glob', 'Write')
+
+# 各阶段在独立的子进程中运行，前置步骤不计时；峰值RSS是子进程整个生命周期的最大值
+STAGES = ('load_data', 'group_messages', 'render_txt', 'render_markdown', 'render_html', 'stream_html')
+# 只读取主会话文件的阶段（子代理文件在渲染时才读取）
+MAIN_FILE_STAGES = ('load_data', 'group_messages')
+
+
+class SessionGenerator:
+    """
+    合成会话生成器
+    结构与 Claude Code 写出的记录一致：助手消息按内容块拆成多行（共享 message.id 并重复携带 usage），
+    thinking 带签名，tool_result 的 content 为字符串或文本块列表，toolUseResult 重复保存原始结果，
+    每隔若干轮调用一次 Task 工具，子代理会话写入同目录的 agent-<agentId>.jsonl（isSidechain 记录）
+    """
+
+    def __init__(self, turns=2000, thinking_chars=2000, tool_result_chars=4000, string_content=0.5,
+                 sidechain_every=50, sidechain_turns=10, seed=1):
+        self.turns = turns
+        self.thinking_chars = thinking_chars
+        self.tool_result_chars = tool_result_chars
+        self.string_content = string_content  # 用户输入和工具结果使用字符串形式content的比例
+        self.sidechain_every = sidechain_every  # 每隔多少轮调用一次子代理，0 表示不生成子代理
+        self.sidechain_turns = sidechain_turns
+        self.random = random.Random(seed)
+        self.clock = datetime(2025, 11, 13, 16, 0, tzinfo=timezone.utc)
+
+    def text(self, chars):
+        """约 chars 个字符的中英混合文本，偶尔带Markdown列表和代码块"""
+        parts = []
+        size = 0
+        while size < chars:
+            roll = self.random.random()
+            if roll < 0.05:
+                part = '\n```python\ndef f(x):\n    return x * 2\n```\n'
+            elif roll < 0.1:
+                part = '\n- ' + ' '.join(self.random.choices(WORDS, k=6)) + '\n'
+            else:
+                part = ' '.join(self.random.choices(WORDS, k=8)) + '。'
+            parts.append(part)
+            size += len(part)
+        return ''.join(parts)[:max(chars, 1)]
+
+    def content(self, text):
+        """字符串形式或文本块列表形式的content"""
+        if self.random.random() < self.string_content:
+            return text
+        return [{'type': 'text', 'text': text}]
+
+    def write(self, path):
+        """生成会话文件（以及子代理文件），返回写出的文件列表"""
+        session_id = str(uuid.UUID(int=self.random.getrandbits(128)))
+        files = [path]
+        with open(path, 'w', encoding='utf-8') as f:
+            writer = _RecordWriter(f, self, session_id, sidechain=False)
+            for turn in range(self.turns):
+                if turn % 100 == 0:
+                    writer.raw({'type': 'queue-operation', 'operation': 'enqueue', 'sessionId': session_id,
+                                'timestamp': self.tick()})
+                writer.user(self.content(self.text(120)))
+                agent_id = None
+                if self.sidechain_every and turn % self.sidechain_every == self.sidechain_every - 1:
+                    agent_id = f'{self.random.getrandbits(32):08x}'
+                    prompt = self.text(200)
+                    files.append(self.write_sidechain(os.path.dirname(path) or '.', session_id, agent_id, prompt))
+                    writer.assistant(turn, 'Task', {'description': '子任务', 'prompt': prompt,
+                                                    'subagent_type': 'general-purpose'}, agent_id)
+                else:
+                    writer.assistant(turn, self.random.choice(TOOLS), None, None)
+        return files
+
+    def write_sidechain(self, directory, session_id, agent_id, prompt):
+        path = os.path.join(directory, f'agent-{agent_id}.jsonl')
+        with open(path, 'w', encoding='utf-8') as f:
+            writer = _RecordWriter(f, self, session_id, sidechain=True, agent_id=agent_id)
+            writer.user(prompt)
+            for turn in range(self.sidechain_turns):
+                writer.assistant(turn, self.random.choice(TOOLS), None, None)
+        return path
+
+    def tick(self):
+        self.clock += timedelta(seconds=self.random.randint(1, 30))
+        return self.clock.isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
+class _RecordWriter:
+    """按回复链（parentUuid）写出一个会话或子代理文件的记录"""
+
+    def __init__(self, f, gen, session_id, sidechain, agent_id=None):
+        self.f = f
+        self.gen = gen
+        self.parent = None
+        self.base = {'isSidechain': sidechain, 'userType': 'external', 'cwd': '/home/user/project',
+                     'sessionId': session_id, 'version': '2.0.37', 'gitBranch': 'main'}
+        if agent_id:
+            self.base['agentId'] = agent_id
+
+    def raw(self, record):
+        self.f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+    def record(self, **fields):
+        record_uuid = str(uuid.UUID(int=self.gen.random.getrandbits(128)))
+        record = {'parentUuid': self.parent, **self.base, **fields, 'uuid': record_uuid, 'timestamp': self.gen.tick()}
+        self.parent = record_uuid
+        self.raw(record)
+
+    def user(self, content):
+        self.record(type='user', message={'role': 'user', 'content': content})
+
+    def assistant(self, turn, tool_name, tool_input, agent_id):
+        gen = self.gen
+        message_id = f'msg_{gen.random.getrandbits(64):016x}'
+        usage = {'input_tokens': gen.random.randint(1, 50), 'output_tokens': gen.random.randint(50, 2000),
+                 'cache_read_input_tokens': gen.random.randint(1000, 100000),
+                 'cache_creation_input_tokens': gen.random.randint(0, 5000), 'service_tier': 'standard'}
+        base = {'model': 'claude-sonnet-4-5-20250929', 'id': message_id, 'type': 'message', 'role': 'assistant',
+                'stop_reason': None, 'stop_sequence': None, 'usage': usage}
+        request_id = f'req_{gen.random.getrandbits(64):016x}'
+        tool_id = f'toolu_{gen.random.getrandbits(64):016x}'
+        if tool_input is None:
+            tool_input = {'file_path': f'/home/user/project/src/module_{turn}.py'} if tool_name != 'Bash' \
+                else {'command': f'pytest -q tests/test_{turn}.py', 'description': '运行测试'}
+
+        blocks = []
+        if gen.thinking_chars:
+            blocks.append({'type': 'thinking', 'thinking': gen.text(gen.thinking_chars), 'signature': 'E' * 400})
+        blocks.append({'type': 'text', 'text': gen.text(300)})
+        blocks.append({'type': 'tool_use', 'id': tool_id, 'name': tool_name, 'input': tool_input})
+        for block in blocks:
+            self.record(type='assistant', requestId=request_id, message={**base, 'content': [block]})
+
+        result = gen.text(gen.tool_result_chars)
+        tool_use_result = {'agentId': agent_id, 'status': 'completed'} if agent_id else \
+            {'type': 'text', 'file': {'filePath': tool_input.get('file_path', ''), 'content': result}}
+        self.record(type='user', toolUseResult=tool_use_result, message={'role': 'user', 'content': [
+            {'tool_use_id': tool_id, 'type': 'tool_result', 'content': gen.content(result)}]})
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """峰值RSS（MB），Linux 上 ru_maxrss 以KB计，macOS 上以字节计"""
+    maxrss = resource.getrusage(who).ru_maxrss
+    return maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def run_stage(stage, path):
+    """在当前进程中执行一个阶段（前置步骤不计时），返回耗时（秒）"""
+    from restore_chat import ChatRestorer, write_parts
+
+    fmt = stage.rsplit('_', 1)[1] if stage.startswith(('render_', 'stream_')) else 'txt'
+    restorer = ChatRestorer(path, fmt)
+    devnull = os.devnull
+    if stage == 'stream_html':
+        start = time.perf_counter()
+        restorer.restore_to_file(devnull)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    restorer.load_data()
+    if stage == 'load_data':
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    grouped = restorer.group_messages()
+    if stage == 'group_messages':
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with open(devnull, 'w', encoding='utf-8') as f:
+        write_parts(f, restorer.iter_document_parts(grouped))
+    return time.perf_counter() - start
+
+
+def run_batch(directory, fmt, jobs):
+    """批处理整个目录（忽略清单），返回耗时（秒）"""
+    from restore_chat import batch_process_directory
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        batch_process_directory(directory, fmt, jobs=jobs, force=True)
+    return time.perf_counter() - start
+
+
+def measure(args, repeat):
+    """在独立的子进程中运行，取最快一次的耗时和各次的最大峰值RSS"""
+    best, rss = float('inf'), 0.0
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', *args],
+                                check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        best = min(best, result['seconds'])
+        rss = max(rss, result['rss_mb'])
+    return best, rss
+
+
+def worker(argv):
+    """子进程入口: --worker stage PATH 或 --worker batch DIR FORMAT JOBS"""
+    if argv[0] == 'batch':
+        seconds = run_batch(argv[1], argv[2], int(argv[3]))
+        rss = max(peak_rss_mb(), peak_rss_mb(resource.RUSAGE_CHILDREN))
+    else:
+        seconds = run_stage(argv[0], argv[1])
+        rss = peak_rss_mb()
+    print(json.dumps({'seconds': seconds, 'rss_mb': rss}))
+
+
+def tree_size(paths):
+    return sum(os.path.getsize(p) for p in paths)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--worker':
+        return worker(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(description='还原流程基准：合成会话上的各阶段吞吐（MB/s）和峰值RSS')
+    parser.add_argument('--turns', type=int, default=2000, help='单个会话的轮数（默认: 2000）')
+    parser.add_argument('--thinking-chars', type=int, default=2000, help='每条thinking的字符数（默认: 2000，0 表示无thinking）')
+    parser.add_argument('--tool-result-chars', type=int, default=4000, help='每个工具结果的字符数（默认: 4000）')
+    parser.add_argument('--string-content', type=float, default=0.5,
+                        help='用户输入和工具结果使用字符串形式content的比例，其余为文本块列表（默认: 0.5）')
+    parser.add_argument('--sidechain-every', type=int, default=50, help='每隔多少轮调用一次子代理，0 表示不生成（默认: 50）')
+    parser.add_argument('--sidechain-turns', type=int, default=10, help='每个子代理会话的轮数（默认: 10）')
+    parser.add_argument('--sessions', type=int, default=20, help='批处理基准的会话数，0 表示跳过（默认: 20）')
+    parser.add_argument('--batch-turns', type=int, default=200, help='批处理基准中每个会话的轮数（默认: 200）')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='批处理基准的并行进程数（默认: 1）')
+    parser.add_argument('--stages', default=','.join(STAGES), help=f'要测量的阶段，逗号分隔（默认: 全部，{",".join(STAGES)}）')
+    parser.add_argument('--repeat', type=int, default=3, help='每项重复次数，取最快一次（默认: 3）')
+    parser.add_argument('--seed', type=int, default=1, help='随机种子（默认: 1）')
+    parser.add_argument('--save', metavar='FILE', help='把结果保存为JSON，作为之后比较的基线')
+    parser.add_argument('--compare', metavar='FILE', help='与基线JSON比较，任一项吞吐下降超过 --threshold 时返回非零')
+    parser.add_argument('--threshold', type=float, default=10.0, help='判定性能回退的吞吐下降百分比（默认: 10）')
+    parser.add_argument('--keep', metavar='DIR', help='把合成会话写入 DIR 并保留（默认写入临时目录，结束后删除）')
+    args = parser.parse_args()
+
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        parser.error(f"未知的阶段: {', '.join(unknown)}（可选: {', '.join(STAGES)}）")
+
+    workdir = args.keep or tempfile.mkdtemp(prefix='bench_restore_')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        options = dict(thinking_chars=args.thinking_chars, tool_result_chars=args.tool_result_chars,
+                       string_content=args.string_content, sidechain_every=args.sidechain_every,
+                       sidechain_turns=args.sidechain_turns)
+        session_dir = os.path.join(workdir, 'single')
+        os.makedirs(session_dir, exist_ok=True)
+        start = time.perf_counter()
+        session_files = SessionGenerator(args.turns, seed=args.seed, **options).write(
+            os.path.join(session_dir, 'session.jsonl'))
+        # load_data / group_messages 只读取主会话文件；渲染时才读取子代理文件，吞吐按实际读取的字节计算
+        main_size = os.path.getsize(session_files[0])
+        subagent_size = tree_size(session_files[1:])
+        print(f"📄 合成会话: {session_files[0]}（{args.turns} 轮，{main_size / 1024 / 1024:.1f} MB；"
+              f"{len(session_files) - 1} 个子代理文件，{subagent_size / 1024 / 1024:.1f} MB；"
+              f"生成耗时 {time.perf_counter() - start:.1f}s）")
+
+        rows = []
+        for stage in stages:
+            seconds, rss = measure([stage, session_files[0]], args.repeat)
+            sub_bytes = 0 if stage in MAIN_FILE_STAGES else subagent_size
+            rows.append((stage, main_size + sub_bytes, sub_bytes, seconds, rss))
+
+        if args.sessions:
+            batch_dir = os.path.join(workdir, 'batch')
+            os.makedirs(batch_dir, exist_ok=True)
+            batch_files = []
+            for i in range(args.sessions):
+                gen = SessionGenerator(args.batch_turns, seed=args.seed + i + 1, **options)
+                batch_files += gen.write(os.path.join(batch_dir, f'session-{i:04d}.jsonl'))
+            batch_size = tree_size(batch_files)
+            batch_subagent_size = tree_size(p for p in batch_files if os.path.basename(p).startswith('agent-'))
+            print(f"📁 批处理目录: {batch_dir}（{args.sessions} 个会话，{batch_size / 1024 / 1024:.1f} MB）")
+            for fmt in ('txt', 'html'):
+                seconds, rss = measure(['batch', batch_dir, fmt, str(args.jobs)], args.repeat)
+                rows.append((f'batch_{fmt} (-j {args.jobs})', batch_size, batch_subagent_size, seconds, rss))
+        print()
+
+        baseline = {}
+        if args.compare:
+            with open(args.compare, 'r', encoding='utf-8') as f:
+                baseline = {row['name']: row for row in json.load(f)['results']}
+
+        print(f"{pad('阶段', 24)}{'耗时(s)':>10}{'MB':>8}{'子代理MB':>8}{'MB/s':>10}{'峰值RSS(MB)':>14}"
+              + (f"{'对比基线':>12}" if baseline else ''))
+        print('-' * (74 + (12 if baseline else 0)))
+        results = []
+        regressions = []
+        mismatched = []
+        for name, size, sub_bytes, seconds, rss in rows:
+            throughput = size / 1024 / 1024 / seconds
+            line = (f"{pad(name, 24)}{seconds:>10.3f}{size / 1024 / 1024:>8.1f}{sub_bytes / 1024 / 1024:>10.1f}"
+                    f"{throughput:>10.1f}{rss:>14.1f}")
+            if name in baseline and baseline[name].get('bytes') != size:
+                # 输入不同（合成参数不同，或基线来自旧的字节计算方式）的结果不可比
+                mismatched.append(name)
+                line += f"{'-':>12}"
+            elif name in baseline:
+                change = (throughput / baseline[name]['mb_per_s'] - 1) * 100
+                line += f"{change:>+11.1f}%"
+                if change < -args.threshold:
+                    regressions.append(name)
+                    line += ' ⚠️'
+            print(line)
+            results.append({'name': name, 'bytes': size, 'subagent_bytes': sub_bytes, 'seconds': round(seconds, 6),
+                            'mb_per_s': round(throughput, 3), 'peak_rss_mb': round(rss, 1)})
+
+        if args.save:
+            with open(args.save, 'w', encoding='utf-8') as f:
+                json.dump({'python': sys.version.split()[0], 'options': vars(args), 'results': results},
+                          f, ensure_ascii=False, indent=1)
+            print(f"\n💾 结果已保存: {args.save}")
+        if mismatched:
+            print(f"\n⚠️  输入字节数与基线不同，未比较: {', '.join(mismatched)}（请用相同参数重新 --save 基线）")
+        if regressions:
+            print(f"\n❌ 吞吐下降超过 {args.threshold:g}%: {', '.join(regressions)}")
+            return 1
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
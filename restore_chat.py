@@ -5,114 +5,2163 @@ Claude Code 会话还原程序
 支持文本和Markdown格式输出
 """
 
+import base64
+import csv
+import gzip
 import json
+import re
 import sys
 import argparse
 import os
+import posixpath
+import fnmatch
+import functools
+import hashlib
+import io
+import itertools
+import mmap
+import sqlite3
+import tarfile
+import time
 import html as html_module
+from array import array
 from pathlib import Path
-from typing import Dict, List, Any
+from urllib.parse import quote
+from typing import BinaryIO, Dict, List, Any, Callable, Iterable, Iterator, Optional, Set, Tuple, TextIO
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 
+__version__ = '1.1.0'
+
+# 可选的快速JSON解码后端，未安装时使用标准库json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# 可选的zstd解压（读取 .zst 压缩的会话和归档），未安装时只支持gzip
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 可选的列式导出（--format parquet / arrow），未安装时只能输出文本格式
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# 可选的代码高亮（HTML导出的 --prerender），未安装时代码块不着色
+try:
+    import pygments
+    from pygments.formatters import HtmlFormatter
+    from pygments.lexers import get_lexer_by_name
+    from pygments.util import ClassNotFound
+except ImportError:
+    pygments = None
+
+
+_stdlib_decoder = json.JSONDecoder()
+
+
+def _stdlib_json_decode(line):
+    """标准库后端：bytes 直接按UTF-8解码，比 json.loads(bytes) 的编码探测更快"""
+    if isinstance(line, bytes):
+        line = line.decode('utf-8')
+    return _stdlib_decoder.decode(line)
+
+
+def _json_backends() -> Dict[str, Tuple[Callable[[Any], Any], Tuple[type, ...]]]:
+    """可用的解码后端: 名称 -> (解码函数, 解析失败时抛出的异常类型)，按优先顺序排列"""
+    backends = {}
+    if orjson is not None:
+        backends['orjson'] = (orjson.loads, (ValueError,))
+    if msgspec is not None:
+        backends['msgspec'] = (msgspec.json.decode, (ValueError, msgspec.DecodeError))
+    backends['json'] = (_stdlib_json_decode, (ValueError,))
+    return backends
+
+
+JSON_BACKENDS = _json_backends()
+JSON_BACKEND = ''
+json_decode = _stdlib_json_decode
+JSON_DECODE_ERRORS = (ValueError,)
+
+
+def set_json_backend(name: Optional[str] = None) -> str:
+    """
+    选择JSON解码后端（orjson / msgspec / json），默认使用可用的最快后端
+    也可通过环境变量 CLAUDE_PARSE_JSON 指定；返回实际使用的后端名
+    """
+    global JSON_BACKEND, json_decode, JSON_DECODE_ERRORS
+    name = name or os.environ.get('CLAUDE_PARSE_JSON') or next(iter(JSON_BACKENDS))
+    if name not in JSON_BACKENDS:
+        raise ValueError(f"不可用的JSON后端: {name}（可用: {', '.join(JSON_BACKENDS)}）")
+    JSON_BACKEND = name
+    json_decode, JSON_DECODE_ERRORS = JSON_BACKENDS[name]
+    return name
+
+
+try:
+    set_json_backend()
+except ValueError as e:
+    print(f"警告: {e}，改用默认后端", file=sys.stderr)
+    set_json_backend(next(iter(JSON_BACKENDS)))
+
+
+def decode_record(line, line_num: int,
+                  observe: Optional[Callable[[Dict[str, Any]], None]] = None) -> Optional[Dict[str, Any]]:
+    """
+    解码一行JSONL（str或bytes），无法解析的行和queue-operation返回None
+    热路径直接解码以二进制读取的行，首尾空白由解码器忽略，不再复制整行
+    observe 在过滤之前接收每条解码成功的记录（包括queue-operation），用于统计等观察者
+    """
+    try:
+        obj = json_decode(line)
+    except JSON_DECODE_ERRORS as e:
+        print(f"警告: 第 {line_num} 行JSON解析失败: {e}", file=sys.stderr)
+        return None
+
+    # 子代理的首条prompt等记录的content是纯字符串，统一为文本块列表
+    message = obj.get('message')
+    if isinstance(message, dict) and isinstance(message.get('content'), str):
+        message['content'] = [{'type': 'text', 'text': message['content']}]
+
+    if observe is not None:
+        observe(obj)
+
+    # 跳过queue-operation
+    if obj.get('type') in ['queue-operation']:
+        return None
+
+    return obj
+
+
+def write_parts(f: TextIO, parts: Iterable[str]) -> None:
+    """将文档片段以换行连接写入文件，结果与 '\n'.join(parts) 完全一致"""
+    first = True
+    for part in parts:
+        if not first:
+            f.write('\n')
+        f.write(part)
+        first = False
+
+
+# 输出压缩（--compress）: 方式 -> (文件后缀, 压缩级别)
+OUTPUT_COMPRESSION = {'gzip': ('.gz', 6), 'zstd': ('.zst', 10)}
+WRITE_BUFFER_SIZE = 1 << 20  # 渲染片段先写入缓冲，攒够后再压缩、写盘
+
+
+def compressed_path(path: Any, compress: Optional[str] = None) -> Path:
+    """输出文件实际写入的路径：compress 时追加 .gz / .zst（页面之间的链接仍使用未压缩的文件名）"""
+    return Path(f"{path}{OUTPUT_COMPRESSION[compress][0]}") if compress else Path(path)
+
+
+def open_output(path: Any, compress: Optional[str] = None) -> TextIO:
+    """
+    以文本方式打开输出文件，带 WRITE_BUFFER_SIZE 的写缓冲
+    compress 为 gzip / zstd 时边写边压缩到 <path>.gz / <path>.zst；gzip 头中的时间固定为0，相同内容的压缩结果相同
+    """
+    target = compressed_path(path, compress)
+    if compress is None:
+        return open(target, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE)
+    level = OUTPUT_COMPRESSION[compress][1]
+    if compress == 'gzip':
+        stream = gzip.GzipFile(target, 'wb', compresslevel=level, mtime=0)
+    else:
+        if zstandard is None:
+            raise RuntimeError('写出 .zst 文件需要安装 zstandard（pip install zstandard）')
+        stream = zstandard.ZstdCompressor(level=level).stream_writer(open(target, 'wb'), closefd=True)
+    return io.TextIOWrapper(io.BufferedWriter(stream, WRITE_BUFFER_SIZE), encoding='utf-8')
+
+
+# 列式导出（--format parquet / arrow）：每个内容块一行，供 DuckDB / pandas 等直接查询
+TABLE_FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+TABLE_BATCH_ROWS = 10000  # 每攒够这么多行写出一个批次（parquet 的一个 row group）
+HIVE_NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'  # Hive风格分区中表示空值的目录名
+
+
+def table_schema() -> Any:
+    """表格导出的列；正文、工具参数和工具结果可能很大，使用 large_string"""
+    text = pyarrow.large_string()
+    return pyarrow.schema([
+        ('session_id', pyarrow.string()),
+        ('agent_id', pyarrow.string()),  # 子代理的agentId，主会话为空
+        ('parent_tool_use_id', pyarrow.string()),  # 子代理消息所属的Task工具调用
+        ('uuid', pyarrow.string()),  # 消息第一条记录的uuid / parentUuid
+        ('parent_uuid', pyarrow.string()),
+        ('message_id', pyarrow.string()),
+        ('message_index', pyarrow.int32()),
+        ('block_index', pyarrow.int32()),
+        ('role', pyarrow.string()),
+        ('timestamp', pyarrow.timestamp('us', tz='UTC')),
+        ('model', pyarrow.string()),
+        ('cwd', pyarrow.string()),
+        ('type', pyarrow.string()),  # text / thinking / tool_use / image 等
+        ('text', text),
+        ('tool_use_id', pyarrow.string()),
+        ('tool_name', pyarrow.string()),
+        ('tool_input', text),  # JSON
+        ('tool_result', text),
+    ] + [(field, pyarrow.int64()) for field in USAGE_FIELDS])
+
+
+def open_table_writer(path: Any, table_format: str, schema: Any) -> Any:
+    """打开列式文件的写入器（parquet / arrow IPC），两者都用zstd压缩"""
+    if pyarrow is None:
+        raise RuntimeError('parquet / arrow 导出需要安装 pyarrow（pip install pyarrow）')
+    if table_format == 'parquet':
+        return pyarrow.parquet.ParquetWriter(str(path), schema, compression='zstd')
+    return pyarrow.ipc.new_file(str(path), schema, options=pyarrow.ipc.IpcWriteOptions(compression='zstd'))
+
+
+def parse_timestamp(timestamp: Optional[str]) -> Optional[datetime]:
+    """解析ISO时间戳，无法解析时返回None"""
+    if not timestamp:
+        return None
+    try:
+        return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+
+
+def _string_end(buf: bytes, pos: int = 0) -> int:
+    """JSON字符串字面量中第一个未转义引号的位置（前面的反斜杠为偶数个），没有时返回-1"""
+    while True:
+        pos = buf.find(b'"', pos)
+        if pos < 0:
+            return -1
+        k = pos
+        while k > 0 and buf[k - 1] == 0x5c:
+            k -= 1
+        if (pos - k) % 2 == 0:
+            return pos
+        pos += 1
+
+
+# 压缩的会话文件（流式解压）和tar归档（逐个成员读取，不解压到磁盘）
+COMPRESSED_SUFFIXES = ('.gz', '.zst')
+ARCHIVE_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.zst')
+SESSION_SUFFIXES = ('.jsonl', '.json')
+ARCHIVE_MEMBER_SUFFIXES = tuple(s + c for s in SESSION_SUFFIXES for c in ('',) + COMPRESSED_SUFFIXES)
+
+# 正在处理的归档成员: 虚拟路径 <归档文件>/<成员路径> -> 解压后的内容（同 zipimport 的路径写法）
+# 只保留当前项目目录的成员，处理完即释放
+_ARCHIVE_MEMBERS: Dict[str, bytes] = {}
+
+
+def is_archive(path: Any) -> bool:
+    return str(path).lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def is_plain_file(path: Any) -> bool:
+    """普通（未压缩、不在归档中）的会话文件，可以按字节偏移随机读取"""
+    name = str(path)
+    return name not in _ARCHIVE_MEMBERS and not name.lower().endswith(COMPRESSED_SUFFIXES + ARCHIVE_SUFFIXES)
+
+
+def session_stem(path: Any) -> str:
+    """去掉压缩或归档后缀后的文件名主干: a.jsonl.gz -> a，month.tar.zst -> month"""
+    name = Path(path).name
+    lower = name.lower()
+    for suffix in ARCHIVE_SUFFIXES:
+        if lower.endswith(suffix):
+            return name[:-len(suffix)]
+    for suffix in COMPRESSED_SUFFIXES:
+        if lower.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    return Path(name).stem
+
+
+def stem_collisions(paths: Iterable[str]) -> Set[str]:
+    """
+    同一目录中文件名主干相同的会话文件（如 a.jsonl 与 a.jsonl.gz）会还原到同一个输出文件，
+    只保留未压缩的那个（都压缩时保留先出现的），返回其余应跳过的路径并给出警告
+    """
+    kept: Dict[Tuple[str, str, bool], str] = {}
+    skipped = set()
+    for path in paths:
+        lower = path.lower()
+        key = (os.path.dirname(path), session_stem(path), lower.endswith(ARCHIVE_SUFFIXES))
+        other = kept.setdefault(key, path)
+        if other == path:
+            continue
+        if other.lower().endswith(COMPRESSED_SUFFIXES) and not lower.endswith(COMPRESSED_SUFFIXES):
+            kept[key], path, other = path, other, path
+        skipped.add(path)
+        print(f"⚠️  跳过 {path}: 与 {other} 的文件名主干相同，还原结果会写入同一输出文件", file=sys.stderr)
+    return skipped
+
+
+def session_size(path: Any) -> int:
+    """会话文件的字节数（压缩文件为压缩后的大小，归档成员为解压后的大小）"""
+    data = _ARCHIVE_MEMBERS.get(str(path))
+    return len(data) if data is not None else os.path.getsize(path)
+
+
+def session_file_exists(path: Any) -> bool:
+    return str(path) in _ARCHIVE_MEMBERS or Path(path).is_file()
+
+
+def _zstd_reader(raw: BinaryIO) -> BinaryIO:
+    """zstd 流式解压（需要可选依赖 zstandard），支持多帧拼接的文件"""
+    if zstandard is None:
+        raise RuntimeError('读取 .zst 文件需要安装 zstandard（pip install zstandard）')
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True), 1 << 20)
+
+
+def open_session(path: Any) -> BinaryIO:
+    """以二进制方式打开会话文件：普通文件、.gz/.zst 压缩文件（流式解压），或正在处理的归档成员"""
+    name = str(path)
+    data = _ARCHIVE_MEMBERS.get(name)
+    if data is not None:
+        return io.BytesIO(data)
+    lower = name.lower()
+    if lower.endswith('.gz'):
+        return gzip.open(name, 'rb')
+    if lower.endswith('.zst'):
+        raw = open(name, 'rb')
+        try:
+            return _zstd_reader(raw)
+        except Exception:
+            raw.close()
+            raise
+    return open(name, 'rb')
+
+
+def decompress_member(name: str, data: bytes) -> bytes:
+    """归档中单独压缩的成员（如 a.jsonl.gz）"""
+    lower = name.lower()
+    if lower.endswith('.gz'):
+        return gzip.decompress(data)
+    if lower.endswith('.zst'):
+        with _zstd_reader(io.BytesIO(data)) as f:
+            return f.read()
+    return data
+
+
+def iter_archive_members(archive: str) -> Iterator[Tuple[str, bytes]]:
+    """
+    按顺序流式读取tar归档（.tar/.tar.gz/.tgz/.tar.zst），产出会话文件成员的 (成员路径, 解压后的内容)
+    成员路径为规范化的相对路径；绝对路径或含 .. 的成员被跳过
+    """
+    with open(archive, 'rb') as raw:
+        compressed_zstd = archive.lower().endswith('.zst')
+        fileobj = _zstd_reader(raw) if compressed_zstd else raw
+        with tarfile.open(fileobj=fileobj, mode='r|' if compressed_zstd else 'r|*') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                name = posixpath.normpath(member.name.lstrip('/'))
+                if name.startswith('..') or not name.lower().endswith(ARCHIVE_MEMBER_SUFFIXES):
+                    continue
+                f = tar.extractfile(member)
+                if f is None:
+                    continue
+                yield name, decompress_member(name, f.read())
+
+
+class LazyText:
+    """
+    延迟解码的tool_result内容
+    加载时只记录JSON字符串字面量在会话文件中的字节位置以及内容的长度和行数，不保留内容本身；
+    渲染预览时只读取并解码预览需要的前缀，完整内容（全文索引等）在需要时才解码。
+    """
+
+    __slots__ = ('path', 'start', 'end', 'length', 'line_count')
+
+    # 字面量中的换行转义 \n（前面的反斜杠为偶数个，排除 \\n 这样的转义反斜杠）
+    NEWLINE_ESCAPE = re.compile(rb'(?<!\\)(?:\\\\)*\\n')
+
+    def __init__(self, path: str, start: int, end: int, length: int, line_count: int):
+        self.path = path
+        self.start = start  # 字面量开头引号之后的文件偏移
+        self.end = end  # 所在行结束的文件偏移（字面量不会超出所在行）
+        self.length = length
+        self.line_count = line_count
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __str__(self) -> str:
+        return self.text()
+
+    def _read(self, size: int) -> bytes:
+        with open(self.path, 'rb') as f:
+            f.seek(self.start)
+            return f.read(min(size, self.end - self.start))
+
+    def _decode(self, raw: bytes) -> str:
+        """解码字面量的前缀；前缀末尾可能截断了转义序列或多字节字符，逐字节回退直到能解码"""
+        end = _string_end(raw)
+        if end >= 0:
+            raw = raw[:end]
+        for cut in range(len(raw), max(len(raw) - 12, 0) - 1, -1):
+            try:
+                return json_decode(b'"' + raw[:cut] + b'"')
+            except JSON_DECODE_ERRORS:
+                continue
+        return ''
+
+    def head(self, max_chars: int) -> str:
+        """前 max_chars 个字符：每个字符的转义形式最多12字节，只读取这么多"""
+        return self._decode(self._read(max_chars * 12 + 12))[:max_chars]
+
+    def first_lines(self, count: int) -> str:
+        """前 count 行（不含第 count 个换行），逐步扩大读取范围直到找到足够的换行"""
+        size = 65536
+        while True:
+            raw = self._read(size)
+            found = 0
+            for match in self.NEWLINE_ESCAPE.finditer(raw):
+                found += 1
+                if found == count:
+                    return self._decode(raw[:match.end() - 2])
+            if len(raw) >= self.end - self.start:
+                return self._decode(raw)
+            size *= 2
+
+    def text(self) -> str:
+        """完整内容"""
+        return self._decode(self._read(self.end - self.start))
+
+
+def preview_content(content: Any, max_chars: int, max_lines: int) -> Tuple[str, Any]:
+    """
+    tool_result内容的截断预览，返回 (预览文本, 截断信息)
+    截断信息: False 为完整内容；整数为按行截断后剩余的行数；True 为按字符截断
+    content 可以是字符串或 LazyText，不会为统计行数拆分整个内容
+    """
+    if len(content) <= max_chars:
+        return str(content), False
+
+    if isinstance(content, LazyText):
+        line_count = content.line_count
+        if line_count > max_lines:
+            return content.first_lines(max_lines), line_count - max_lines
+        return content.head(max_chars), True
+
+    line_count = content.count('\n') + 1
+    if line_count > max_lines:
+        pos = -1
+        for _ in range(max_lines):
+            pos = content.find('\n', pos + 1)
+        return content[:pos], line_count - max_lines
+    return content[:max_chars], True
+
+
+# 聚合后消息的数据模型
+# 大会话中内容块和消息的数量可达数万，使用 __slots__ 而不是字典，只保留渲染和索引需要的字段
+
+class ContentBlock:
+    """消息中的内容块：text、thinking，或渲染时不展开的其它类型（图片等）"""
+
+    __slots__ = ('type', 'text')
+
+    def __init__(self, type: str, text: str = ''):
+        self.type = type
+        self.text = text  # thinking 块为思考内容
+
+    def to_dict(self) -> Dict[str, Any]:
+        """还原为记录中的内容块格式"""
+        return {'type': self.type, ('thinking' if self.type == 'thinking' else 'text'): self.text}
+
+
+class ToolCall:
+    """助手消息中的工具调用（tool_use 内容块）"""
+
+    __slots__ = ('id', 'name', 'input')
+    type = 'tool_use'
+
+    def __init__(self, id: str = '', name: str = 'Unknown', input: Optional[Dict[str, Any]] = None):
+        self.id = id
+        self.name = name
+        self.input = input if input is not None else {}
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'type': self.type, 'id': self.id, 'name': self.name, 'input': self.input}
+
+
+def content_block(item: Dict[str, Any]) -> Any:
+    """将记录中的内容块转换为 ContentBlock / ToolCall，丢弃 signature 等渲染不需要的字段"""
+    item_type = item.get('type')
+    if item_type == 'tool_use':
+        return ToolCall(item.get('id', ''), item.get('name', 'Unknown'), item.get('input', {}))
+    if item_type == 'thinking':
+        return ContentBlock(item_type, item.get('thinking', ''))
+    return ContentBlock(item_type, item.get('text', ''))
+
+
+class ToolResult:
+    """工具调用的结果，content 为字符串或 LazyText"""
+
+    __slots__ = ('content', 'timestamp', 'agent_id')
+
+    def __init__(self, content: Any, timestamp: Optional[str] = None, agent_id: Optional[str] = None):
+        self.content = content
+        self.timestamp = timestamp
+        self.agent_id = agent_id  # Task工具结果中记录的子代理agentId
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {'content': str(self.content), 'timestamp': self.timestamp}
+        if self.agent_id:
+            data['agent_id'] = self.agent_id
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'ToolResult':
+        return cls(data['content'], data.get('timestamp'), data.get('agent_id'))
+
+
+class Message:
+    """
+    聚合后的一条消息：一次用户输入，或同一message.id的全部助手记录
+    默认不引用原始记录；raw 只在 group_messages(keep_raw=True) 时保存该消息的第一条记录
+    """
+
+    __slots__ = ('role', 'timestamp', 'content', 'id', 'usage', 'branch', 'raw')
+
+    def __init__(self, role: str, timestamp: Optional[str] = '', id: Optional[str] = None,
+                 usage: Optional[Dict[str, Any]] = None, raw: Optional[Dict[str, Any]] = None):
+        self.role = role
+        self.timestamp = timestamp
+        self.content = []  # ContentBlock / ToolCall
+        self.id = id
+        self.usage = usage
+        self.branch = None  # 分支的第一条消息: {'index', 'count', 'current'}
+        self.raw = raw
+
+    def add_content(self, items: Iterable[Dict[str, Any]]) -> None:
+        """追加记录中的内容块"""
+        self.content.extend(content_block(item) for item in items)
+
+    def tool_calls(self) -> List[ToolCall]:
+        return [item for item in self.content if item.type == 'tool_use']
+
+    def to_dict(self) -> Dict[str, Any]:
+        """可JSON序列化的形式（增量导出的续读状态）"""
+        data = {'role': self.role, 'timestamp': self.timestamp,
+                'content': [item.to_dict() for item in self.content]}
+        for key in ('id', 'usage', 'branch'):
+            if getattr(self, key) is not None:
+                data[key] = getattr(self, key)
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'Message':
+        msg = cls(data['role'], data.get('timestamp', ''), data.get('id'), data.get('usage'))
+        msg.add_content(data.get('content', []))
+        msg.branch = data.get('branch')
+        return msg
+
+
+class StreamingGrouper:
+    """
+    流式消息分组器
+    按文件顺序接收记录，将连续的同一message.id的助手记录聚合为一条消息；
+    含tool_use的消息会等到对应的tool_result到达（或出现新的用户输入/文件结束）后再产出，
+    保证渲染时能关联到工具结果。已产出消息的tool_result随即释放。
+    """
+
+    def __init__(self, tool_results: Dict[str, ToolResult]):
+        self.tool_results = tool_results  # 与ChatRestorer共享，供渲染时查找
+        self.current = None  # 正在聚合的助手消息
+        self.current_tool_ids = []
+        self.pending = []  # 已结束但可能仍在等待tool_result的消息: (msg, tool_ids)
+        self.waiting = set()  # 尚未收到结果的tool_use id
+
+    def feed(self, obj: Dict[str, Any]) -> Iterator[Message]:
+        """接收一条记录，产出所有已完整的消息"""
+        msg_type = obj.get('type')
+        timestamp = obj.get('timestamp', '')
+
+        if msg_type == 'user':
+            for tool_use_id, tool_result in ChatRestorer._extract_tool_results(obj):
+                if tool_use_id in self.waiting:
+                    self.waiting.discard(tool_use_id)
+                    self.tool_results[tool_use_id] = tool_result
+
+            content = obj.get('message', {}).get('content', [])
+            user_content = [c for c in content if c.get('type') != 'tool_result']
+            if user_content:
+                # 新的用户输入之前的消息全部输出，不再等待tool_result
+                self._close_current()
+                yield from self._release(force=True)
+                msg = Message('user', timestamp)
+                msg.add_content(user_content)
+                yield from self._emit(msg, [])
+            else:
+                yield from self._release()
+
+        elif msg_type == 'assistant':
+            message = obj.get('message', {})
+            msg_id = message.get('id')
+
+            if msg_id:
+                if self.current is None or self.current.id != msg_id:
+                    self._close_current()
+                    self.current = Message('assistant', timestamp, msg_id, message.get('usage', {}))
+                    self.current_tool_ids = []
+
+                content = message.get('content', [])
+                self.current.add_content(content)
+                for item in content:
+                    if item.get('type') == 'tool_use' and item.get('id'):
+                        self.current_tool_ids.append(item['id'])
+                        self.waiting.add(item['id'])
+
+                yield from self._release()
+
+    def flush(self) -> Iterator[Message]:
+        """文件结束，产出剩余的全部消息"""
+        self._close_current()
+        yield from self._release(force=True)
+
+    @property
+    def idle(self) -> bool:
+        """没有正在聚合或等待产出的消息"""
+        return self.current is None and not self.pending
+
+    def open_messages(self) -> List[Message]:
+        """尚未产出的消息（等待tool_result的消息和正在聚合的消息），不改变分组状态"""
+        messages = [msg for msg, _ in self.pending]
+        if self.current is not None:
+            messages.append(self.current)
+        return messages
+
+    def to_state(self) -> Dict[str, Any]:
+        """导出可JSON序列化的分组状态"""
+        return {
+            'current': self.current.to_dict() if self.current is not None else None,
+            'current_tool_ids': self.current_tool_ids,
+            'pending': [[msg.to_dict(), tool_ids] for msg, tool_ids in self.pending],
+            'waiting': sorted(self.waiting),
+            'tool_results': {tool_id: result.to_dict() for tool_id, result in self.tool_results.items()},
+        }
+
+    def load_state(self, state: Dict[str, Any]) -> None:
+        """从 to_state() 的结果恢复分组状态"""
+        self.current = Message.from_dict(state['current']) if state['current'] is not None else None
+        self.current_tool_ids = state['current_tool_ids']
+        self.pending = [(Message.from_dict(msg), tool_ids) for msg, tool_ids in state['pending']]
+        self.waiting = set(state['waiting'])
+        self.tool_results.clear()
+        self.tool_results.update((tool_id, ToolResult.from_dict(result))
+                                 for tool_id, result in state['tool_results'].items())
+
+    def _close_current(self) -> None:
+        if self.current is not None:
+            self.pending.append((self.current, self.current_tool_ids))
+            self.current = None
+            self.current_tool_ids = []
+
+    def _release(self, force: bool = False) -> Iterator[Message]:
+        while self.pending:
+            msg, tool_ids = self.pending[0]
+            if not force and any(tool_id in self.waiting for tool_id in tool_ids):
+                break
+            self.pending.pop(0)
+            self.waiting.difference_update(tool_ids)
+            yield from self._emit(msg, tool_ids)
+
+    def _emit(self, msg: Message, tool_ids: List[str]) -> Iterator[Message]:
+        yield msg
+        # 调用方已渲染完该消息，释放其工具结果
+        for tool_id in tool_ids:
+            self.tool_results.pop(tool_id, None)
+
+
+class SessionTail:
+    """
+    可续读的会话读取器
+    记住已解析的字节偏移和未完成的消息分组（按message.id聚合中的助手消息、
+    等待tool_result的tool_use），每次只解析文件新追加的完整行
+    """
+
+    ANCHOR_SIZE = 64  # 用偏移前的若干字节校验文件是否被改写
+
+    def __init__(self, jsonl_file: str):
+        self.jsonl_file = jsonl_file
+        self.offset = 0
+        self.line_num = 0
+        self.anchor = ''
+        self.identity = None
+        self.tool_results = {}
+        self.grouper = StreamingGrouper(self.tool_results)
+
+    def _read_anchor(self, f) -> str:
+        start = max(0, self.offset - self.ANCHOR_SIZE)
+        f.seek(start)
+        return f.read(self.offset - start).hex()
+
+    def is_resumable(self) -> bool:
+        """文件仍是同一个文件，且已解析的部分未被截断或改写"""
+        try:
+            st = os.stat(self.jsonl_file)
+        except OSError:
+            return False
+        if [st.st_dev, st.st_ino] != self.identity or st.st_size < self.offset:
+            return False
+        with open(self.jsonl_file, 'rb') as f:
+            return self._read_anchor(f) == self.anchor
+
+    def read_new(self) -> Iterator[Dict[str, Any]]:
+        """解码自上次偏移以来新追加的完整行；末尾写了一半的行留到下次读取"""
+        st = os.stat(self.jsonl_file)
+        self.identity = [st.st_dev, st.st_ino]
+        with open(self.jsonl_file, 'rb') as f:
+            f.seek(self.offset)
+            # 上次已按完整记录读取了没有换行符的末行时，随后补上的换行符属于同一行
+            unterminated = bool(self.anchor) and not self.anchor.endswith('0a')
+            for line in f:
+                if not line.strip():
+                    # 空行（或补上的换行符）不解码，否则会报JSON解析失败
+                    self.offset += len(line)
+                    self.line_num += not unterminated
+                    unterminated = False
+                    continue
+                unterminated = False
+                if not line.endswith(b'\n'):
+                    # 可能是写入中的行：只有能完整解析时才消费
+                    try:
+                        json_decode(line)
+                    except JSON_DECODE_ERRORS:
+                        break
+                self.offset += len(line)
+                self.line_num += 1
+                obj = decode_record(line, self.line_num)
+                if obj is not None:
+                    yield obj
+            self.anchor = self._read_anchor(f)
+
+    def iter_new_messages(self, route: Optional[Callable[[Dict[str, Any]], bool]] = None) -> Iterator[Message]:
+        """产出因新数据而完整的消息；route 返回True的记录（如内联的sidechain记录）不参与分组"""
+        for obj in self.read_new():
+            if route is not None and route(obj):
+                continue
+            yield from self.grouper.feed(obj)
+
+    def to_state(self) -> Dict[str, Any]:
+        return {
+            'offset': self.offset,
+            'line_num': self.line_num,
+            'anchor': self.anchor,
+            'identity': self.identity,
+            'grouper': self.grouper.to_state(),
+        }
+
+    def load_state(self, state: Dict[str, Any]) -> None:
+        self.offset = state['offset']
+        self.line_num = state['line_num']
+        self.anchor = state['anchor']
+        self.identity = state['identity']
+        self.grouper.load_state(state['grouper'])
+
+
+class SessionLineIndex:
+    """
+    会话文件的行偏移索引
+    用 array('Q') 记录每个完整行的起始偏移，并记录每行的记录类型和 message.id 的64位哈希，
+    不保留解码后的内容；之后通过内存映射只解码需要的行，用于分页、部分导出和快速重新渲染。
+    索引缓存在会话文件旁的 <文件>.lineidx 中，文件只是追加了内容时只扫描新增的行。
+    """
+
+    VERSION = 2
+    SUFFIX = '.lineidx'
+
+    # 行的记录类型
+    KIND_SKIP = 0  # queue-operation 或无法解析的行
+    KIND_OTHER = 1
+    KIND_USER = 2  # 含用户输入（非tool_result内容）的user记录
+    KIND_TOOL_RESULT = 3  # 只含tool_result的user记录
+    KIND_ASSISTANT = 4
+    SIDECHAIN = 8  # 与类型按位或：内联的sidechain记录（拼接子代理时不计为消息）
+
+    ANCHOR_BYTES = 64
+
+    def __init__(self, jsonl_file: str):
+        self.path = jsonl_file
+        self.starts = array('Q')  # 每行的起始偏移
+        self.kinds = array('B')
+        self.msg_hashes = array('Q')  # 助手记录 message.id 的哈希，其它为0
+        self.size = 0  # 已索引的字节数（最后一个完整行的结尾）
+        self.mtime_ns = 0
+        self.anchor = ''
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    @classmethod
+    def load(cls, jsonl_file: str, use_cache: bool = True) -> 'SessionLineIndex':
+        """加载索引：缓存有效时直接读取，文件只是追加了内容时增量扫描，否则重新扫描"""
+        index = cls(jsonl_file)
+        st = os.stat(jsonl_file)
+        if use_cache and index._read_cache():
+            if index.size == st.st_size and index.mtime_ns == st.st_mtime_ns:
+                return index
+            if not (index.size <= st.st_size and index._anchor_matches()):
+                index = cls(jsonl_file)
+
+        index._scan()
+        if use_cache:
+            try:
+                index._write_cache()
+            except OSError:
+                pass  # 会话目录不可写时不缓存
+        return index
+
+    @property
+    def cache_path(self) -> str:
+        return self.path + self.SUFFIX
+
+    @staticmethod
+    def message_hash(msg_id: str) -> int:
+        return int.from_bytes(hashlib.blake2b(msg_id.encode('utf-8'), digest_size=8).digest(), 'little')
+
+    @classmethod
+    def classify(cls, obj: Optional[Dict[str, Any]]) -> Tuple[int, int]:
+        """记录的 (类型, message.id哈希)"""
+        if obj is None:
+            return cls.KIND_SKIP, 0
+        sidechain = cls.SIDECHAIN if obj.get('isSidechain') else 0
+        msg_type = obj.get('type')
+        if msg_type == 'assistant':
+            msg_id = (obj.get('message') or {}).get('id')
+            return cls.KIND_ASSISTANT | sidechain, cls.message_hash(msg_id) if msg_id else 0
+        if msg_type == 'user':
+            content = (obj.get('message') or {}).get('content', [])
+            if any(c.get('type') != 'tool_result' for c in content):
+                return cls.KIND_USER | sidechain, 0
+            return cls.KIND_TOOL_RESULT | sidechain, 0
+        return cls.KIND_OTHER | sidechain, 0
+
+    def _open(self):
+        f = open(self.path, 'rb')
+        try:
+            return f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # 空文件无法映射
+            return f, b''
+
+    def _scan(self) -> None:
+        """从 self.size 开始扫描新增的完整行"""
+        f, mm = self._open()
+        with f:
+            size = len(mm)
+            pos = self.size
+            find = mm.find
+            while pos < size:
+                end = find(b'\n', pos)
+                if end < 0:
+                    # 末尾没有换行符的行：能完整解析时才索引（同 SessionTail.read_new），否则可能还在写入，留到下次
+                    end = size
+                    try:
+                        json_decode(mm[pos:end])
+                    except JSON_DECODE_ERRORS:
+                        break
+                line = mm[pos:end]
+                # 空行（包括之后给已索引的末行补上的换行符）不计为一行
+                if line.strip():
+                    kind, msg_hash = self.classify(decode_record(line, len(self.starts) + 1))
+                    self.starts.append(pos)
+                    self.kinds.append(kind)
+                    self.msg_hashes.append(msg_hash)
+                pos = min(end + 1, size)
+            self.size = pos
+            self.anchor = mm[max(pos - self.ANCHOR_BYTES, 0):pos].hex()
+            if isinstance(mm, mmap.mmap):
+                mm.close()
+        self.mtime_ns = os.stat(self.path).st_mtime_ns
+
+    def _anchor_matches(self) -> bool:
+        with open(self.path, 'rb') as f:
+            start = max(self.size - self.ANCHOR_BYTES, 0)
+            f.seek(start)
+            return f.read(self.size - start).hex() == self.anchor
+
+    def _read_cache(self) -> bool:
+        try:
+            with open(self.cache_path, 'rb') as f:
+                header = json.loads(f.readline())
+                if header.get('version') != self.VERSION or header.get('byteorder') != sys.byteorder:
+                    return False
+                count = header['count']
+                for arr in (self.starts, self.kinds, self.msg_hashes):
+                    arr.fromfile(f, count)
+        except (OSError, ValueError, KeyError, EOFError):
+            self.__init__(self.path)
+            return False
+        self.size = header['size']
+        self.mtime_ns = header['mtime_ns']
+        self.anchor = header['anchor']
+        return True
+
+    def _write_cache(self) -> None:
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps({
+                'version': self.VERSION,
+                'byteorder': sys.byteorder,
+                'count': len(self.starts),
+                'size': self.size,
+                'mtime_ns': self.mtime_ns,
+                'anchor': self.anchor,
+            }).encode('utf-8') + b'\n')
+            for arr in (self.starts, self.kinds, self.msg_hashes):
+                arr.tofile(f)
+        os.replace(tmp_path, self.cache_path)
+
+    def message_starts(self, skip_sidechain: bool = True) -> array:
+        """
+        每条聚合消息（按文件顺序，与 StreamingGrouper 的分组一致）的起始行号
+        只看类型和哈希，不解码任何内容；skip_sidechain 时内联的sidechain记录（拼接到Task调用下）不计为消息
+        """
+        starts = array('Q')
+        current = 0
+        for i, (kind, msg_hash) in enumerate(zip(self.kinds, self.msg_hashes)):
+            if kind & self.SIDECHAIN:
+                if skip_sidechain:
+                    continue
+                kind ^= self.SIDECHAIN
+            if kind == self.KIND_USER:
+                starts.append(i)
+                current = 0
+            elif kind == self.KIND_ASSISTANT and msg_hash and msg_hash != current:
+                starts.append(i)
+                current = msg_hash
+        return starts
+
+    def iter_records(self, lines: Iterable[int]) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """通过内存映射只解码指定的行（行号从0开始），产出 (行号, 记录)，跳过无效行"""
+        f, mm = self._open()
+        with f:
+            try:
+                for i in lines:
+                    end = self.starts[i + 1] if i + 1 < len(self.starts) else self.size
+                    obj = decode_record(mm[self.starts[i]:end], i + 1)
+                    if obj is not None:
+                        yield i, obj
+            finally:
+                if isinstance(mm, mmap.mmap):
+                    mm.close()
+
+
+def read_first_record(jsonl_file: str) -> Optional[Dict[str, Any]]:
+    """读取文件中第一条有效记录（跳过queue-operation），不读取文件其余部分"""
+    with open_session(jsonl_file) as f:
+        for line in f:
+            try:
+                obj = json_decode(line)
+            except JSON_DECODE_ERRORS:
+                continue
+            if isinstance(obj, dict) and obj.get('type') != 'queue-operation':
+                return obj
+    return None
+
+
+def record_prompt(record: Dict[str, Any]) -> str:
+    """记录中用户消息的文本（content 为字符串或 text 列表）"""
+    content = (record.get('message') or {}).get('content', '')
+    if isinstance(content, list):
+        content = '\n'.join(c.get('text', '') for c in content if isinstance(c, dict) and c.get('type') == 'text')
+    return content.strip() if isinstance(content, str) else ''
+
+
+_AGENT_FILE_CACHE = {}  # 目录 -> (目录mtime, {agent文件路径: 首条记录})
+
+
+AGENT_FILE_PATTERNS = ('agent-*.jsonl', 'agent-*.jsonl.gz', 'agent-*.jsonl.zst')
+
+
+def agent_files_in(directory: Path) -> Dict[str, Dict[str, Any]]:
+    """
+    目录中所有 agent-*.jsonl（含压缩的）文件及其首条记录，按目录mtime缓存（批处理时每个目录只扫描一次）
+    directory 为归档中的目录时从正在处理的归档成员中查找
+    """
+    if _ARCHIVE_MEMBERS and not os.path.isdir(directory):
+        prefix = f"{directory}/"
+        files = {}
+        for path in _ARCHIVE_MEMBERS:
+            name = path[len(prefix):]
+            if path.startswith(prefix) and '/' not in name and any(fnmatch.fnmatch(name, p) for p in AGENT_FILE_PATTERNS):
+                first = read_first_record(path)
+                if first is not None:
+                    files[path] = first
+        return files
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+    except OSError:
+        return {}
+    cached = _AGENT_FILE_CACHE.get(str(directory))
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    files = {}
+    for path, _ in discover_session_files(str(directory), include=AGENT_FILE_PATTERNS, exclude=()):
+        try:
+            first = read_first_record(path)
+        except OSError:
+            continue
+        if first is not None:
+            files[path] = first
+    _AGENT_FILE_CACHE[str(directory)] = (mtime, files)
+    return files
+
+
+class SubagentResolver:
+    """
+    子代理（sidechain）会话定位
+    优先用Task工具结果中的 agentId 直接定位 agent-<agentId>.jsonl；
+    缺少 agentId 的旧版本记录，则用会话的 uuid 索引匹配 sidechain 根记录的 parentUuid，
+    最后退回比较Task的prompt与子代理的第一条用户输入。每个子代理只会被拼接一次。
+    """
+
+    TASK_TOOLS = ('Task', 'Agent')
+
+    def __init__(self, session_file: str, session_id: Optional[str],
+                 records_by_uuid: Dict[str, Dict[str, Any]], sidechain_records: List[Dict[str, Any]]):
+        self.directory = Path(session_file).parent
+        self.session_id = session_id
+        self.records_by_uuid = records_by_uuid
+        self.sidechain_records = sidechain_records
+        self.candidates = None  # [(来源, 根记录)]，来源为agent文件路径或内联的sidechain记录列表
+        self.used = set()
+
+    def _agent_dirs(self) -> List[Path]:
+        dirs = [self.directory]
+        if self.session_id:
+            dirs.append(self.directory / self.session_id / 'subagents')
+        return dirs
+
+    def _build_candidates(self) -> List[Tuple[Any, Dict[str, Any]]]:
+        candidates = []
+
+        # 会话文件中内联的sidechain记录：沿parentUuid一次遍历切分为各自的链
+        chain_of = {}
+        chains = {}
+        for record in self.sidechain_records:
+            root = chain_of.get(record.get('parentUuid')) or record.get('uuid') or id(record)
+            if record.get('uuid'):
+                chain_of[record['uuid']] = root
+            chains.setdefault(root, []).append(record)
+        candidates.extend((records, records[0]) for records in chains.values())
+
+        # 同目录（及 <sessionId>/subagents/）中属于本会话的agent文件
+        for directory in self._agent_dirs():
+            for path, first in agent_files_in(directory).items():
+                if not self.session_id or first.get('sessionId') == self.session_id:
+                    candidates.append((path, first))
+        return candidates
+
+    def _root_matches(self, root: Dict[str, Any], tool: ToolCall) -> bool:
+        parent = self.records_by_uuid.get(root.get('parentUuid'))
+        if parent:
+            content = (parent.get('message') or {}).get('content', [])
+            if isinstance(content, list) and any(
+                    isinstance(c, dict) and c.get('id') == tool.id for c in content):
+                return True
+        prompt = (tool.input or {}).get('prompt')
+        return bool(prompt) and record_prompt(root) == prompt.strip()
+
+    def resolve(self, tool: ToolCall, tool_result: Optional[ToolResult]) -> Any:
+        """返回子代理记录的来源（agent文件路径或sidechain记录列表），找不到时返回None"""
+        agent_id = tool_result.agent_id if tool_result else None
+        if agent_id:
+            for directory in self._agent_dirs():
+                for suffix in ('',) + COMPRESSED_SUFFIXES:
+                    path = str(directory / f'agent-{agent_id}.jsonl{suffix}')
+                    if path not in self.used and session_file_exists(path):
+                        self.used.add(path)
+                        return path
+
+        if tool.name not in self.TASK_TOOLS:
+            return None
+
+        if self.candidates is None:
+            self.candidates = self._build_candidates()
+        for source, root in self.candidates:
+            # 流式读取时候选会随新的sidechain记录重建，内联的链以根记录的uuid标识
+            key = source if isinstance(source, str) else root.get('uuid') or id(root)
+            if key not in self.used and self._root_matches(root, tool):
+                self.used.add(key)
+                return source
+        return None
+
+
+class MarkdownRenderer:
+    """
+    服务端Markdown渲染（HTML导出的 --prerender）
+    支持对话中常见的语法：标题、段落（单个换行即换行）、有序/无序列表、引用、围栏代码块、表格、分隔线，
+    以及行内代码、粗体、斜体、删除线、链接和自动链接。所有文本先转义再加标签，
+    链接只允许 http(s)、mailto 和相对地址，因此输出无需再消毒。
+    渲染结果按文本的哈希缓存，重复出现的内容块只渲染一次
+    """
+
+    MAX_CACHE_ENTRIES = 8192
+    PYGMENTS_STYLE = 'monokai'
+
+    FENCE = re.compile(r'^( {0,3})(`{3,}|~{3,})[ \t]*([^\s`]*)')
+    HEADING = re.compile(r'^ {0,3}(#{1,6})(?:[ \t]+(.*?))?(?:[ \t]+#+)?[ \t]*$')
+    SETEXT = re.compile(r'^ {0,3}(=+|-+)[ \t]*$')
+    RULE = re.compile(r'^ {0,3}([-*_])(?:[ \t]*\1){2,}[ \t]*$')
+    QUOTE = re.compile(r'^ {0,3}> ?')
+    LIST_ITEM = re.compile(r'^( *)([-*+]|\d{1,9}[.)])(?:[ \t]+|$)')
+    TABLE_DELIMITER = re.compile(r'^ {0,3}\|?[ \t]*:?-+:?[ \t]*(?:\|[ \t]*:?-+:?[ \t]*)*\|?[ \t]*$')
+    CELL_SPLIT = re.compile(r'(?<!\\)\|')
+
+    INLINE_TOKEN = re.compile(
+        r'(?P<ticks>`+)(?P<code>.+?)(?<!`)(?P=ticks)(?!`)'
+        r'|!?\[(?P<label>[^\]\n]*)\]\((?P<url>[^()\s]*)(?:[ \t]+"[^"\n]*")?\)'
+        r'|<(?P<auto>(?:https?://|mailto:)[^\s<>]+)>'
+        r'|(?<![\w/])(?P<bare>https?://[^\s<>]*[^\s<>.,:;!?\'")\]*_~`])')
+    EMPHASIS = (
+        (re.compile(r'\*\*(?=\S)(.+?)(?<=\S)\*\*'), 'strong'),
+        (re.compile(r'(?<!\w)__(?=\S)(.+?)(?<=\S)__(?!\w)'), 'strong'),
+        (re.compile(r'(?<![*\w])\*(?=[^\s*])(.+?)(?<=[^\s*])\*(?![*\w])'), 'em'),
+        (re.compile(r'(?<!\w)_(?=[^\s_])(.+?)(?<=[^\s_])_(?!\w)'), 'em'),
+        (re.compile(r'~~(?=\S)(.+?)(?<=\S)~~'), 'del'),
+    )
+    PLACEHOLDER = re.compile(r'\x00(\d+)\x00')
+
+    def __init__(self):
+        self.cache = {}  # 文本的blake2b摘要 -> 渲染结果
+        self.hits = 0
+        self.misses = 0
+        self.formatter = HtmlFormatter(nowrap=True) if pygments is not None else None
+
+    def render(self, text: str) -> str:
+        """渲染一段Markdown文本为HTML片段"""
+        key = hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+        html = self.cache.get(key)
+        if html is not None:
+            self.hits += 1
+            return html
+
+        self.misses += 1
+        lines = text.replace('\x00', '').replace('\r\n', '\n').split('\n')
+        html = '\n'.join(self._blocks(lines))
+        if len(self.cache) >= self.MAX_CACHE_ENTRIES:
+            self.cache.clear()
+        self.cache[key] = html
+        return html
+
+    def style_defs(self) -> str:
+        """代码高亮的CSS，未安装 pygments 时为空"""
+        if pygments is None:
+            return ''
+        return HtmlFormatter(style=self.PYGMENTS_STYLE).get_style_defs('.text-section pre code')
+
+    # 块级语法
+
+    def _blocks(self, lines: List[str], tight: bool = False) -> List[str]:
+        """渲染块级元素；tight 为紧凑列表项，段落不加 <p>"""
+        out = []
+        i = 0
+        n = len(lines)
+        while i < n:
+            line = lines[i]
+            if not line.strip():
+                i += 1
+                continue
+
+            fence = self.FENCE.match(line)
+            if fence:
+                i = self._fenced_code(lines, i, fence, out)
+                continue
+
+            heading = self.HEADING.match(line)
+            if heading:
+                level = len(heading.group(1))
+                out.append(f'<h{level}>{self._inline(heading.group(2) or "")}</h{level}>')
+                i += 1
+                continue
+
+            if self.RULE.match(line):
+                out.append('<hr>')
+                i += 1
+                continue
+
+            if self.QUOTE.match(line):
+                quoted = []
+                while i < n and lines[i].strip():
+                    quote = self.QUOTE.match(lines[i])
+                    quoted.append(lines[i][quote.end():] if quote else lines[i])
+                    i += 1
+                out.append('<blockquote>\n' + '\n'.join(self._blocks(quoted)) + '\n</blockquote>')
+                continue
+
+            if self._is_table(lines, i):
+                i = self._table(lines, i, out)
+                continue
+
+            if self.LIST_ITEM.match(line):
+                i = self._list(lines, i, out)
+                continue
+
+            # 段落：直到空行或另一个块级元素
+            paragraph = [line.strip()]
+            i += 1
+            level = 0
+            while i < n and lines[i].strip():
+                setext = self.SETEXT.match(lines[i])
+                if setext:
+                    level = 1 if setext.group(1)[0] == '=' else 2
+                    i += 1
+                    break
+                if self._starts_block(lines, i):
+                    break
+                paragraph.append(lines[i].strip())
+                i += 1
+
+            text = self._inline('\n'.join(paragraph))
+            if level:
+                out.append(f'<h{level}>{text}</h{level}>')
+            else:
+                text = text.replace('\n', '<br>\n')
+                out.append(text if tight else f'<p>{text}</p>')
+        return out
+
+    def _starts_block(self, lines: List[str], i: int) -> bool:
+        """该行是否开始一个新的块级元素（可以打断段落）"""
+        line = lines[i]
+        return bool(self.FENCE.match(line) or self.HEADING.match(line) or self.RULE.match(line)
+                    or self.QUOTE.match(line) or self.LIST_ITEM.match(line) or self._is_table(lines, i))
+
+    def _fenced_code(self, lines: List[str], i: int, fence: Any, out: List[str]) -> int:
+        indent = len(fence.group(1))
+        marker = fence.group(2)
+        closing = re.compile(r'^ {0,3}' + re.escape(marker[0]) + '{' + str(len(marker)) + r',}[ \t]*$')
+        code = []
+        i += 1
+        while i < len(lines) and not closing.match(lines[i]):
+            line = lines[i]
+            strip = min(indent, len(line) - len(line.lstrip(' ')))
+            code.append(line[strip:])
+            i += 1
+        out.append(self._code_block('\n'.join(code), fence.group(3)))
+        return i + 1
+
+    def _code_block(self, code: str, lang: str) -> str:
+        attr = f' class="language-{html_module.escape(lang)}"' if lang else ''
+        if self.formatter is not None and lang:
+            try:
+                lexer = get_lexer_by_name(lang)
+            except ClassNotFound:
+                lexer = None
+            if lexer is not None:
+                return f'<pre><code{attr}>{pygments.highlight(code, lexer, self.formatter).rstrip()}</code></pre>'
+        return f'<pre><code{attr}>{html_module.escape(code)}</code></pre>'
+
+    def _list(self, lines: List[str], i: int, out: List[str]) -> int:
+        first = self.LIST_ITEM.match(lines[i])
+        indent = len(first.group(1))
+        ordered = first.group(2)[0].isdigit()
+        items = []
+        loose = False
+        n = len(lines)
+
+        while i < n:
+            item = self.LIST_ITEM.match(lines[i])
+            if (item is None or len(item.group(1)) != indent
+                    or item.group(2)[0].isdigit() != ordered):
+                break
+            marker_end = len(item.group(1)) + len(item.group(2))
+            content_offset = item.end() if item.end() - marker_end <= 4 else marker_end + 1
+
+            body = [lines[i][item.end():]]
+            i += 1
+            blank = False
+            while i < n:
+                line = lines[i]
+                if not line.strip():
+                    body.append('')
+                    blank = True
+                    i += 1
+                    continue
+                line_indent = len(line) - len(line.lstrip(' '))
+                if line_indent > indent:
+                    # 缩进的行属于当前列表项（含嵌套列表）；项内有空行分隔时为松散列表
+                    loose = loose or blank
+                    body.append(line[min(line_indent, content_offset):])
+                    blank = False
+                    i += 1
+                    continue
+                if blank or self._starts_block(lines, i):
+                    break
+                # 惰性续行
+                body.append(line.strip())
+                i += 1
+
+            while body and not body[-1].strip():
+                body.pop()
+            items.append(body)
+
+            # 列表项之间有空行时为松散列表
+            if blank and i < n:
+                sibling = self.LIST_ITEM.match(lines[i])
+                if sibling and len(sibling.group(1)) == indent and sibling.group(2)[0].isdigit() == ordered:
+                    loose = True
+                    continue
+                break
+
+        tag = 'ol' if ordered else 'ul'
+        start = int(first.group(2)[:-1]) if ordered else 1
+        parts = [f'<{tag} start="{start}">' if start != 1 else f'<{tag}>']
+        for body in items:
+            parts.append('<li>' + '\n'.join(self._blocks(body, tight=not loose)) + '</li>')
+        parts.append(f'</{tag}>')
+        out.append('\n'.join(parts))
+        return i
+
+    def _split_row(self, line: str) -> List[str]:
+        line = line.strip()
+        if line.startswith('|'):
+            line = line[1:]
+        if line.endswith('|') and not line.endswith('\\|'):
+            line = line[:-1]
+        return [cell.strip().replace('\\|', '|') for cell in self.CELL_SPLIT.split(line)]
+
+    def _is_table(self, lines: List[str], i: int) -> bool:
+        return (i + 1 < len(lines) and '|' in lines[i] and '-' in lines[i + 1]
+                and bool(self.TABLE_DELIMITER.match(lines[i + 1]))
+                and len(self._split_row(lines[i])) == len(self._split_row(lines[i + 1])))
+
+    def _table(self, lines: List[str], i: int, out: List[str]) -> int:
+        header = self._split_row(lines[i])
+        aligns = []
+        for cell in self._split_row(lines[i + 1]):
+            if cell.startswith(':') and cell.endswith(':'):
+                aligns.append(' style="text-align: center"')
+            elif cell.endswith(':'):
+                aligns.append(' style="text-align: right"')
+            elif cell.startswith(':'):
+                aligns.append(' style="text-align: left"')
+            else:
+                aligns.append('')
+
+        parts = ['<table>', '<thead>', '<tr>']
+        parts.extend(f'<th{align}>{self._inline(cell)}</th>' for cell, align in zip(header, aligns))
+        parts.extend(['</tr>', '</thead>'])
+        i += 2
+        rows = []
+        while i < len(lines) and lines[i].strip() and not (
+                self.FENCE.match(lines[i]) or self.HEADING.match(lines[i]) or self.QUOTE.match(lines[i])):
+            cells = self._split_row(lines[i])
+            cells = (cells + [''] * len(header))[:len(header)]
+            rows.append('<tr>' + ''.join(f'<td{align}>{self._inline(cell)}</td>'
+                                         for cell, align in zip(cells, aligns)) + '</tr>')
+            i += 1
+        if rows:
+            parts.append('<tbody>')
+            parts.extend(rows)
+            parts.append('</tbody>')
+        parts.append('</table>')
+        out.append('\n'.join(parts))
+        return i
+
+    # 行内语法
+
+    @staticmethod
+    def _safe_url(url: str) -> Optional[str]:
+        """只允许 http(s)、mailto 和相对地址，其它协议（javascript: 等）返回None"""
+        scheme = re.match(r'^([a-zA-Z][a-zA-Z0-9+.-]*):', url)
+        if scheme and scheme.group(1).lower() not in ('http', 'https', 'mailto'):
+            return None
+        return url
+
+    def _inline(self, text: str) -> str:
+        """
+        渲染行内语法：代码、链接等先替换为占位符，转义其余文本后再处理强调，最后填回占位符，
+        保证代码和链接地址中的字符不会被当作格式
+        """
+        stash = []
+
+        def keep(html: str) -> str:
+            stash.append(html)
+            return f'\x00{len(stash) - 1}\x00'
+
+        def token(match: Any) -> str:
+            if match.group('code') is not None:
+                code = match.group('code')
+                if code.startswith(' ') and code.endswith(' ') and code.strip():
+                    code = code[1:-1]
+                return keep(f'<code>{html_module.escape(code)}</code>')
+            if match.group('label') is not None:
+                label = self._inline(match.group('label'))
+                href = self._safe_url(match.group('url'))
+                if href is None:
+                    return keep(label)
+                return keep(f'<a href="{html_module.escape(href)}">{label}</a>')
+            url = match.group('auto') or match.group('bare')
+            return keep(f'<a href="{html_module.escape(url)}">{html_module.escape(url)}</a>')
+
+        text = html_module.escape(self.INLINE_TOKEN.sub(token, text), quote=False)
+        for pattern, tag in self.EMPHASIS:
+            text = pattern.sub(rf'<{tag}>\1</{tag}>', text)
+        return self.PLACEHOLDER.sub(lambda m: stash[int(m.group(1))], text)
+
+
+MARKDOWN_RENDERER = MarkdownRenderer()  # 进程内共享，批处理时跨会话复用渲染缓存
+
+# HTML页面在浏览器端使用的第三方库: 文件名 -> CDN地址
+# 共享资源模式下，放在本脚本旁 vendor/ 目录中的同名文件会复制到资源目录，页面完全离线可用
+VENDOR_ASSETS = {
+    'github-dark.min.css': 'https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.9.0/styles/github-dark.min.css',
+    'marked.min.js': 'https://cdn.jsdelivr.net/npm/marked@11.1.1/marked.min.js',
+    'purify.min.js': 'https://cdn.jsdelivr.net/npm/dompurify@3.0.6/dist/purify.min.js',
+    'highlight.min.js': 'https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.9.0/highlight.min.js',
+}
+VENDOR_DIR = Path(__file__).resolve().parent / 'vendor'
+
+_ASSET_BUNDLES = {}  # (资源目录, 是否预渲染) -> {资源: 文件名}，每个进程只写一次
+
+
+def write_asset(assets_dir: str, name: str, data: bytes) -> str:
+    """
+    把资源以带内容哈希的文件名（如 restore_chat-1a2b3c4d5e6f.css）写入共享资源目录，返回文件名
+    内容不变时文件名不变，浏览器可以长期缓存；同名文件已存在时不再重写，并行进程同时写入也安全
+    """
+    stem, _, ext = name.partition('.')
+    file_name = f"{stem}-{hashlib.blake2b(data, digest_size=6).hexdigest()}.{ext}"
+    path = Path(assets_dir) / file_name
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{file_name}.{os.getpid()}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+    return file_name
+
+
+USAGE_FIELDS = ('input_tokens', 'output_tokens', 'cache_read_input_tokens', 'cache_creation_input_tokens')
+
+
+class SessionStats:
+    """
+    会话统计（记录观察者）
+    作为 ChatRestorer 的 observers 之一，在还原的同一次解析中逐条接收解码后的记录，
+    不必为统计再读取和解码一遍文件。usage 按 message.id 去重（同一消息的流式记录重复携带 usage）
+    """
+
+    def __init__(self):
+        self.total_lines = 0
+        self.counts = defaultdict(int)
+        self.message_ids = set()
+        self.usage_by_message = {}
+
+    @classmethod
+    def from_file(cls, jsonl_file: str) -> 'SessionStats':
+        """只做统计时直接扫描文件（跳过无法解析的行）"""
+        stats = cls()
+        line_num = 0
+        with open(jsonl_file, 'rb') as f:
+            for line_num, line in enumerate(f, 1):
+                try:
+                    stats.observe(json_decode(line))
+                except JSON_DECODE_ERRORS:
+                    continue
+        stats.finish(line_num)
+        return stats
+
+    def observe(self, obj: Dict[str, Any]) -> None:
+        obj_type = obj.get('type')
+        message = obj.get('message')
+        content = message.get('content') if isinstance(message, dict) else None
+        items = [item for item in content if isinstance(item, dict)] if isinstance(content, list) else []
+
+        if obj_type == 'queue-operation':
+            self.counts['queue_operations'] += 1
+        elif obj_type == 'user':
+            self.counts['user_messages'] += 1
+            self.counts['tool_results'] += sum(1 for item in items if item.get('type') == 'tool_result')
+        elif obj_type == 'assistant':
+            self.counts['assistant_messages'] += 1
+            msg_id = message.get('id') if isinstance(message, dict) else None
+            if msg_id:
+                self.message_ids.add(msg_id)
+
+            usage = message.get('usage') if isinstance(message, dict) else None
+            if isinstance(usage, dict):
+                merged = self.usage_by_message.setdefault(msg_id or len(self.usage_by_message), {})
+                for field in USAGE_FIELDS:
+                    merged[field] = max(merged.get(field, 0), usage.get(field) or 0)
+
+            for item in items:
+                item_type = item.get('type')
+                if item_type == 'thinking':
+                    self.counts['thinking_blocks'] += 1
+                elif item_type == 'text':
+                    self.counts['text_responses'] += 1
+                elif item_type == 'tool_use':
+                    self.counts['tool_uses'] += 1
+
+    def finish(self, total_lines: int) -> None:
+        """文件读取结束时调用，total_lines 为总行数（含无法解析的行）"""
+        self.total_lines = total_lines
+
+    def to_dict(self) -> Dict[str, int]:
+        """与 test_summary.analyze_jsonl 相同的统计字典"""
+        totals = {field: sum(usage[field] for usage in self.usage_by_message.values()) for field in USAGE_FIELDS}
+        return {
+            'total_lines': self.total_lines,
+            'queue_operations': self.counts['queue_operations'],
+            'user_messages': self.counts['user_messages'],
+            'assistant_messages': self.counts['assistant_messages'],
+            'tool_uses': self.counts['tool_uses'],
+            'tool_results': self.counts['tool_results'],
+            'thinking_blocks': self.counts['thinking_blocks'],
+            'text_responses': self.counts['text_responses'],
+            'unique_message_ids': len(self.message_ids),
+            'total_input_tokens': totals['input_tokens'],
+            'total_output_tokens': totals['output_tokens'],
+            'total_cache_read_tokens': totals['cache_read_input_tokens'],
+            'total_cache_creation_tokens': totals['cache_creation_input_tokens'],
+        }
+
+
+PROFILE_STAGES = {
+    'discover': '文件发现',
+    'archive': '读取归档',
+    'manifest': '增量清单检查',
+    'decode': '读取与JSON解码',
+    'load': '关联tool_result',
+    'group': '消息聚合',
+    'render_txt': '渲染 txt',
+    'render_markdown': '渲染 markdown',
+    'render_html': '渲染 html',
+    'render_parquet': '导出 parquet',
+    'render_arrow': '导出 arrow',
+    'file': '其他',
+}
+
+
+class ProfileSpan:
+    """一段计时区间，bytes/records 可在区间内填写"""
+    __slots__ = ('profiler', 'file', 'stage', 'trace', 'bytes', 'records', 'start', 'children')
+
+    def __init__(self, profiler: 'Profiler', file: str, stage: str, trace: bool):
+        self.profiler = profiler
+        self.file = file
+        self.stage = stage
+        self.trace = trace
+        self.bytes = 0
+        self.records = 0
+        self.children = 0.0  # 嵌套区间的耗时，不计入本区间的自身耗时
+
+    def __enter__(self) -> 'ProfileSpan':
+        self.start = time.perf_counter()
+        self.profiler._stack.append(self)
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        self.profiler._close(self, time.perf_counter())
+        return False
+
+
+class _NullSpan:
+    """未开启 --profile 时使用的空区间"""
+    bytes = 0
+    records = 0
+
+    def __enter__(self) -> '_NullSpan':
+        return self
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        pass  # 忽略 bytes/records 的填写
+
+    def __exit__(self, *exc_info) -> bool:
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Profiler:
+    """
+    分阶段计时（--profile）
+    按阶段累计自身耗时（不含嵌套阶段）、字节数和记录数，各阶段耗时之和即总耗时；
+    stage 为 'file' 的区间表示一个会话文件，结束时记下该文件各阶段的耗时。
+    区间同时记为 Chrome trace 的完整事件（ph 'X'）。未开启时各处只持有 None，不做任何计时。
+    """
+
+    def __init__(self):
+        self.stages = {}  # 阶段 -> [自身耗时, 字节数, 记录数, 次数]
+        self.files = []  # 每个会话文件: {'file', 'seconds', 'bytes', 'stages': {阶段: 自身耗时}}
+        self.events = []
+        self._stack = []
+        self._file_stages = {}
+
+    def span(self, file: str, stage: str, trace: bool = True) -> ProfileSpan:
+        """计时区间；trace 为False时只累计，不记为trace事件（用于逐条消息等细粒度区间）"""
+        return ProfileSpan(self, file, stage, trace)
+
+    def add(self, stage: str, seconds: float, nbytes: int = 0, records: int = 0) -> None:
+        """累计一段不连续的耗时（如逐行解码），从当前区间的自身耗时中扣除"""
+        if self._stack:
+            self._stack[-1].children += seconds
+        self._account(stage, seconds, nbytes, records)
+
+    def _account(self, stage: str, seconds: float, nbytes: int, records: int) -> None:
+        totals = self.stages.setdefault(stage, [0.0, 0, 0, 0])
+        totals[0] += seconds
+        totals[1] += nbytes
+        totals[2] += records
+        totals[3] += 1
+        self._file_stages[stage] = self._file_stages.get(stage, 0.0) + seconds
+
+    def _close(self, span: ProfileSpan, end: float) -> None:
+        self._stack.pop()
+        duration = end - span.start
+        if self._stack:
+            self._stack[-1].children += duration
+        # 文件区间的字节数（会话文件大小）只记在该文件的明细中，不按自身耗时计算吞吐
+        self._account(span.stage, duration - span.children, 0 if span.stage == 'file' else span.bytes, span.records)
+
+        if span.stage == 'file' and not self._stack:
+            self.files.append({'file': span.file, 'seconds': duration, 'bytes': span.bytes,
+                               'stages': self._file_stages})
+            self._file_stages = {}
+        if span.trace:
+            args = {'file': span.file}
+            if span.bytes:
+                args['bytes'] = span.bytes
+            if span.records:
+                args['records'] = span.records
+            if span.stage == 'file':
+                args['stages'] = {stage: round(seconds, 6) for stage, seconds in self.files[-1]['stages'].items()}
+            self.events.append({'name': Path(span.file).name if span.stage == 'file' else span.stage,
+                                'cat': span.stage, 'ph': 'X', 'ts': span.start * 1e6, 'dur': duration * 1e6,
+                                'pid': os.getpid(), 'tid': 0, 'args': args})
+
+    def to_dict(self) -> Dict[str, Any]:
+        """可跨进程传递的计时结果（perf_counter 为系统范围的单调时钟，各进程的事件可直接合并）"""
+        return {'stages': self.stages, 'files': self.files, 'events': self.events}
+
+    def merge(self, data: Dict[str, Any]) -> None:
+        """合并工作进程的计时结果"""
+        for stage, (seconds, nbytes, records, calls) in data['stages'].items():
+            totals = self.stages.setdefault(stage, [0.0, 0, 0, 0])
+            totals[0] += seconds
+            totals[1] += nbytes
+            totals[2] += records
+            totals[3] += calls
+        self.files.extend(data['files'])
+        self.events.extend(data['events'])
+
+    def summary(self) -> Dict[str, Any]:
+        """JSON报告：各阶段合计，以及按耗时从高到低排列的各会话文件"""
+        return {
+            'version': __version__,
+            'stages': {stage: {'seconds': round(seconds, 6), 'bytes': nbytes, 'records': records, 'calls': calls}
+                       for stage, (seconds, nbytes, records, calls) in self.stages.items()},
+            'files': [dict(entry, seconds=round(entry['seconds'], 6),
+                           stages={stage: round(seconds, 6) for stage, seconds in entry['stages'].items()})
+                      for entry in sorted(self.files, key=lambda entry: -entry['seconds'])],
+        }
+
+    def write_json(self, path: str) -> None:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, ensure_ascii=False, indent=1)
+
+    def write_trace(self, path: str) -> None:
+        """写出 Chrome trace（可在 chrome://tracing 或 Perfetto 中打开），时间以第一个事件为零点"""
+        origin = min((event['ts'] for event in self.events), default=0)
+        events = [{**event, 'ts': round(event['ts'] - origin, 3), 'dur': round(event['dur'], 3)}
+                  for event in self.events]
+        for pid in sorted({event['pid'] for event in events}):
+            events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+                           'args': {'name': f'restore_chat ({pid})'}})
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, ensure_ascii=False)
+
+    def print_summary(self, top: int = 10) -> None:
+        """打印各阶段的耗时表，以及耗时最多的会话文件和其中占比最高的阶段"""
+        total = sum(seconds for seconds, _, _, _ in self.stages.values()) or 1e-9
+        print("")
+        print("⏱️  分阶段耗时（自身耗时，不含嵌套阶段；并行处理时为各进程耗时之和）")
+        print(f"{'阶段':<14}{'耗时(s)':>8}{'占比':>6}{'MB':>10}{'记录数':>9}{'MB/s':>10}")
+        print("-" * 70)
+        order = list(PROFILE_STAGES) + sorted(set(self.stages) - set(PROFILE_STAGES))
+        for stage in order:
+            if stage not in self.stages:
+                continue
+            seconds, nbytes, records, _ = self.stages[stage]
+            mb = nbytes / 1024 / 1024
+            label = PROFILE_STAGES.get(stage, stage)
+            wide = sum(1 for c in label if ord(c) > 0x2E80)  # 中文占两格
+            print(f"{label:<{16 - wide}}{seconds:>10.3f}{seconds / total:>8.1%}"
+                  f"{f'{mb:.1f}' if nbytes else '-':>10}{f'{records:,}' if records else '-':>12}"
+                  f"{f'{mb / seconds:.1f}' if nbytes and seconds > 0 else '-':>10}")
+        print("-" * 70)
+        print(f"{'合计':<14}{total:>10.3f}")
+
+        if len(self.files) > 1:
+            print("")
+            print(f"🐢 耗时最多的 {min(top, len(self.files))} 个会话文件:")
+            for entry in sorted(self.files, key=lambda entry: -entry['seconds'])[:top]:
+                stage, seconds = max(entry['stages'].items(), key=lambda item: item[1])
+                share = seconds / entry['seconds'] if entry['seconds'] > 0 else 0
+                print(f"  {entry['seconds']:>8.3f}s  {entry['bytes'] / 1024 / 1024:>8.1f} MB  "
+                      f"{PROFILE_STAGES.get(stage, stage)} {share:.0%}  {entry['file']}")
+
+
+def profile_span(profiler: Optional[Profiler], file: str, stage: str) -> Any:
+    """profiler 为None（未开启 --profile）时返回空区间"""
+    return profiler.span(file, stage) if profiler is not None else NULL_SPAN
+
+
+def profiled(stage: str) -> Callable:
+    """
+    ChatRestorer 方法的计时装饰器，stage 为 'render' 时按当前输出格式记为 render_<格式>
+    未开启时只多一次属性判断；返回列表时记下其长度（如聚合后的消息数）
+    """
+    def decorate(method: Callable) -> Callable:
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.profiler is None:
+                return method(self, *args, **kwargs)
+            name = f'render_{self.output_format}' if stage == 'render' else stage
+            with self.profiler.span(self.jsonl_file, name) as span:
+                result = method(self, *args, **kwargs)
+                if isinstance(result, list):
+                    span.records = len(result)
+                return result
+        return wrapper
+    return decorate
+
 
 class ChatRestorer:
-    def __init__(self, jsonl_file: str, output_format: str = 'txt'):
+    MAX_SUBAGENT_DEPTH = 3
+
+    def __init__(self, jsonl_file: str, output_format: str = 'txt', stitch_subagents: bool = True,
+                 is_sidechain: bool = False, depth: int = 0, page_size: int = 0, prerender: bool = False,
+                 assets_dir: Optional[str] = None, observers: Optional[Iterable[Any]] = None,
+                 profiler: Optional[Profiler] = None, compress: Optional[str] = None):
         self.jsonl_file = jsonl_file
         self.output_format = output_format  # 'txt' or 'markdown'
+        self.page_size = page_size  # HTML分页导出时每页的消息数，0 表示不分页
+        self.prerender = prerender  # HTML导出时在本地渲染Markdown，页面不依赖JavaScript和CDN
+        self.assets_dir = assets_dir  # HTML共享资源目录，为None时样式和脚本内联在每个页面中
+        self.output_dir = None  # 输出文件所在目录（默认为会话文件所在目录），用于计算共享资源的相对地址
+        self.compress = compress  # 输出压缩方式（gzip / zstd），为None时不压缩
         self.messages = []  # 存储所有消息
         self.tool_results = {}  # 存储tool_result，以tool_use_id为key
-
-    def load_data(self):
-        """加载JSONL数据"""
-        with open(self.jsonl_file, 'r', encoding='utf-8') as f:
+        self.stitch_subagents = stitch_subagents  # 将子代理会话嵌入到对应的Task工具调用下
+        self.is_sidechain = is_sidechain  # 本文件自身就是子代理记录
+        self.depth = depth
+        self.session_id = None
+        self.records_by_uuid = {}  # uuid -> 记录，一次遍历建立
+        self.sidechain_records = []  # 会话文件中内联的sidechain记录
+        self._subagent_resolver = None
+        self._subagent_cache = None  # 多格式输出时缓存当前消息的子代理会话，各格式共用一次解析
+        # 记录观察者（如 SessionStats）：完整读取会话文件时逐条接收解码后的记录，结束时收到总行数
+        self.observers = list(observers or [])
+        self.profiler = profiler  # 分阶段计时（--profile），为None时不计时
+
+    def _observe(self, obj: Dict[str, Any]) -> None:
+        for observer in self.observers:
+            observer.observe(obj)
+
+    def _iter_records(self) -> Iterator[Dict[str, Any]]:
+        """逐行读取并解码JSONL，跳过queue-operation和无法解析的行"""
+        for _, _, obj in self._iter_record_spans():
+            yield obj
+
+    def _iter_record_spans(self) -> Iterator[Tuple[int, bytes, Dict[str, Any]]]:
+        """同 _iter_records，同时产出每行在文件中的起始偏移和原始字节: (offset, line, record)"""
+        offset = 0
+        line_num = 0
+        observe = self._observe if self.observers else None
+        # --profile: 逐行累计读取和解码的耗时（不含调用方处理记录的时间）
+        profiler = self.profiler
+        decode_time = 0.0
+        start = time.perf_counter() if profiler is not None else 0.0
+        with open_session(self.jsonl_file) as f:
             for line_num, line in enumerate(f, 1):
-                try:
-                    obj = json.loads(line.strip())
-                    # 跳过queue-operation
-                    if obj.get('type') in ['queue-operation']:
-                        continue
+                obj = decode_record(line, line_num, observe)
+                if profiler is not None:
+                    decode_time += time.perf_counter() - start
+                if obj is not None:
+                    if self.session_id is None and obj.get('sessionId'):
+                        self.session_id = obj['sessionId']
+                    yield offset, line, obj
+                offset += len(line)
+                if profiler is not None:
+                    start = time.perf_counter()
+        for observer in self.observers:
+            observer.finish(line_num)
+        if profiler is not None:
+            profiler.add('decode', decode_time, offset, line_num)
+
+    @staticmethod
+    def _extract_tool_results(obj: Dict[str, Any],
+                              make_lazy: Optional[Callable[[str, Any], Optional[LazyText]]] = None
+                              ) -> Iterator[Tuple[str, ToolResult]]:
+        """
+        从user记录中提取 (tool_use_id, tool_result) 对
+        make_lazy 可以把长内容替换为 LazyText，此时不拼接内容，并在记录中用 LazyText 替换原内容
+        """
+        if obj.get('type') == 'user' and obj.get('message'):
+            content = obj['message'].get('content', [])
+            for item in content:
+                if item.get('type') == 'tool_result':
+                    tool_use_id = item.get('tool_use_id')
+                    if tool_use_id:
+                        # content可能是字符串或列表，需要统一处理为字符串
+                        raw_content = item.get('content', '')
+                        lazy = make_lazy(tool_use_id, raw_content) if make_lazy else None
+                        if lazy is not None:
+                            content_str = item['content'] = lazy
+                        elif isinstance(raw_content, list):
+                            # 如果是列表，提取所有text内容
+                            text_parts = []
+                            for c in raw_content:
+                                if isinstance(c, dict) and c.get('type') == 'text':
+                                    text_parts.append(c.get('text', ''))
+                                elif isinstance(c, str):
+                                    text_parts.append(c)
+                            content_str = '\n'.join(text_parts)
+                        else:
+                            content_str = str(raw_content)
+
+                        # Task工具的结果中记录了子代理的agentId
+                        tool_use_result = obj.get('toolUseResult')
+                        agent_id = tool_use_result.get('agentId') if isinstance(tool_use_result, dict) else None
+
+                        yield tool_use_id, ToolResult(content_str, obj.get('timestamp'), agent_id)
+
+    @profiled('load')
+    def load_data(self):
+        """
+        加载JSONL数据
+        长的tool_result内容只记录字节位置（LazyText），渲染时按需解码（压缩文件和归档成员无法按偏移读取，照常解码）；
+        toolUseResult 中重复的原始结果（文件内容、命令输出等）不再保留
+        """
+        seekable = is_plain_file(self.jsonl_file)
+        for offset, line, obj in self._iter_record_spans():
+            make_lazy = None
+            if seekable and len(line) > self.LAZY_MIN_CHARS and obj.get('type') == 'user':
+                make_lazy = self._lazy_factory(offset, line)
+            self._load_record(obj, make_lazy)
+
+    def _load_records(self, records: Iterable[Dict[str, Any]]) -> None:
+        for obj in records:
+            self._load_record(obj)
+
+    def _load_record(self, obj: Dict[str, Any],
+                     make_lazy: Optional[Callable[[str, Any], Optional[LazyText]]] = None) -> None:
+        # 内联的sidechain记录单独保存，渲染时嵌入到对应的Task工具调用下
+        if self.stitch_subagents and not self.is_sidechain and obj.get('isSidechain'):
+            self.sidechain_records.append(obj)
+            return
+
+        # 收集tool_result；之后不再需要toolUseResult中重复的原始结果
+        for tool_use_id, tool_result in self._extract_tool_results(obj, make_lazy):
+            self.tool_results[tool_use_id] = tool_result
+        obj.pop('toolUseResult', None)
+
+        self.messages.append(obj)
+        if obj.get('uuid'):
+            self.records_by_uuid[obj['uuid']] = obj
+
+    LAZY_MIN_CHARS = 2000  # 超过这个长度的字符串tool_result内容延迟解码
+
+    # Claude Code 写出的tool_result对象: {"tool_use_id":"...","type":"tool_result","content":"...
+    TOOL_RESULT_HEAD = re.compile(rb'"tool_use_id":"[^"\\]*","type":"tool_result","content":"')
+
+    def _lazy_factory(self, offset: int, line: bytes) -> Callable[[str, Any], Optional[LazyText]]:
+        """为一行记录生成 make_lazy：在原始字节中定位长字符串内容的字面量，找不到时返回None（照常解码）"""
+        def make_lazy(tool_use_id: str, raw_content: Any) -> Optional[LazyText]:
+            if not isinstance(raw_content, str) or len(raw_content) <= self.LAZY_MIN_CHARS:
+                return None
+            pos = line.find(b'"tool_use_id":"' + tool_use_id.encode('utf-8') + b'"')
+            match = self.TOOL_RESULT_HEAD.match(line, pos) if pos >= 0 else None
+            if match is None:
+                return None
+            return LazyText(self.jsonl_file, offset + match.end(), offset + len(line),
+                            len(raw_content), raw_content.count('\n') + 1)
+        return make_lazy
+
+    def subagent_messages(self, tool: ToolCall, keep_raw: bool = False) -> Tuple[Optional['ChatRestorer'], List[Message]]:
+        """
+        查找Task工具调用对应的子代理会话
+        返回 (子代理的ChatRestorer, 聚合后的子代理消息)，没有子代理时返回 (None, [])；keep_raw 同 group_messages
+        """
+        if not self.stitch_subagents or self.depth >= self.MAX_SUBAGENT_DEPTH:
+            return None, []
+        if self._subagent_cache is not None and tool.id in self._subagent_cache:
+            nested, messages = self._subagent_cache[tool.id]
+            if nested is not None:
+                nested.output_format = self.output_format
+            return nested, messages
+
+        if self._subagent_resolver is None:
+            self._subagent_resolver = SubagentResolver(
+                self.jsonl_file, self.session_id, self.records_by_uuid, self.sidechain_records)
+        source = self._subagent_resolver.resolve(tool, self.tool_results.get(tool.id))
+        if source is None:
+            return None, []
+
+        nested = ChatRestorer(source if isinstance(source, str) else self.jsonl_file, self.output_format,
+                              self.stitch_subagents, is_sidechain=True, depth=self.depth + 1,
+                              prerender=self.prerender, profiler=self.profiler)
+        try:
+            if isinstance(source, str):
+                nested.load_data()
+            else:
+                nested._load_records(source)
+        except OSError as e:
+            print(f"警告: 无法读取子代理记录 {source}: {e}", file=sys.stderr)
+            return None, []
+        messages = nested.group_messages(keep_raw)
+        if self._subagent_cache is not None:
+            nested._subagent_cache = {}
+            self._subagent_cache[tool.id] = (nested, messages)
+        return nested, messages
+
+    @staticmethod
+    def _is_turn(record: Dict[str, Any]) -> bool:
+        """记录是否会渲染为一条消息：助手回复，或含非tool_result内容的用户输入"""
+        if record.get('type') == 'assistant':
+            return True
+        if record.get('type') == 'user':
+            content = (record.get('message') or {}).get('content', [])
+            return any(c.get('type') != 'tool_result' for c in content)
+        return False
+
+    def _conversation_tree(self) -> Tuple[List[int], List[Optional[int]], Dict[int, List[int]], List[Optional[int]]]:
+        """
+        由 uuid/parentUuid 一次遍历建立对话树，节点为 self.messages 的下标
+        返回 (根节点, 第一个子节点, 有多个子节点的父节点 -> 全部子节点, 父节点)；
+        绝大多数节点只有一个子节点，不为每个节点单独分配子节点列表。
+        compact_boundary 通过 logicalParentUuid 接回压缩前的对话；没有uuid的旧格式记录按文件顺序串联。
+        只接受出现在子记录之前的父记录，保证结果无环。
+        """
+        position = {}
+        roots = []
+        first_child = [None] * len(self.messages)
+        forks = {}
+        parents = [None] * len(self.messages)
+
+        for i, record in enumerate(self.messages):
+            uuid = record.get('uuid')
+            parent = position.get(record.get('parentUuid'))
+            if parent is None:
+                parent = position.get(record.get('logicalParentUuid'))
+            if parent is None and not uuid and i > 0:
+                parent = i - 1
+
+            if parent is None:
+                roots.append(i)
+            else:
+                parents[i] = parent
+                if first_child[parent] is None:
+                    first_child[parent] = i
+                elif parent in forks:
+                    forks[parent].append(i)
+                else:
+                    forks[parent] = [first_child[parent], i]
 
-                    # 收集tool_result
-                    if obj.get('type') == 'user' and obj.get('message'):
-                        content = obj['message'].get('content', [])
-                        for item in content:
-                            if item.get('type') == 'tool_result':
-                                tool_use_id = item.get('tool_use_id')
-                                if tool_use_id:
-                                    # content可能是字符串或列表，需要统一处理为字符串
-                                    raw_content = item.get('content', '')
-                                    if isinstance(raw_content, list):
-                                        # 如果是列表，提取所有text内容
-                                        text_parts = []
-                                        for c in raw_content:
-                                            if isinstance(c, dict) and c.get('type') == 'text':
-                                                text_parts.append(c.get('text', ''))
-                                            elif isinstance(c, str):
-                                                text_parts.append(c)
-                                        content_str = '\n'.join(text_parts)
-                                    else:
-                                        content_str = str(raw_content)
-
-                                    self.tool_results[tool_use_id] = {
-                                        'content': content_str,
-                                        'timestamp': obj.get('timestamp')
-                                    }
-
-                    self.messages.append(obj)
-                except json.JSONDecodeError as e:
-                    print(f"警告: 第 {line_num} 行JSON解析失败: {e}", file=sys.stderr)
-                    continue
+            if uuid and uuid not in position:
+                position[uuid] = i
+
+        return roots, first_child, forks, parents
 
-    def group_messages(self) -> List[Dict[str, Any]]:
+    def _ordered_children(self, parent: int, children: List[int], visible: List[bool],
+                          last: List[int]) -> List[Tuple[int, Optional[Dict[str, Any]]]]:
         """
-        将消息按message.id分组聚合
+        子节点的遍历顺序及分支信息
+        同一message.id的后续记录、tool_result和不含消息的子树不算分支；
+        有两个以上真正的分支时，未继续的分支按文件顺序在前，最终延续到会话末尾的当前分支在最后。
+        """
+        parent_msg_id = (self.messages[parent].get('message') or {}).get('id')
+
+        def is_branch(child: int) -> bool:
+            record = self.messages[child]
+            if not visible[child]:
+                return False
+            if record.get('type') == 'assistant':
+                return (record.get('message') or {}).get('id') != parent_msg_id
+            return record.get('type') != 'user' or self._is_turn(record)
+
+        branches = [c for c in children if is_branch(c)]
+        if len(branches) < 2:
+            return [(c, None) for c in children]
+
+        current = max(branches, key=lambda c: last[c])
+        ordered = [(c, None) for c in children if c not in branches]
+        for number, child in enumerate(branches, 1):
+            if child != current:
+                ordered.append((child, {'index': number, 'count': len(branches), 'current': False}))
+        ordered.append((current, {'index': branches.index(current) + 1, 'count': len(branches), 'current': True}))
+        return ordered
+
+    @profiled('group')
+    def group_messages(self, keep_raw: bool = False) -> List[Message]:
+        """
+        沿对话树的实际回复链将消息按message.id分组聚合
+        同一回复链上连续的同一message.id记录合并为一条消息；分叉（编辑重发、重新生成）时
+        各分支依次输出，分支的第一条消息带有 branch 信息（index/count/current）。
+        keep_raw 为True时每条消息的 raw 引用其第一条原始记录（默认不保留）
         返回聚合后的消息列表
         """
-        grouped = {}
-        user_messages = []
-
-        for msg in self.messages:
-            msg_type = msg.get('type')
-            timestamp = msg.get('timestamp', '')
-
-            if msg_type == 'user':
-                # 用户消息（非tool_result）
-                content = msg.get('message', {}).get('content', [])
-                user_content = [c for c in content if c.get('type') != 'tool_result']
-                if user_content:
-                    user_messages.append({
-                        'role': 'user',
-                        'timestamp': timestamp,
-                        'content': user_content,
-                        'raw': msg
-                    })
-
-            elif msg_type == 'assistant':
-                message = msg.get('message', {})
-                msg_id = message.get('id')
-
-                if msg_id:
-                    if msg_id not in grouped:
-                        grouped[msg_id] = {
-                            'role': 'assistant',
-                            'id': msg_id,
-                            'timestamp': timestamp,
-                            'content': [],
-                            'usage': message.get('usage', {}),
-                            'raw': msg
-                        }
-
-                    # 添加内容到该消息
-                    content = message.get('content', [])
-                    grouped[msg_id]['content'].extend(content)
-
-        # 按时间排序并合并用户和助手消息
-        all_messages = list(grouped.values()) + user_messages
-        all_messages.sort(key=lambda x: x.get('timestamp', ''))
+        records = self.messages
+        roots, first_child, forks, parents = self._conversation_tree()
+
+        visible = last = None
+        if forks:
+            # 逆序一次遍历：子树是否包含消息、子树中最后一条记录的位置（用于判断当前分支）
+            visible = [self._is_turn(record) for record in records]
+            last = list(range(len(records)))
+            for i in range(len(records) - 1, -1, -1):
+                parent = parents[i]
+                if parent is not None:
+                    visible[parent] = visible[parent] or visible[i]
+                    if last[i] > last[parent]:
+                        last[parent] = last[i]
+
+        all_messages = []
+        pending_branch = None
+        # 栈元素: (记录下标, 分支信息, 当前回复链上正在聚合的助手消息)；单链部分直接沿first_child前进
+        stack = [(root, None, None) for root in reversed(roots)]
+
+        while stack:
+            i, branch, group = stack.pop()
+            if branch is not None:
+                pending_branch = branch
+
+            while i is not None:
+                msg = records[i]
+                msg_type = msg.get('type')
+                entry = None
+
+                if msg_type == 'user':
+                    # 用户消息（非tool_result）
+                    content = msg.get('message', {}).get('content', [])
+                    user_content = [c for c in content if c.get('type') != 'tool_result']
+                    if user_content:
+                        entry = Message('user', msg.get('timestamp', ''), raw=msg if keep_raw else None)
+                        entry.add_content(user_content)
+                        group = None
+
+                elif msg_type == 'assistant':
+                    message = msg.get('message', {})
+                    msg_id = message.get('id')
+
+                    if msg_id:
+                        if group is None or group.id != msg_id:
+                            group = entry = Message('assistant', msg.get('timestamp', ''), msg_id,
+                                                    message.get('usage', {}), msg if keep_raw else None)
+
+                        # 添加内容到该消息
+                        group.add_content(message.get('content', []))
+
+                if entry is not None:
+                    if pending_branch is not None:
+                        entry.branch = pending_branch
+                        pending_branch = None
+                    all_messages.append(entry)
+
+                if i in forks:
+                    ordered = self._ordered_children(i, forks[i], visible, last)
+                    for child, child_branch in reversed(ordered):
+                        stack.append((child, child_branch, group))
+                    break
+                i = first_child[i]
 
         return all_messages
 
+    @staticmethod
+    def branch_label(branch: Dict[str, Any]) -> str:
+        """分支标记文字"""
+        state = '当前分支' if branch.get('current') else '未继续的分支'
+        return f"🔀 对话分支 {branch['index']}/{branch['count']}（{state}）"
+
+    def iter_message_range(self, start: Optional[int] = None, stop: Optional[int] = None,
+                           index: Optional[SessionLineIndex] = None) -> Iterator[Message]:
+        """
+        只解码第 start 到 stop-1 条消息（按文件顺序编号，同 --stream 的输出，支持负数）
+        通过行偏移索引定位消息所在的行；范围之后的行只在仍有工具调用等待结果时读取，且只读取含tool_result的行
+        """
+        index = index or SessionLineIndex.load(self.jsonl_file)
+        stitch = self.stitch_subagents and not self.is_sidechain
+        starts = index.message_starts(stitch)
+        start, stop, _ = slice(start, stop).indices(len(starts))
+        if start >= stop:
+            return
+
+        first_line = starts[start]
+        last_line = starts[stop] if stop < len(starts) else len(index)
+        grouper = StreamingGrouper(self.tool_results)
+        for _, obj in index.iter_records(range(first_line, last_line)):
+            if not self._route_streamed_record(obj):
+                yield from grouper.feed(obj)
+
+        # 范围之后的sidechain记录可能属于范围内仍在等待结果的Task调用
+        result_kinds = (index.KIND_USER, index.KIND_TOOL_RESULT)
+        result_lines = (i for i in range(last_line, len(index))
+                        if (stitch and index.kinds[i] & index.SIDECHAIN)
+                        or index.kinds[i] & ~index.SIDECHAIN in result_kinds)
+        records = index.iter_records(result_lines)
+        for _, obj in records:
+            if not grouper.waiting:
+                break
+            if self._route_streamed_record(obj):
+                continue
+            # 只取其中的tool_result，范围之后的用户输入本身不输出
+            content = [c for c in obj['message'].get('content', []) if c.get('type') == 'tool_result']
+            yield from grouper.feed({'type': 'user', 'timestamp': obj.get('timestamp'), 'message': {'content': content}})
+        records.close()
+        yield from grouper.flush()
+
+    def iter_grouped_messages(self) -> Iterator[Message]:
+        """
+        流式地产出聚合后的消息（按文件顺序）
+        不保留原始记录，tool_result在所属消息渲染后即被释放
+        """
+        grouper = StreamingGrouper(self.tool_results)
+        for obj in self._iter_records():
+            if self._route_streamed_record(obj):
+                continue
+            yield from grouper.feed(obj)
+            self._release_sidechains(grouper)
+        yield from grouper.flush()
+
+    def _route_streamed_record(self, obj: Dict[str, Any]) -> bool:
+        """
+        流式读取（--stream/--tail/--range）时同 _load_record 处理内联的sidechain记录：单独保存，返回True（不参与分组）
+        含Task调用的记录按uuid索引，供定位子代理时匹配sidechain根记录的parentUuid；其余记录不保留
+        """
+        if not self.stitch_subagents or self.is_sidechain:
+            return False
+        if obj.get('isSidechain'):
+            self.sidechain_records.append(obj)
+            if self._subagent_resolver is not None:
+                self._subagent_resolver.candidates = None  # 有新的sidechain记录，下次定位时重建候选
+            return True
+        if obj.get('type') == 'assistant' and obj.get('uuid'):
+            content = (obj.get('message') or {}).get('content')
+            if isinstance(content, list) and any(
+                    isinstance(c, dict) and c.get('name') in SubagentResolver.TASK_TOOLS for c in content):
+                self.records_by_uuid[obj['uuid']] = obj
+        return False
+
+    def _release_sidechains(self, grouper: StreamingGrouper) -> None:
+        """没有未产出的消息时，之前的Task调用都已渲染，释放保存的sidechain记录"""
+        if grouper.idle and (self.sidechain_records or self.records_by_uuid):
+            self.sidechain_records.clear()
+            self.records_by_uuid.clear()
+            if self._subagent_resolver is not None:
+                self._subagent_resolver.candidates = None
+
     def format_thinking(self, thinking_text: str) -> str:
         """格式化thinking内容"""
         lines = thinking_text.split('\n')
@@ -122,11 +2171,11 @@ class ChatRestorer:
                 formatted.append(f"  {line}")
         return '\n'.join(formatted)
 
-    def format_tool_use(self, tool: Dict[str, Any]) -> str:
+    def format_tool_use(self, tool: ToolCall) -> str:
         """格式化tool_use内容"""
-        tool_name = tool.get('name', 'Unknown')
-        tool_id = tool.get('id', '')
-        tool_input = tool.get('input', {})
+        tool_name = tool.name
+        tool_id = tool.id
+        tool_input = tool.input
 
         # 格式化输入参数
         params = []
@@ -148,28 +2197,34 @@ class ChatRestorer:
         tool_result = self.tool_results.get(tool_id)
         if tool_result:
             result.append("\n  📤 工具结果:")
-            content = tool_result['content']
             # 如果内容太长，截断显示
-            if len(content) > 500:
-                lines = content.split('\n')
-                if len(lines) > 20:
-                    preview = '\n'.join(lines[:20])
-                    result.append(f"    {preview}")
-                    result.append(f"    ... (还有 {len(lines) - 20} 行)")
-                else:
-                    result.append(f"    {content[:500]}...")
+            content, truncated = preview_content(tool_result.content, 500, 20)
+            if truncated is True:
+                result.append(f"    {content}...")
+            elif truncated:
+                result.append(f"    {content}")
+                result.append(f"    ... (还有 {truncated} 行)")
             else:
                 # 添加缩进
                 for line in content.split('\n'):
                     result.append(f"    {line}")
 
+        # 嵌入子代理会话
+        nested, messages = self.subagent_messages(tool)
+        if messages:
+            result.append(f"\n  🧩 子代理会话（{len(messages)} 条消息）:")
+            for msg in messages:
+                for line in nested.format_message(msg).split('\n'):
+                    result.append(f"    {line}")
+            result.append("  🧩 子代理会话结束")
+
         return '\n'.join(result)
 
-    def format_message(self, msg: Dict[str, Any]) -> str:
+    def format_message(self, msg: Message) -> str:
         """格式化单条消息"""
-        role = msg.get('role', 'unknown')
-        timestamp = msg.get('timestamp', '')
-        content = msg.get('content', [])
+        role = msg.role
+        timestamp = msg.timestamp
+        content = msg.content
 
         # 格式化时间戳
         try:
@@ -180,15 +2235,18 @@ class ChatRestorer:
 
         lines = []
 
+        if msg.branch:
+            lines.append(self.branch_label(msg.branch))
+
         if role == 'user':
             lines.append("=" * 80)
             lines.append(f"👤 用户 [{time_str}]")
             lines.append("=" * 80)
 
             for item in content:
-                item_type = item.get('type')
+                item_type = item.type
                 if item_type == 'text':
-                    text = item.get('text', '')
+                    text = item.text
                     # 处理特殊标记
                     if '<ide_opened_file>' in text:
                         lines.append("📂 " + text.replace('<ide_opened_file>', '').replace('</ide_opened_file>', '').strip())
@@ -200,7 +2258,7 @@ class ChatRestorer:
             lines.append(f"🤖 Claude [{time_str}]")
 
             # 显示token使用情况
-            usage = msg.get('usage', {})
+            usage = msg.usage
             if usage:
                 input_tokens = usage.get('input_tokens', 0)
                 output_tokens = usage.get('output_tokens', 0)
@@ -211,19 +2269,19 @@ class ChatRestorer:
 
             # 按顺序处理内容
             for item in content:
-                item_type = item.get('type')
+                item_type = item.type
 
                 if item_type == 'thinking':
                     lines.append("\n💭 思考过程:")
                     lines.append("-" * 80)
-                    thinking_text = item.get('thinking', '')
+                    thinking_text = item.text
                     lines.append(self.format_thinking(thinking_text))
                     lines.append("-" * 80)
 
                 elif item_type == 'text':
                     lines.append("\n💬 回复:")
                     lines.append("-" * 80)
-                    lines.append(item.get('text', ''))
+                    lines.append(item.text)
                     lines.append("-" * 80)
 
                 elif item_type == 'tool_use':
@@ -236,11 +2294,11 @@ class ChatRestorer:
         # 保留原始的markdown格式
         return thinking_text
 
-    def format_tool_use_markdown(self, tool: Dict[str, Any]) -> str:
+    def format_tool_use_markdown(self, tool: ToolCall) -> str:
         """格式化tool_use内容为Markdown"""
-        tool_name = tool.get('name', 'Unknown')
-        tool_id = tool.get('id', '')
-        tool_input = tool.get('input', {})
+        tool_name = tool.name
+        tool_id = tool.id
+        tool_input = tool.input
 
         result = [
             f"#### 🔧 工具调用: `{tool_name}`",
@@ -262,22 +2320,19 @@ class ChatRestorer:
         if tool_result:
             result.append("#### 📤 工具结果:")
             result.append("")
-            content = tool_result['content']
 
             # 如果内容太长，截断显示
-            if len(content) > 1000:
-                lines = content.split('\n')
-                if len(lines) > 30:
-                    preview = '\n'.join(lines[:30])
-                    result.append("```")
-                    result.append(preview)
-                    result.append("```")
-                    result.append(f"")
-                    result.append(f"*... (还有 {len(lines) - 30} 行)*")
-                else:
-                    result.append("```")
-                    result.append(content[:1000] + "...")
-                    result.append("```")
+            content, truncated = preview_content(tool_result.content, 1000, 30)
+            if truncated is True:
+                result.append("```")
+                result.append(content + "...")
+                result.append("```")
+            elif truncated:
+                result.append("```")
+                result.append(content)
+                result.append("```")
+                result.append(f"")
+                result.append(f"*... (还有 {truncated} 行)*")
             else:
                 # 保留markdown格式
                 # 检查是否已经是代码块
@@ -289,13 +2344,27 @@ class ChatRestorer:
                     result.append("```")
             result.append("")
 
+        # 嵌入子代理会话
+        nested, messages = self.subagent_messages(tool)
+        if messages:
+            result.append("#### 🧩 子代理会话")
+            result.append("")
+            result.append("<details>")
+            result.append(f"<summary>展开子代理会话（{len(messages)} 条消息）</summary>")
+            result.append("")
+            for msg in messages:
+                result.append(nested.format_message_markdown(msg))
+                result.append("")
+            result.append("</details>")
+            result.append("")
+
         return '\n'.join(result)
 
-    def format_message_markdown(self, msg: Dict[str, Any]) -> str:
+    def format_message_markdown(self, msg: Message) -> str:
         """格式化单条消息为Markdown"""
-        role = msg.get('role', 'unknown')
-        timestamp = msg.get('timestamp', '')
-        content = msg.get('content', [])
+        role = msg.role
+        timestamp = msg.timestamp
+        content = msg.content
 
         # 格式化时间戳
         try:
@@ -306,6 +2375,10 @@ class ChatRestorer:
 
         lines = []
 
+        if msg.branch:
+            lines.append(f"> **{self.branch_label(msg.branch)}**")
+            lines.append("")
+
         if role == 'user':
             lines.append("---")
             lines.append("")
@@ -313,9 +2386,9 @@ class ChatRestorer:
             lines.append("")
 
             for item in content:
-                item_type = item.get('type')
+                item_type = item.type
                 if item_type == 'text':
-                    text = item.get('text', '')
+                    text = item.text
                     # 处理特殊标记
                     if '<ide_opened_file>' in text:
                         file_path = text.replace('<ide_opened_file>', '').replace('</ide_opened_file>', '').strip()
@@ -332,7 +2405,7 @@ class ChatRestorer:
             lines.append("")
 
             # 显示token使用情况
-            usage = msg.get('usage', {})
+            usage = msg.usage
             if usage:
                 input_tokens = usage.get('input_tokens', 0)
                 output_tokens = usage.get('output_tokens', 0)
@@ -342,7 +2415,7 @@ class ChatRestorer:
 
             # 按顺序处理内容
             for item in content:
-                item_type = item.get('type')
+                item_type = item.type
 
                 if item_type == 'thinking':
                     lines.append("### 💭 思考过程")
@@ -350,7 +2423,7 @@ class ChatRestorer:
                     lines.append("<details>")
                     lines.append("<summary>展开思考过程</summary>")
                     lines.append("")
-                    thinking_text = item.get('thinking', '')
+                    thinking_text = item.text
                     lines.append("```")
                     lines.append(self.format_thinking_markdown(thinking_text))
                     lines.append("```")
@@ -362,7 +2435,7 @@ class ChatRestorer:
                     lines.append("### 💬 回复")
                     lines.append("")
                     # 保留原始的markdown格式
-                    lines.append(item.get('text', ''))
+                    lines.append(item.text)
                     lines.append("")
 
                 elif item_type == 'tool_use':
@@ -382,38 +2455,230 @@ class ChatRestorer:
         else:
             return self._restore_text(grouped_messages)
 
-    def _restore_text(self, grouped_messages: List[Dict[str, Any]]) -> str:
-        """以文本格式还原会话"""
-        output = []
-        output.append("╔" + "═" * 78 + "╗")
-        output.append("║" + " " * 20 + "Claude Code 会话还原" + " " * 38 + "║")
-        output.append("╚" + "═" * 78 + "╝")
-        output.append("")
+    def open_output(self, output_file: Any) -> TextIO:
+        """打开输出文件（按 compress 压缩时实际写入 <output_file>.gz / .zst）"""
+        return open_output(output_file, self.compress)
+
+    def write_document(self, output_file: str) -> None:
+        """
+        还原完整会话并写入文件：文档片段经缓冲边渲染边写出，不在内存中拼接整个文档（内容与 restore() 相同）
+        parquet / arrow 格式写出表格（见 write_table）
+        """
+        self.load_data()
+        if self.output_format in TABLE_FORMATS:
+            self.write_table(output_file, self.group_messages(keep_raw=True))
+        else:
+            self.write_messages(output_file, self.group_messages())
+
+    @profiled('render')
+    def write_messages(self, output_file: str, grouped_messages: Iterable[Message]) -> None:
+        """把聚合后的消息（列表或生成器）写为完整文档"""
+        with self.open_output(output_file) as f:
+            write_parts(f, self.iter_document_parts(grouped_messages))
+
+    def restore_to_file(self, output_file: str) -> None:
+        """
+        流式还原会话并直接写入文件
+        逐条读取、聚合、渲染，峰值内存只取决于单条消息的大小
+        """
+        self.write_messages(output_file, self.iter_grouped_messages())
+
+    def write_outputs(self, outputs: Dict[str, str], stream: bool = False) -> None:
+        """
+        一次解析写出多种格式: outputs 为 {输出格式: 输出文件}
+        每条聚合消息依次渲染为各个格式后再处理下一条（子代理会话也只解析一次），
+        stream 时与 restore_to_file 一样边读边写；各文件内容与单独导出该格式完全一致
+        """
+        output_format = self.output_format
+        files = {}
+        self._subagent_cache = {}
+        try:
+            for fmt, output_file in outputs.items():
+                files[fmt] = self.open_output(output_file)
+            if stream:
+                grouped_messages = self.iter_grouped_messages()
+            else:
+                self.load_data()
+                grouped_messages = self.group_messages()
+
+            for fmt, f in files.items():
+                self.output_format = fmt
+                write_parts(f, self._document_head())
+            profiler = self.profiler
+            for msg in grouped_messages:
+                for fmt, f in files.items():
+                    self.output_format = fmt
+                    span = NULL_SPAN if profiler is None else profiler.span(self.jsonl_file, f'render_{fmt}', False)
+                    with span:
+                        for part in self._format_entry(msg):
+                            f.write('\n')
+                            f.write(part)
+                self._subagent_cache.clear()
+            for fmt, f in files.items():
+                self.output_format = fmt
+                for part in self._document_tail():
+                    f.write('\n')
+                    f.write(part)
+        finally:
+            self.output_format = output_format
+            self._subagent_cache = None
+            for f in files.values():
+                f.close()
+
+    @profiled('render')
+    def restore_incremental(self, output_file: str, state_file: Optional[str] = None) -> int:
+        """
+        增量刷新导出文件：只解析会话文件新追加的部分
+        已完整的消息直接追加到输出文件；仍在进行中的消息和文档尾部每次重写。
+        续读状态保存在 <output_file>.tailstate.json，状态无效时自动全量重建。
+        返回本次新增的完整消息数
+        """
+        state_path = Path(state_file or f"{output_file}.tailstate.json")
+        tail = SessionTail(self.jsonl_file)
+        self.tool_results = tail.tool_results
+
+        state = None
+        try:
+            with open(state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            if (state.get('version') != __version__
+                    or state.get('format') != self.output_format
+                    or os.path.getsize(output_file) != state.get('output_size')):
+                state = None
+        except (OSError, ValueError):
+            state = None
+
+        if state is not None:
+            tail.load_state(state['tail'])
+            if not tail.is_resumable():
+                tail = SessionTail(self.jsonl_file)
+                self.tool_results = tail.tool_results
+                state = None
+        if state is not None:
+            # 上次刷新时仍在进行中的Task调用所需的sidechain记录
+            self.sidechain_records.extend(state.get('sidechain', []))
+            self.records_by_uuid.update((record['uuid'], record) for record in state.get('task_records', []))
+
+        new_count = 0
+        if state is None:
+            f = open(output_file, 'wb')
+            f.write('\n'.join(self._document_head()).encode('utf-8'))
+        else:
+            f = open(output_file, 'r+b')
+            f.seek(state['committed_size'])
+            f.truncate()
+
+        with f:
+            # 已完整的消息：追加后不再改写
+            for msg in tail.iter_new_messages(self._route_streamed_record):
+                for part in self._format_entry(msg):
+                    f.write(('\n' + part).encode('utf-8'))
+                new_count += 1
+            committed_size = f.tell()
+
+            # 进行中的消息和文档尾部：下次刷新时截断重写
+            for msg in tail.grouper.open_messages():
+                for part in self._format_entry(msg):
+                    f.write(('\n' + part).encode('utf-8'))
+            f.write(('\n' + '\n'.join(self._document_tail())).encode('utf-8'))
+            output_size = f.tell()
+        self._release_sidechains(tail.grouper)
+
+        tmp_path = state_path.with_name(state_path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as sf:
+            json.dump({
+                'version': __version__,
+                'format': self.output_format,
+                'committed_size': committed_size,
+                'output_size': output_size,
+                'tail': tail.to_state(),
+                'sidechain': self.sidechain_records,
+                'task_records': list(self.records_by_uuid.values()),
+            }, sf, ensure_ascii=False)
+        os.replace(tmp_path, state_path)
+
+        return new_count
+
+    def iter_document_parts(self, grouped_messages: Iterable[Message]) -> Iterator[str]:
+        """
+        按输出格式产出文档片段，片段之间以换行连接
+        grouped_messages 可以是列表，也可以是 iter_grouped_messages() 的生成器
+        """
+        yield from self._document_head()
+        for msg in grouped_messages:
+            yield from self._format_entry(msg)
+        yield from self._document_tail()
+
+    def _document_head(self) -> List[str]:
+        if self.output_format == 'markdown':
+            return self._markdown_head()
+        elif self.output_format == 'html':
+            return self._html_head()
+        return self._text_head()
+
+    def _document_tail(self) -> List[str]:
+        if self.output_format == 'markdown':
+            return self._markdown_tail()
+        elif self.output_format == 'html':
+            return self._html_tail()
+        return self._text_tail()
+
+    def _format_entry(self, msg: Message) -> List[str]:
+        if self.output_format == 'markdown':
+            return self._format_entry_markdown(msg)
+        elif self.output_format == 'html':
+            return self._format_entry_html(msg)
+        return self._format_entry_text(msg)
+
+    def _text_head(self) -> List[str]:
+        """文本格式的文档头部"""
+        return [
+            "╔" + "═" * 78 + "╗",
+            "║" + " " * 20 + "Claude Code 会话还原" + " " * 38 + "║",
+            "╚" + "═" * 78 + "╝",
+            "",
+        ]
+
+    def _text_tail(self) -> List[str]:
+        """文本格式的文档尾部"""
+        return [
+            "\n",
+            "╔" + "═" * 78 + "╗",
+            "║" + " " * 30 + "会话结束" + " " * 38 + "║",
+            "╚" + "═" * 78 + "╝",
+        ]
 
-        for i, msg in enumerate(grouped_messages, 1):
-            output.append(self.format_message(msg))
-            output.append("")  # 空行分隔
+    def _format_entry_text(self, msg: Message) -> List[str]:
+        return [self.format_message(msg), ""]  # 空行分隔
 
-        output.append("\n")
-        output.append("╔" + "═" * 78 + "╗")
-        output.append("║" + " " * 30 + "会话结束" + " " * 38 + "║")
-        output.append("╚" + "═" * 78 + "╝")
+    @profiled('render')
+    def _restore_text(self, grouped_messages: List[Message]) -> str:
+        """以文本格式还原会话"""
+        output = self._text_head()
+        for msg in grouped_messages:
+            output.extend(self._format_entry_text(msg))
+        output.extend(self._text_tail())
 
         return '\n'.join(output)
 
-    def _restore_markdown(self, grouped_messages: List[Dict[str, Any]]) -> str:
-        """以Markdown格式还原会话"""
-        output = []
-        output.append("# Claude Code 会话还原")
-        output.append("")
+    def _markdown_head(self) -> List[str]:
+        """Markdown格式的文档头部"""
+        return ["# Claude Code 会话还原", ""]
+
+    def _markdown_tail(self) -> List[str]:
+        """Markdown格式的文档尾部"""
+        return ["---", "", "**会话结束**"]
 
-        for i, msg in enumerate(grouped_messages, 1):
-            output.append(self.format_message_markdown(msg))
-            output.append("")  # 空行分隔
+    def _format_entry_markdown(self, msg: Message) -> List[str]:
+        return [self.format_message_markdown(msg), ""]  # 空行分隔
 
-        output.append("---")
-        output.append("")
-        output.append("**会话结束**")
+    @profiled('render')
+    def _restore_markdown(self, grouped_messages: List[Message]) -> str:
+        """以Markdown格式还原会话"""
+        output = self._markdown_head()
+        for msg in grouped_messages:
+            output.extend(self._format_entry_markdown(msg))
+        output.extend(self._markdown_tail())
 
         return '\n'.join(output)
 
@@ -760,11 +3025,72 @@ class ChatRestorer:
                 font-size: 12px;
             }
 
-            .user-message .message-header {
-                border-bottom-color: #4a90e2;
+            .branch-marker {
+                margin: 24px 0 8px;
+                padding: 8px 16px;
+                border-left: 4px solid #9f7aea;
+                background: #2d2640;
+                color: #d6bcfa;
+                font-weight: 600;
+                border-radius: 6px;
             }
 
-            .assistant-message .message-header {
+            .branch-marker.abandoned {
+                opacity: 0.7;
+            }
+
+            .subagent-section {
+                background: #2f2a24;
+                border-left: 4px solid #ed8936;
+                padding: 12px 16px;
+                margin-top: 12px;
+                border-radius: 6px;
+            }
+
+            .subagent-header {
+                color: #f6ad55;
+                font-weight: 600;
+                cursor: pointer;
+                user-select: none;
+                display: flex;
+                align-items: center;
+                gap: 8px;
+            }
+
+            .subagent-messages {
+                margin-top: 12px;
+            }
+
+            .subagent-section.collapsed .subagent-messages {
+                display: none;
+            }
+
+            .page-nav {
+                display: flex;
+                justify-content: space-between;
+                align-items: center;
+                padding: 12px 16px;
+                margin: 8px 0;
+                background: #3a3a3a;
+                border-radius: 6px;
+                color: #aaa;
+                font-size: 14px;
+            }
+
+            .page-nav a {
+                color: #90cdf4;
+                text-decoration: none;
+            }
+
+            .page-nav .disabled {
+                color: #666;
+            }
+
+            .user-message .message-header {
+                border-bottom-color: #4a90e2;
+            }
+
+            .assistant-message .message-header {
                 border-bottom-color: #764ba2;
             }
 
@@ -821,11 +3147,11 @@ class ChatRestorer:
         </style>
         """
 
-    def format_tool_use_html(self, tool: Dict[str, Any]) -> str:
+    def format_tool_use_html(self, tool: ToolCall) -> str:
         """格式化tool_use内容为HTML"""
-        tool_name = html_module.escape(tool.get('name', 'Unknown'))
-        tool_id = html_module.escape(tool.get('id', ''))
-        tool_input = tool.get('input', {})
+        tool_name = html_module.escape(tool.name)
+        tool_id = html_module.escape(tool.id)
+        tool_input = tool.input
 
         html_parts = []
         html_parts.append('<div class="tool-section">')
@@ -841,43 +3167,49 @@ class ChatRestorer:
             html_parts.append(f'  <div class="tool-params">{params_json}</div>')
 
         # 查找对应的tool_result
-        tool_result = self.tool_results.get(tool.get('id'))
+        tool_result = self.tool_results.get(tool.id)
         if tool_result:
             html_parts.append(f'  <div class="tool-result">')
             html_parts.append(f'    <div class="tool-result-header">📤 工具结果</div>')
 
-            content = tool_result['content']
-            truncated = False
-
             # 如果内容太长，截断显示
-            if len(content) > 1000:
-                lines = content.split('\n')
-                if len(lines) > 30:
-                    content = '\n'.join(lines[:30])
-                    truncated = len(lines) - 30
-                else:
-                    content = content[:1000]
-                    truncated = True
+            content, truncated = preview_content(tool_result.content, 1000, 30)
 
             escaped_content = html_module.escape(content)
             html_parts.append(f'    <div class="tool-result-content">{escaped_content}</div>')
 
             if truncated:
-                if isinstance(truncated, int):
-                    html_parts.append(f'    <div class="truncated-notice">... (还有 {truncated} 行)</div>')
-                else:
+                if truncated is True:
                     html_parts.append(f'    <div class="truncated-notice">... (内容已截断)</div>')
+                else:
+                    html_parts.append(f'    <div class="truncated-notice">... (还有 {truncated} 行)</div>')
 
             html_parts.append(f'  </div>')
 
+        # 嵌入子代理会话（默认折叠）
+        nested, messages = self.subagent_messages(tool)
+        if messages:
+            # 预渲染的页面不依赖JavaScript，子代理会话默认展开
+            collapsed = '' if self.prerender else ' collapsed'
+            html_parts.append(f'  <div class="subagent-section{collapsed}">')
+            html_parts.append(f'    <div class="subagent-header" onclick="this.parentElement.classList.toggle(\'collapsed\');">')
+            html_parts.append(f'      <span class="collapse-icon">▼</span>')
+            html_parts.append(f'      <span>🧩 子代理会话（{len(messages)} 条消息）</span>')
+            html_parts.append(f'    </div>')
+            html_parts.append(f'    <div class="subagent-messages">')
+            for msg in messages:
+                html_parts.append(nested.format_message_html(msg))
+            html_parts.append(f'    </div>')
+            html_parts.append(f'  </div>')
+
         html_parts.append('</div>')
         return '\n'.join(html_parts)
 
-    def format_message_html(self, msg: Dict[str, Any]) -> str:
+    def format_message_html(self, msg: Message) -> str:
         """格式化单条消息为HTML"""
-        role = msg.get('role', 'unknown')
-        timestamp = msg.get('timestamp', '')
-        content = msg.get('content', [])
+        role = msg.role
+        timestamp = msg.timestamp
+        content = msg.content
 
         # 格式化时间戳
         try:
@@ -888,6 +3220,10 @@ class ChatRestorer:
 
         html_parts = []
 
+        if msg.branch:
+            branch_class = 'current' if msg.branch.get('current') else 'abandoned'
+            html_parts.append(f'<div class="branch-marker {branch_class}">{self.branch_label(msg.branch)}</div>')
+
         if role == 'user':
             icon = '👤'
             role_text = '用户'
@@ -906,7 +3242,7 @@ class ChatRestorer:
 
         # 显示token使用情况（仅助手消息）
         if role == 'assistant':
-            usage = msg.get('usage', {})
+            usage = msg.usage
             if usage:
                 input_tokens = usage.get('input_tokens', 0)
                 output_tokens = usage.get('output_tokens', 0)
@@ -923,10 +3259,10 @@ class ChatRestorer:
 
         # 处理消息内容
         for item in content:
-            item_type = item.get('type')
+            item_type = item.type
 
             if item_type == 'thinking':
-                thinking_text = html_module.escape(item.get('thinking', ''))
+                thinking_text = html_module.escape(item.text)
                 html_parts.append(f'    <div class="thinking-section">')
                 html_parts.append(f'      <div class="thinking-header" onclick="event.stopPropagation(); this.parentElement.classList.toggle(\'collapsed\'); this.nextElementSibling.classList.toggle(\'hidden\');">')
                 html_parts.append(f'        <span class="collapse-icon">▼</span>')
@@ -936,11 +3272,15 @@ class ChatRestorer:
                 html_parts.append(f'    </div>')
 
             elif item_type == 'text':
-                text = item.get('text', '')
+                text = item.text
                 # 处理特殊标记
                 if '<ide_opened_file>' in text:
                     file_path = text.replace('<ide_opened_file>', '').replace('</ide_opened_file>', '').strip()
                     html_parts.append(f'    <div class="text-section">📂 <strong>打开文件:</strong> <code>{html_module.escape(file_path)}</code></div>')
+                elif self.prerender:
+                    # 导出时渲染为HTML（按文本哈希缓存），页面无需JavaScript
+                    highlight = ' highlight' if role == 'assistant' else ''
+                    html_parts.append(f'    <div class="text-section{highlight}">{MARKDOWN_RENDERER.render(text)}</div>')
                 else:
                     # 保留原始markdown文本，由客户端JavaScript渲染
                     # 使用data-markdown属性存储原始文本，避免HTML转义问题
@@ -959,8 +3299,8 @@ class ChatRestorer:
 
         return '\n'.join(html_parts)
 
-    def _restore_html(self, grouped_messages: List[Dict[str, Any]]) -> str:
-        """以HTML格式还原会话"""
+    def _html_head(self) -> List[str]:
+        """HTML格式的文档头部（含样式）"""
         html_parts = []
 
         # HTML头部
@@ -970,9 +3310,22 @@ class ChatRestorer:
         html_parts.append('  <meta charset="UTF-8">')
         html_parts.append('  <meta name="viewport" content="width=device-width, initial-scale=1.0">')
         html_parts.append('  <title>Claude Code 会话还原</title>')
-        html_parts.append('  <!-- Highlight.js for syntax highlighting -->')
-        html_parts.append('  <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.9.0/styles/github-dark.min.css">')
-        html_parts.append(self._get_html_css())
+        if self.assets_dir:
+            # 共享资源模式：样式在资源目录中，所有页面共用同一份并由浏览器缓存
+            assets = self._shared_assets()
+            if not self.prerender:
+                html_parts.append(f'  <link rel="stylesheet" href="{assets["github-dark.min.css"]}">')
+            html_parts.append(f'  <link rel="stylesheet" href="{assets["restore_chat.css"]}">')
+        else:
+            if self.prerender:
+                # Markdown已在导出时渲染，代码高亮（如有）使用 pygments 的样式
+                style_defs = MARKDOWN_RENDERER.style_defs()
+                if style_defs:
+                    html_parts.append(f'  <style>\n{style_defs}\n  </style>')
+            else:
+                html_parts.append('  <!-- Highlight.js for syntax highlighting -->')
+                html_parts.append(f'  <link rel="stylesheet" href="{VENDOR_ASSETS["github-dark.min.css"]}">')
+            html_parts.append(self._get_html_css())
         html_parts.append('</head>')
         html_parts.append('<body>')
         html_parts.append('  <div class="container">')
@@ -982,65 +3335,341 @@ class ChatRestorer:
         html_parts.append('    </div>')
         html_parts.append('    <div class="messages">')
 
-        # 添加所有消息
-        for msg in grouped_messages:
-            html_parts.append(self.format_message_html(msg))
+        return html_parts
 
+    def _html_tail(self) -> List[str]:
+        """HTML格式的文档尾部（含Markdown渲染脚本）"""
+        html_parts = []
         html_parts.append('    </div>')
         html_parts.append('    <div class="footer">')
         html_parts.append('      <p>会话结束</p>')
         html_parts.append('    </div>')
         html_parts.append('  </div>')
+        if self.prerender:
+            html_parts.append('</body>')
+            html_parts.append('</html>')
+            return html_parts
+
         html_parts.append('')
+        if self.assets_dir:
+            assets = self._shared_assets()
+            for name in ('marked.min.js', 'purify.min.js', 'highlight.min.js'):
+                html_parts.append(f'  <script src="{assets[name]}"></script>')
+            html_parts.append(f'  <script src="{assets["restore_chat.js"]}"></script>')
+            html_parts.append('</body>')
+            html_parts.append('</html>')
+            return html_parts
+
         html_parts.append('  <!-- JavaScript Libraries -->')
         html_parts.append('  <!-- Marked.js for Markdown parsing -->')
-        html_parts.append('  <script src="https://cdn.jsdelivr.net/npm/marked@11.1.1/marked.min.js"></script>')
+        html_parts.append(f'  <script src="{VENDOR_ASSETS["marked.min.js"]}"></script>')
         html_parts.append('  <!-- DOMPurify for XSS protection -->')
-        html_parts.append('  <script src="https://cdn.jsdelivr.net/npm/dompurify@3.0.6/dist/purify.min.js"></script>')
+        html_parts.append(f'  <script src="{VENDOR_ASSETS["purify.min.js"]}"></script>')
         html_parts.append('  <!-- Highlight.js for syntax highlighting -->')
-        html_parts.append('  <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.9.0/highlight.min.js"></script>')
+        html_parts.append(f'  <script src="{VENDOR_ASSETS["highlight.min.js"]}"></script>')
         html_parts.append('')
         html_parts.append('  <script>')
+        html_parts.extend(self._html_script())
+        html_parts.append('  </script>')
+        html_parts.append('</body>')
+        html_parts.append('</html>')
+
+        return html_parts
+
+    def _html_script(self) -> List[str]:
+        """页面脚本：Markdown渲染（滚动到可视区域附近时才渲染）"""
+        html_parts = []
         html_parts.append('    // Configure marked.js to use highlight.js for code blocks')
-        html_parts.append('    marked.setOptions({')
-        html_parts.append('      highlight: function(code, lang) {')
-        html_parts.append('        if (lang && hljs.getLanguage(lang)) {')
-        html_parts.append('          try {')
-        html_parts.append('            return hljs.highlight(code, { language: lang }).value;')
-        html_parts.append('          } catch (err) {')
-        html_parts.append('            console.error("Highlight error:", err);')
+        html_parts.append('    const librariesLoaded = typeof marked !== "undefined" && typeof DOMPurify !== "undefined";')
+        html_parts.append('    if (librariesLoaded) {')
+        html_parts.append('      marked.setOptions({')
+        html_parts.append('        highlight: function(code, lang) {')
+        html_parts.append('          if (typeof hljs === "undefined") {')
+        html_parts.append('            return code;')
         html_parts.append('          }')
-        html_parts.append('        }')
-        html_parts.append('        return hljs.highlightAuto(code).value;')
-        html_parts.append('      },')
-        html_parts.append('      breaks: true,  // Support GFM line breaks')
-        html_parts.append('      gfm: true      // Enable GitHub Flavored Markdown')
-        html_parts.append('    });')
+        html_parts.append('          if (lang && hljs.getLanguage(lang)) {')
+        html_parts.append('            try {')
+        html_parts.append('              return hljs.highlight(code, { language: lang }).value;')
+        html_parts.append('            } catch (err) {')
+        html_parts.append('              console.error("Highlight error:", err);')
+        html_parts.append('            }')
+        html_parts.append('          }')
+        html_parts.append('          return hljs.highlightAuto(code).value;')
+        html_parts.append('        },')
+        html_parts.append('        breaks: true,  // Support GFM line breaks')
+        html_parts.append('        gfm: true      // Enable GitHub Flavored Markdown')
+        html_parts.append('      });')
+        html_parts.append('    }')
+        html_parts.append('')
+        html_parts.append('    function renderMarkdown(element) {')
+        html_parts.append('      const markdownText = element.getAttribute("data-markdown");')
+        html_parts.append('      if (!markdownText) {')
+        html_parts.append('        return;')
+        html_parts.append('      }')
+        html_parts.append('      if (!librariesLoaded) {')
+        html_parts.append('        // Libraries unavailable (e.g. offline): show the plain text')
+        html_parts.append('        element.textContent = markdownText;')
+        html_parts.append('        element.style.whiteSpace = "pre-wrap";')
+        html_parts.append('        return;')
+        html_parts.append('      }')
+        html_parts.append('      // Parse markdown and sanitize HTML')
+        html_parts.append('      const rawHtml = marked.parse(markdownText);')
+        html_parts.append('      const cleanHtml = DOMPurify.sanitize(rawHtml);')
+        html_parts.append('      element.innerHTML = cleanHtml;')
+        html_parts.append('    }')
         html_parts.append('')
-        html_parts.append('    // Render all markdown content')
+        html_parts.append('    // Render markdown lazily as messages scroll into view, so opening a long session')
+        html_parts.append('    // costs the same as opening a short one')
         html_parts.append('    document.addEventListener("DOMContentLoaded", function() {')
         html_parts.append('      const markdownElements = document.querySelectorAll(".markdown-content");')
+        html_parts.append('      if (!("IntersectionObserver" in window)) {')
+        html_parts.append('        markdownElements.forEach(renderMarkdown);')
+        html_parts.append('        return;')
+        html_parts.append('      }')
+        html_parts.append('      const observer = new IntersectionObserver(function(entries) {')
+        html_parts.append('        entries.forEach(function(entry) {')
+        html_parts.append('          if (entry.isIntersecting) {')
+        html_parts.append('            observer.unobserve(entry.target);')
+        html_parts.append('            renderMarkdown(entry.target);')
+        html_parts.append('          }')
+        html_parts.append('        });')
+        html_parts.append('      }, { rootMargin: "1000px 0px" });')
         html_parts.append('      markdownElements.forEach(function(element) {')
-        html_parts.append('        const markdownText = element.getAttribute("data-markdown");')
-        html_parts.append('        if (markdownText) {')
-        html_parts.append('          // Parse markdown and sanitize HTML')
-        html_parts.append('          const rawHtml = marked.parse(markdownText);')
-        html_parts.append('          const cleanHtml = DOMPurify.sanitize(rawHtml);')
-        html_parts.append('          element.innerHTML = cleanHtml;')
-        html_parts.append('        }')
+        html_parts.append('        observer.observe(element);')
         html_parts.append('      });')
         html_parts.append('    });')
-        html_parts.append('  </script>')
-        html_parts.append('</body>')
-        html_parts.append('</html>')
+        return html_parts
+
+    def _shared_assets(self) -> Dict[str, str]:
+        """
+        共享资源模式：写出（每个进程只写一次）样式、页面脚本和 vendor/ 中的第三方库，
+        返回 {资源名: 相对当前输出目录的地址}；vendor/ 中没有的第三方库仍使用CDN地址
+        """
+        key = (str(self.assets_dir), self.prerender)
+        names = _ASSET_BUNDLES.get(key)
+        if names is None:
+            names = {}
+            css = self._get_html_css().split('<style>', 1)[1].rsplit('</style>', 1)[0]
+            if self.prerender:
+                css = MARKDOWN_RENDERER.style_defs() + '\n' + css
+            names['restore_chat.css'] = write_asset(self.assets_dir, 'restore_chat.css', css.encode('utf-8'))
+            if not self.prerender:
+                script = '\n'.join(line[4:] for line in self._html_script()) + '\n'
+                names['restore_chat.js'] = write_asset(self.assets_dir, 'restore_chat.js', script.encode('utf-8'))
+                for name in VENDOR_ASSETS:
+                    if (VENDOR_DIR / name).is_file():
+                        names[name] = write_asset(self.assets_dir, name, (VENDOR_DIR / name).read_bytes())
+            _ASSET_BUNDLES[key] = names
+
+        base = os.path.relpath(self.assets_dir, self.output_dir or Path(self.jsonl_file).parent)
+        urls = dict(VENDOR_ASSETS)
+        urls.update((name, quote(Path(base, file_name).as_posix())) for name, file_name in names.items())
+        return urls
+
+    def _format_entry_html(self, msg: Message) -> List[str]:
+        return [self.format_message_html(msg)]
+
+    @profiled('render')
+    def _restore_html(self, grouped_messages: List[Message]) -> str:
+        """以HTML格式还原会话"""
+        html_parts = self._html_head()
+
+        # 添加所有消息
+        for msg in grouped_messages:
+            html_parts.extend(self._format_entry_html(msg))
+
+        html_parts.extend(self._html_tail())
 
         return '\n'.join(html_parts)
 
+    @staticmethod
+    def page_file(output_file: str, number: int) -> Path:
+        """分页导出时第 number 页的文件路径：第1页即 output_file，之后为 <名称>_p<页码>.html"""
+        path = Path(output_file)
+        if number == 1:
+            return path
+        return path.with_name(f"{path.stem}_p{number}{path.suffix}")
+
+    def _page_nav(self, output_file: str, number: int, total: Optional[int], has_next: bool) -> str:
+        """分页导航条"""
+        if number > 1:
+            prev_link = f'<a href="{html_module.escape(self.page_file(output_file, number - 1).name)}">« 上一页</a>'
+        else:
+            prev_link = '<span class="disabled">« 上一页</span>'
+        if has_next:
+            next_link = f'<a href="{html_module.escape(self.page_file(output_file, number + 1).name)}">下一页 »</a>'
+        else:
+            next_link = '<span class="disabled">下一页 »</span>'
+        position = f'第 {number} 页（共 {total} 页）' if total else f'第 {number} 页'
+        return f'      <nav class="page-nav">{prev_link}<span>{position}</span>{next_link}</nav>'
+
+    def _write_page(self, output_file: str, number: int, total: Optional[int],
+                    entries: List[str], has_next: bool) -> None:
+        nav = self._page_nav(output_file, number, total, has_next)
+        with self.open_output(self.page_file(output_file, number)) as f:
+            write_parts(f, self._html_head() + [nav] + entries + [nav] + self._html_tail())
+
+    @profiled('render')
+    def write_pages(self, output_file: str, grouped_messages: Iterable[Message]) -> int:
+        """
+        分页写出HTML，每页最多 page_size 条消息，页面之间有上一页/下一页导航
+        grouped_messages 可以是生成器（流式、部分导出）：消息到达时立即渲染，只缓存当前页渲染后的片段，
+        此时导航中不显示总页数。上次导出留下的多余页面（包括压缩和未压缩的）会被删除。返回页数
+        """
+        total = None
+        if isinstance(grouped_messages, list):
+            total = max(1, -(-len(grouped_messages) // self.page_size))
 
-def scan_jsonl_files(directory: str) -> List[str]:
+        number = 1
+        count = 0
+        entries = []
+        for msg in grouped_messages:
+            if count == self.page_size:
+                self._write_page(output_file, number, total, entries, has_next=True)
+                number += 1
+                count = 0
+                entries = []
+            entries.extend(self._format_entry_html(msg))
+            count += 1
+        self._write_page(output_file, number, total, entries, has_next=False)
+
+        # 上次导出可能未压缩或用了另一种压缩：已写出的页面删除其他形式的副本，多出的页面各种形式都删除
+        variants = (None, *OUTPUT_COMPRESSION)
+        for page in range(2, number + 1):
+            for compress in variants:
+                if compress != self.compress:
+                    compressed_path(self.page_file(output_file, page), compress).unlink(missing_ok=True)
+        stale = number + 1
+        while True:
+            leftovers = [path for path in (compressed_path(self.page_file(output_file, stale), compress)
+                                           for compress in variants) if path.exists()]
+            if not leftovers:
+                break
+            for path in leftovers:
+                path.unlink()
+            stale += 1
+        return number
+
+    def restore_pages(self, output_file: str, stream: bool = False) -> int:
+        """分页还原会话（stream 时按文件顺序流式渲染），返回页数"""
+        if stream:
+            return self.write_pages(output_file, self.iter_grouped_messages())
+        self.load_data()
+        return self.write_pages(output_file, self.group_messages())
+
+    # ========== 列式导出（parquet / arrow） ==========
+
+    def start_month(self) -> Optional[str]:
+        """会话第一条带时间戳的记录所在的月份（YYYY-MM），用于数据集分区；需先 load_data"""
+        for record in self.messages:
+            if record.get('timestamp'):
+                return record['timestamp'][:7]
+        return None
+
+    def iter_table_rows(self, grouped_messages: Iterable[Message], parent_tool_use_id: Optional[str] = None,
+                        agent_id: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """
+        表格导出的行：每个内容块一行，工具调用行带上参数（JSON）和对应的工具结果
+        消息需由 group_messages(keep_raw=True) 聚合，uuid 等取自消息的第一条记录；
+        usage 只记在每条助手消息的第一行，按列求和即为按 message.id 去重后的用量；
+        子代理的消息紧跟在所属的Task工具调用之后，parent_tool_use_id 为该调用的id，
+        agent_id 为工具结果中记录的agentId（记录中没有agentId时使用）
+        """
+        for index, msg in enumerate(grouped_messages):
+            raw = msg.raw or {}
+            usage = msg.usage or {}
+            base = {
+                'session_id': raw.get('sessionId') or self.session_id,
+                'agent_id': raw.get('agentId') or agent_id,
+                'parent_tool_use_id': parent_tool_use_id,
+                'uuid': raw.get('uuid'),
+                'parent_uuid': raw.get('parentUuid'),
+                'message_id': msg.id,
+                'message_index': index,
+                'role': msg.role,
+                'timestamp': parse_timestamp(msg.timestamp),
+                'model': (raw.get('message') or {}).get('model'),
+                'cwd': raw.get('cwd'),
+            }
+            for block_index, item in enumerate(msg.content):
+                row = dict(base, block_index=block_index, type=item.type)
+                if block_index == 0:
+                    row.update((field, usage.get(field)) for field in USAGE_FIELDS)
+                if item.type != 'tool_use':
+                    row['text'] = item.text
+                    yield row
+                    continue
+
+                tool_result = self.tool_results.get(item.id)
+                row['tool_use_id'] = item.id
+                row['tool_name'] = item.name
+                row['tool_input'] = json.dumps(item.input, ensure_ascii=False)
+                row['tool_result'] = str(tool_result.content) if tool_result is not None else None
+                yield row
+                nested, messages = self.subagent_messages(item, keep_raw=True)
+                if nested is not None:
+                    yield from nested.iter_table_rows(messages, item.id,
+                                                      tool_result.agent_id if tool_result is not None else None)
+
+    @profiled('render')
+    def write_table(self, output_file: str, grouped_messages: Iterable[Message]) -> int:
+        """按 output_format（parquet / arrow）写出表格，每 TABLE_BATCH_ROWS 行写一个批次，返回行数"""
+        schema = table_schema() if pyarrow is not None else None
+        count = 0
+        rows = []
+        with open_table_writer(output_file, self.output_format, schema) as writer:
+            for row in self.iter_table_rows(grouped_messages):
+                rows.append(row)
+                if len(rows) >= TABLE_BATCH_ROWS:
+                    writer.write_table(pyarrow.Table.from_pylist(rows, schema=schema))
+                    count += len(rows)
+                    rows = []
+            if rows:
+                writer.write_table(pyarrow.Table.from_pylist(rows, schema=schema))
+                count += len(rows)
+        return count
+
+
+OUTPUT_DIR_NAME = 'claude_parse'
+ASSETS_DIR_NAME = 'assets'  # HTML共享资源（--shared-assets）所在的子目录
+DATASET_DIR_NAME = 'dataset'  # 批量列式导出（parquet / arrow）的分区数据集所在的子目录
+DEFAULT_INCLUDE = ('*.jsonl', '*.json')
+# 还原时额外包含的压缩会话和tar归档（索引、统计等只扫描 DEFAULT_INCLUDE）
+COMPRESSED_INCLUDE = ('*.jsonl.gz', '*.jsonl.zst', '*.tar', '*.tar.gz', '*.tgz', '*.tar.zst')
+DEFAULT_EXCLUDE = ('agent-*',)  # agent- 前缀的文件是子任务（sidechain）记录
+# 本工具写在会话旁的附属文件（--tail 的续读状态、--stats 的统计结果），不是会话，扫描时总是跳过
+OUTPUT_SIDECAR_PATTERNS = ('*.tailstate.json', '*_stats.json')
+
+
+def compile_patterns(patterns: Iterable[str]) -> Optional[Tuple[Any, Any]]:
     """
-    扫描目录中所有的jsonl文件，排除agent-前缀的文件
-    返回符合条件的文件路径列表
+    将通配符模式编译为 (按文件名匹配, 按相对路径匹配) 两个正则
+    含 '/' 的模式匹配相对于扫描根目录的路径，其余模式只匹配文件名
+    """
+    name_patterns = [fnmatch.translate(p) for p in patterns if p and '/' not in p]
+    path_patterns = [fnmatch.translate(p) for p in patterns if p and '/' in p]
+    if not name_patterns and not path_patterns:
+        return None
+    return (
+        re.compile('|'.join(name_patterns)) if name_patterns else None,
+        re.compile('|'.join(path_patterns)) if path_patterns else None,
+    )
+
+
+def _matches(compiled: Optional[Tuple[Any, Any]], name: str, rel_path: str) -> bool:
+    if compiled is None:
+        return False
+    name_re, path_re = compiled
+    return bool((name_re and name_re.match(name)) or (path_re and path_re.match(rel_path)))
+
+
+def discover_session_files(directory: str, recursive: bool = False,
+                           include: Iterable[str] = DEFAULT_INCLUDE,
+                           exclude: Iterable[str] = DEFAULT_EXCLUDE) -> List[Tuple[str, os.stat_result]]:
+    """
+    用 os.scandir 单次遍历目录（recursive 时包含所有子目录），
+    返回 (文件路径, stat结果) 列表，stat 直接复用 DirEntry 的缓存结果，后续步骤无需再次 stat。
+    exclude 同样作用于子目录名；输出目录 claude_parse 和本工具的附属文件（OUTPUT_SIDECAR_PATTERNS）总是被跳过，空文件被忽略。
     """
     directory_path = Path(directory)
     if not directory_path.exists():
@@ -1049,30 +3678,198 @@ def scan_jsonl_files(directory: str) -> List[str]:
     if not directory_path.is_dir():
         raise NotADirectoryError(f"不是有效的目录: {directory}")
 
-    jsonl_files = []
+    include_re = compile_patterns(include)
+    exclude_re = compile_patterns(exclude)
+    sidecar_re = compile_patterns(OUTPUT_SIDECAR_PATTERNS)
 
-    # 扫描所有.jsonl和.json文件
-    for file_path in directory_path.glob('*.jsonl'):
-        # 排除agent-前缀的文件
-        if not file_path.name.startswith('agent-'):
-            # 检查文件大小，跳过空文件
-            if file_path.stat().st_size > 0:
-                jsonl_files.append(str(file_path))
+    results = []
+    stack = [(str(directory_path), '')]
+    while stack:
+        dir_path, rel_dir = stack.pop()
+        try:
+            entries = os.scandir(dir_path)
+        except OSError as e:
+            print(f"警告: 无法读取目录 {dir_path}: {e}", file=sys.stderr)
+            continue
+
+        with entries:
+            for entry in entries:
+                rel_path = rel_dir + entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if (recursive and entry.name != OUTPUT_DIR_NAME
+                                and not _matches(exclude_re, entry.name, rel_path)):
+                            stack.append((entry.path, rel_path + '/'))
+                        continue
+                    if not entry.is_file():
+                        continue
+                    if (not _matches(include_re, entry.name, rel_path) or _matches(exclude_re, entry.name, rel_path)
+                            or _matches(sidecar_re, entry.name, rel_path)):
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                # 检查文件大小，跳过空文件
+                if st.st_size > 0:
+                    results.append((entry.path, st))
+
+    results.sort(key=lambda item: item[0])
+    skipped = stem_collisions(path for path, _ in results)
+    return [item for item in results if item[0] not in skipped]
+
+
+def scan_jsonl_files(directory: str) -> List[str]:
+    """
+    扫描目录中所有的jsonl文件，排除agent-前缀的文件
+    返回符合条件的文件路径列表
+    """
+    return [path for path, _ in discover_session_files(directory)]
 
-    # 也扫描.json文件（如示例中的bb81858c-f8ba-4a96-8750-79bac1934255.json）
-    for file_path in directory_path.glob('*.json'):
-        if not file_path.name.startswith('agent-'):
-            if file_path.stat().st_size > 0:
-                jsonl_files.append(str(file_path))
 
-    return sorted(jsonl_files)
+def file_digest(file_path: str, chunk_size: int = 1 << 20) -> str:
+    """计算文件内容的BLAKE2b摘要"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
-def process_single_file(input_file: str, output_dir: str, output_format: str) -> dict:
+class BuildManifest:
+    """
+    增量批处理清单
+    记录每个源文件的大小、mtime、内容摘要以及输出格式、渲染选项和工具版本，
+    未变化的会话在下次批处理时直接跳过
+    """
+
+    FILE_NAME = '.restore_manifest.json'
+
+    def __init__(self, output_dir: str, source_dir: str):
+        self.path = Path(output_dir) / self.FILE_NAME
+        self.source_dir = Path(source_dir)
+        self.entries = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if isinstance(data.get('entries'), dict):
+                self.entries = data['entries']
+        except (OSError, ValueError, AttributeError):
+            # 清单不存在或已损坏时视为全部需要重新生成
+            self.entries = {}
+
+    def _key(self, input_file: str, output_format: str) -> str:
+        try:
+            rel_path = Path(input_file).relative_to(self.source_dir).as_posix()
+        except ValueError:
+            rel_path = str(Path(input_file).resolve())
+        return f"{rel_path}|{output_format}"
+
+    def is_up_to_date(self, input_file: str, output_format: str, options: Dict[str, Any],
+                      st: Optional[os.stat_result] = None) -> bool:
+        """判断源文件自上次生成以来是否未变化（st 可传入扫描时已有的stat结果）"""
+        entry = self.entries.get(self._key(input_file, output_format))
+        if not entry:
+            return False
+        if entry.get('version') != __version__ or entry.get('options') != options:
+            return False
+        if not entry.get('output') or not os.path.exists(entry['output']):
+            return False
+
+        st = st or os.stat(input_file)
+        if st.st_size != entry.get('size'):
+            return False
+        if st.st_mtime_ns == entry.get('mtime_ns'):
+            return True
+
+        # mtime变化但大小相同（如被touch或重新同步），用内容摘要确认
+        if file_digest(input_file) != entry.get('hash'):
+            return False
+        entry['mtime_ns'] = st.st_mtime_ns
+        return True
+
+    def record(self, input_file: str, output_format: str, options: Dict[str, Any],
+               output_file: str, st: os.stat_result) -> None:
+        """
+        记录一次成功的生成
+        st 为处理前的stat结果；若处理期间源文件又被修改，则不记录，下次重新生成
+        """
+        current = os.stat(input_file)
+        if (current.st_size, current.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+            return
+
+        self.entries[self._key(input_file, output_format)] = {
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'hash': file_digest(input_file),
+            'format': output_format,
+            'options': options,
+            'version': __version__,
+            'output': output_file,
+        }
+
+    def save(self) -> None:
+        """原子地写回清单文件"""
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': __version__, 'entries': self.entries}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+def output_file_for(input_file: str, output_dir: str, output_format: str, suffix: str = '') -> Path:
+    """根据输入文件名和输出格式生成输出文件路径，suffix 附加在 _restored 之后（如部分导出的范围）"""
+    base_name = session_stem(input_file)  # 不包含扩展名（及压缩后缀）的文件名
+
+    if output_format == 'markdown':
+        return Path(output_dir) / f"{base_name}_restored{suffix}.md"
+    elif output_format in TABLE_FORMATS:
+        return Path(output_dir) / f"{base_name}_restored{suffix}{TABLE_FORMATS[output_format]}"
+    elif output_format == 'html':
+        return Path(output_dir) / f"{base_name}_restored{suffix}.html"
+    else:
+        return Path(output_dir) / f"{base_name}_restored{suffix}.txt"
+
+
+def dataset_partition(input_file: str, month: Optional[str]) -> str:
+    """
+    会话在数据集中的分区目录 project=<会话所在目录名>/month=<YYYY-MM>（Hive风格）
+    ~/.claude/projects 中会话所在目录即项目；查询时 DuckDB / pyarrow 按分区裁剪，只读需要的文件
+    """
+    project = Path(input_file).parent.name
+    return (f"project={quote(project, safe='') if project else HIVE_NULL_PARTITION}/"
+            f"month={month or HIVE_NULL_PARTITION}")
+
+
+def stats_file_for(input_file: str, output_dir: str) -> Path:
+    """--stats 的统计结果文件路径"""
+    return Path(output_dir) / f"{session_stem(input_file)}_stats.json"
+
+
+def write_stats(stats_file: Path, stats: SessionStats) -> None:
+    with open(stats_file, 'w', encoding='utf-8') as f:
+        json.dump(stats.to_dict(), f, ensure_ascii=False, indent=1)
+
+
+def output_formats_of(output_format: Any) -> List[str]:
+    """output_format 可以是单个格式，也可以是一次解析写出的多个格式列表"""
+    return [output_format] if isinstance(output_format, str) else list(output_format)
+
+
+def process_single_file(input_file: str, output_dir: str, output_format: Any,
+                        stream: bool = False, tail: bool = False,
+                        render_options: Optional[Dict[str, Any]] = None, stats: bool = False,
+                        profile: bool = False) -> dict:
     """
     处理单个文件
+    output_format 为多个格式的列表时只解析一次会话，依次写出各格式；
+    render_options 为传给 ChatRestorer 的渲染选项（如 stitch_subagents）；stats 时同时写出统计结果；
+    profile 时分阶段计时，结果（Profiler.to_dict()）放在返回值的 'profile' 中；
+    input_file 为tar归档时交给 process_archive 处理其中的全部会话；
+    output_format 为 parquet / arrow 时 output_dir 为数据集目录，表格写入其中按项目和月份划分的分区
     返回处理结果的统计信息
     """
+    if is_archive(input_file):
+        return process_archive(input_file, output_dir, output_format, stream, render_options, stats, profile)
+
     result = {
         'input_file': input_file,
         'success': False,
@@ -1080,210 +3877,1572 @@ def process_single_file(input_file: str, output_dir: str, output_format: str) ->
         'error': None
     }
 
+    profiler = Profiler() if profile else None
     try:
-        restorer = ChatRestorer(input_file, output_format)
-        output = restorer.restore()
-
-        # 生成输出文件名
-        input_path = Path(input_file)
-        base_name = input_path.stem  # 不包含扩展名的文件名
-
-        if output_format == 'markdown':
-            output_file = Path(output_dir) / f"{base_name}_restored.md"
-        elif output_format == 'html':
-            output_file = Path(output_dir) / f"{base_name}_restored.html"
-        else:
-            output_file = Path(output_dir) / f"{base_name}_restored.txt"
-
-        # 写入文件
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write(output)
+        with profile_span(profiler, input_file, 'file') as span:
+            if profiler is not None:
+                span.bytes = session_size(input_file)
+            formats = output_formats_of(output_format)
+            session_stats = SessionStats() if stats else None
+            restorer = ChatRestorer(input_file, formats[0], observers=[session_stats] if stats else None,
+                                    profiler=profiler, **(render_options or {}))
+
+            # 生成输出文件名（递归模式下输出目录镜像源目录结构）
+            outputs = {fmt: output_file_for(input_file, output_dir, fmt) for fmt in formats}
+            output_file = outputs[formats[0]]
+            output_file.parent.mkdir(parents=True, exist_ok=True)
+            restorer.output_dir = str(output_file.parent)
+
+            # 写入文件（压缩文件和归档成员不会再增长，不做增量刷新；增量刷新需要改写已有输出，不能压缩）
+            if formats[0] in TABLE_FORMATS:
+                restorer.load_data()
+                output_file = Path(output_dir) / dataset_partition(input_file, restorer.start_month()) / output_file.name
+                output_file.parent.mkdir(parents=True, exist_ok=True)
+                restorer.write_table(str(output_file), restorer.group_messages(keep_raw=True))
+            elif tail and is_plain_file(input_file) and not restorer.compress:
+                restorer.restore_incremental(str(output_file))
+            elif len(outputs) > 1:
+                restorer.write_outputs({fmt: str(path) for fmt, path in outputs.items()}, stream)
+            elif restorer.page_size and output_format == 'html':
+                restorer.restore_pages(str(output_file), stream)
+            elif stream:
+                restorer.restore_to_file(str(output_file))
+            else:
+                restorer.write_document(str(output_file))
+            if session_stats is not None:
+                write_stats(stats_file_for(input_file, output_dir), session_stats)
 
         result['success'] = True
-        result['output_file'] = str(output_file)
+        result['output_file'] = str(compressed_path(output_file, restorer.compress))
 
     except Exception as e:
         result['error'] = str(e)
 
+    if profiler is not None:
+        result['profile'] = profiler.to_dict()
+    return result
+
+
+def archive_group(member: str) -> str:
+    """成员所属的项目目录；<sessionId>/subagents/ 中的子代理归入会话所在的目录"""
+    parts = member.split('/')[:-1]
+    if len(parts) >= 2 and parts[-1] == 'subagents':
+        parts = parts[:-2]
+    return '/'.join(parts)
+
+
+def process_archive(archive: str, output_dir: str, output_format: Any, stream: bool = False,
+                    render_options: Optional[Dict[str, Any]] = None, stats: bool = False,
+                    profile: bool = False, exclude: Iterable[str] = DEFAULT_EXCLUDE) -> dict:
+    """
+    还原tar归档中的全部会话，不解压到磁盘
+    归档按顺序流式读取；tar中同一目录的成员通常是连续的，因此逐个项目目录缓存成员（子代理文件需要与会话一起查找），
+    读到下一个目录时还原上一个目录中的会话并释放内容，内存占用只取决于最大的项目目录。
+    目录的成员不连续时给出警告：分开还原的部分找不到彼此的子代理文件。
+    输出写入 output_dir/<归档名>/，按成员的目录结构存放；parquet / arrow 格式直接写入 output_dir 数据集的分区中。
+    exclude 按成员的文件名或相对路径匹配（默认排除子代理文件）
+    """
+    result = {
+        'input_file': archive,
+        'success': False,
+        'output_file': None,
+        'error': None,
+        'sessions': 0,
+    }
+    table = output_formats_of(output_format)[0] in TABLE_FORMATS
+    archive_output = Path(output_dir) if table else Path(output_dir) / session_stem(archive)
+    exclude_re = compile_patterns(exclude)
+    profiler = Profiler() if profile else None
+    errors = []
+    group = None
+    members = []
+    seen_groups = set()
+    split_groups = set()
+
+    def flush() -> None:
+        sessions = [name for name in members if not _matches(exclude_re, posixpath.basename(name), name)]
+        skipped = stem_collisions(sessions)
+        for name in sessions:
+            if name in skipped:
+                continue
+            member_output = archive_output if table else archive_output / posixpath.dirname(name)
+            member_result = process_single_file(f"{archive}/{name}", str(member_output),
+                                                output_format, stream, False, render_options, stats, profile)
+            if profiler is not None and member_result.get('profile'):
+                profiler.merge(member_result['profile'])
+            result['sessions'] += 1
+            if not member_result['success']:
+                errors.append(f"{name}: {member_result['error']}")
+        for name in members:
+            _ARCHIVE_MEMBERS.pop(f"{archive}/{name}", None)
+        members.clear()
+
+    try:
+        archive_output.mkdir(parents=True, exist_ok=True)
+        entries = iter_archive_members(archive)
+        while True:
+            with profile_span(profiler, archive, 'archive') as span:
+                entry = next(entries, None)
+                if entry is not None:
+                    span.bytes = len(entry[1])
+            if entry is None:
+                break
+            name, data = entry
+            if archive_group(name) != group:
+                flush()
+                group = archive_group(name)
+                if group in seen_groups and group not in split_groups:
+                    split_groups.add(group)
+                    print(f"⚠️  {archive}: {group or '根目录'} 中的成员在归档中不连续，"
+                          f"分开还原的会话可能无法拼接子代理", file=sys.stderr)
+                seen_groups.add(group)
+            _ARCHIVE_MEMBERS[f"{archive}/{name}"] = data
+            members.append(name)
+        flush()
+    except Exception as e:
+        errors.append(f"读取归档失败: {e or type(e).__name__}")
+    finally:
+        for name in members:
+            _ARCHIVE_MEMBERS.pop(f"{archive}/{name}", None)
+
+    result['success'] = not errors
+    result['output_file'] = str(archive_output)
+    if errors:
+        result['error'] = f"{len(errors)} 个错误: " + '; '.join(errors[:3]) + (' ...' if len(errors) > 3 else '')
+    if profiler is not None:
+        result['profile'] = profiler.to_dict()
     return result
 
 
-def batch_process_directory(directory: str, output_format: str = 'txt') -> None:
+def iter_parallel_results(tasks: List[Tuple[str, str]], output_format: Any,
+                          stream: bool, tail: bool, jobs: int,
+                          render_options: Optional[Dict[str, Any]] = None, stats: bool = False,
+                          profile: bool = False) -> Iterator[dict]:
+    """
+    在进程池中并行处理 (输入文件, 输出目录) 任务，按完成顺序产出处理结果
+    单个文件的异常由 process_single_file 隔离；工作进程本身崩溃时也只记为该文件失败
+    """
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(process_single_file, input_file, output_dir, output_format,
+                            stream, tail, render_options, stats, profile): input_file
+            for input_file, output_dir in tasks
+        }
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                yield {
+                    'input_file': futures[future],
+                    'success': False,
+                    'output_file': None,
+                    'error': str(e) or type(e).__name__
+                }
+
+
+def print_result_status(result: dict) -> bool:
+    """打印单个文件的处理结果，返回是否成功"""
+    if result['success']:
+        print(f"✅ 成功" + (f"（归档中 {result['sessions']} 个会话）" if 'sessions' in result else ''))
+        return True
+    print(f"❌ 失败: {result['error']}")
+    return False
+
+
+def mirrored_output_dir(input_file: str, directory: str, output_dir: str) -> str:
+    """输出目录镜像源文件相对于扫描根目录的子目录结构"""
+    rel_parent = Path(input_file).parent.relative_to(directory)
+    return str(Path(output_dir) / rel_parent)
+
+
+def batch_process_directory(directory: str, output_format: Any = 'txt', stream: bool = False,
+                            jobs: int = 1, force: bool = False, tail: bool = False,
+                            recursive: bool = False, include: Iterable[str] = DEFAULT_INCLUDE,
+                            exclude: Iterable[str] = DEFAULT_EXCLUDE,
+                            render_options: Optional[Dict[str, Any]] = None, stats: bool = False,
+                            profiler: Optional[Profiler] = None) -> None:
     """
     批量处理目录中的所有JSONL文件
+    jobs > 1 时使用多进程并行处理；除非 force，否则跳过清单中记录为未变化的文件；
+    recursive 时遍历所有子目录，输出文件按源目录结构存放（parquet / arrow 格式写入 claude_parse/dataset/ 分区数据集）；
+    output_format 为格式列表时每个会话只解析一次，写出全部格式；stats 时同时写出每个会话的统计结果；
+    profiler 不为None时分阶段计时，各文件（包括工作进程中）的计时结果合并到其中
     """
     print(f"📁 正在扫描目录: {directory}")
 
     # 扫描文件
     try:
-        jsonl_files = scan_jsonl_files(directory)
+        with profile_span(profiler, directory, 'discover') as span:
+            discovered = discover_session_files(directory, recursive, include, exclude)
+            if profiler is not None:
+                span.records = len(discovered)
     except Exception as e:
         print(f"❌ 错误: {e}", file=sys.stderr)
         sys.exit(1)
 
+    jsonl_files = [path for path, _ in discovered]
+    source_stats = dict(discovered)
+
     if not jsonl_files:
-        print("⚠️  未找到符合条件的JSONL文件（排除了agent-前缀和空文件）")
+        print(f"⚠️  未找到符合条件的JSONL文件（排除了 {', '.join(exclude) or '无'} 和空文件）")
         return
 
     print(f"✅ 找到 {len(jsonl_files)} 个符合条件的文件")
 
     # 创建输出目录
-    output_dir = Path(directory) / 'claude_parse'
+    output_dir = Path(directory) / OUTPUT_DIR_NAME
     output_dir.mkdir(exist_ok=True)
     print(f"📂 输出目录: {output_dir}")
-    print(f"📄 输出格式: {output_format.upper()}")
+    print(f"📄 输出格式: {'+'.join(fmt.upper() for fmt in output_formats_of(output_format))}")
+
+    # 增量处理：跳过自上次生成以来未变化的文件（多个格式作为一个组合记录）
+    manifest = BuildManifest(str(output_dir), directory)
+    manifest_format = '+'.join(output_formats_of(output_format))
+    options = {'stream': stream or tail, **(render_options or {})}
+    if stats:
+        options['stats'] = True
+    if force:
+        pending_files = jsonl_files
+    else:
+        with profile_span(profiler, directory, 'manifest') as span:
+            pending_files = [f for f in jsonl_files
+                             if not manifest.is_up_to_date(f, manifest_format, options, source_stats[f])]
+            span.records = len(jsonl_files)
+    skipped_count = len(jsonl_files) - len(pending_files)
+    if skipped_count:
+        print(f"⏭️  跳过未变化的文件: {skipped_count} 个")
+    if output_formats_of(output_format)[0] in TABLE_FORMATS:
+        # 列式导出：全部会话写入同一个按项目和月份分区的数据集
+        dataset_dir = str(output_dir / DATASET_DIR_NAME)
+        tasks = [(f, dataset_dir) for f in pending_files]
+    else:
+        tasks = [(f, mirrored_output_dir(f, directory, str(output_dir))) for f in pending_files]
+
+    jobs = min(jobs, len(pending_files))
+    if jobs > 1:
+        print(f"⚙️  并行进程数: {jobs}")
     print("")
 
     # 批量处理
     success_count = 0
     failed_count = 0
 
-    for i, input_file in enumerate(jsonl_files, 1):
-        file_name = Path(input_file).name
-        print(f"[{i}/{len(jsonl_files)}] 处理中: {file_name} ... ", end='', flush=True)
-
-        result = process_single_file(input_file, str(output_dir), output_format)
-
-        if result['success']:
-            print(f"✅ 成功")
+    def handle_result(result: dict) -> None:
+        nonlocal success_count, failed_count
+        if profiler is not None and result.get('profile'):
+            profiler.merge(result['profile'])
+        if print_result_status(result):
             success_count += 1
+            try:
+                manifest.record(result['input_file'], manifest_format, options,
+                                result['output_file'], source_stats[result['input_file']])
+            except OSError:
+                pass
         else:
-            print(f"❌ 失败: {result['error']}")
             failed_count += 1
 
+    try:
+        if jobs > 1:
+            # 并行模式：按完成顺序显示进度
+            results = iter_parallel_results(tasks, output_format, stream, tail, jobs, render_options, stats,
+                                            profiler is not None)
+            for i, result in enumerate(results, 1):
+                file_name = Path(result['input_file']).name
+                print(f"[{i}/{len(pending_files)}] 已完成: {file_name} ... ", end='', flush=True)
+                handle_result(result)
+        else:
+            for i, (input_file, file_output_dir) in enumerate(tasks, 1):
+                file_name = Path(input_file).name
+                print(f"[{i}/{len(pending_files)}] 处理中: {file_name} ... ", end='', flush=True)
+                handle_result(process_single_file(input_file, file_output_dir, output_format,
+                                                  stream, tail, render_options, stats, profiler is not None))
+    finally:
+        # 即使中途中断，也保留已完成文件的记录
+        manifest.save()
+
     # 输出统计信息
     print("")
     print("=" * 80)
     print(f"批量处理完成！")
     print(f"  成功: {success_count} 个文件")
     print(f"  失败: {failed_count} 个文件")
+    if skipped_count:
+        print(f"  跳过: {skipped_count} 个文件（未变化）")
     print(f"  输出目录: {output_dir}")
     print("=" * 80)
 
 
-def scan_jsonl_files(directory: str) -> List[str]:
+WATCH_MAX_WAIT = 5  # 监视模式中持续变化的文件最多等待 debounce 的这么多倍就刷新
+
+
+def watch_sessions(list_files: Callable[[], List[str]], output_dir_for: Callable[[str], str],
+                   output_format: str, interval: float = 1.0, debounce: float = 2.0,
+                   render_options: Optional[Dict[str, Any]] = None) -> None:
     """
-    扫描目录中所有的jsonl文件，排除agent-前缀的文件
-    返回符合条件的文件路径列表
+    监视会话文件并实时增量刷新导出
+    轮询文件的大小和mtime；文件在 debounce 秒内不再变化后才重新渲染，
+    合并连续追加带来的多次变化。持续写入的会话（如长时间运行的代理）最多等待
+    WATCH_MAX_WAIT 倍的 debounce 就刷新一次。每次刷新只解析新追加的内容（见 restore_incremental）。
     """
-    directory_path = Path(directory)
-    if not directory_path.exists():
-        raise FileNotFoundError(f"目录不存在: {directory}")
+    rendered = {}  # path -> 已渲染时的 (size, mtime_ns)
+    observed = {}  # path -> (最近一次观察到的 (size, mtime_ns), 观察时间, 开始等待的时间)
+    first_pass = True
 
-    if not directory_path.is_dir():
-        raise NotADirectoryError(f"不是有效的目录: {directory}")
+    print(f"👀 正在监视会话变化（轮询间隔 {interval}s，防抖 {debounce}s），按 Ctrl+C 停止")
 
-    jsonl_files = []
+    try:
+        while True:
+            now = time.monotonic()
+            try:
+                files = list_files()
+            except OSError as e:
+                print(f"❌ 错误: {e}", file=sys.stderr)
+                files = []
+
+            for input_file in files:
+                try:
+                    st = os.stat(input_file)
+                except OSError:
+                    continue
+                signature = (st.st_size, st.st_mtime_ns)
+                if rendered.get(input_file) == signature:
+                    continue
 
-    # 扫描所有.jsonl和.json文件
-    for file_path in directory_path.glob('*.jsonl'):
-        # 排除agent-前缀的文件
-        if not file_path.name.startswith('agent-'):
-            # 检查文件大小，跳过空文件
-            if file_path.stat().st_size > 0:
-                jsonl_files.append(str(file_path))
+                if not first_pass:
+                    last = observed.get(input_file)
+                    first_seen = last[2] if last is not None else now
+                    overdue = now - first_seen >= WATCH_MAX_WAIT * debounce
+                    if (last is None or last[0] != signature) and not overdue:
+                        # 仍在变化，等待稳定
+                        observed[input_file] = (signature, now, first_seen)
+                        continue
+                    if now - last[1] < debounce and not overdue:
+                        continue
+
+                observed.pop(input_file, None)
+                output_file = output_file_for(input_file, output_dir_for(input_file), output_format)
+                try:
+                    restorer = ChatRestorer(input_file, output_format, **(render_options or {}))
+                    restorer.output_dir = str(output_file.parent)
+                    new_count = restorer.restore_incremental(str(output_file))
+                    rendered[input_file] = signature
+                    print(f"🔄 [{datetime.now().strftime('%H:%M:%S')}] {Path(input_file).name}: "
+                          f"新增 {new_count} 条消息 -> {output_file}")
+                except Exception as e:
+                    rendered[input_file] = signature
+                    print(f"❌ [{datetime.now().strftime('%H:%M:%S')}] {Path(input_file).name}: {e}")
 
-    # 也扫描.json文件（如示例中的bb81858c-f8ba-4a96-8750-79bac1934255.json）
-    for file_path in directory_path.glob('*.json'):
-        if not file_path.name.startswith('agent-'):
-            if file_path.stat().st_size > 0:
-                jsonl_files.append(str(file_path))
+            first_pass = False
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("\n👋 已停止监视")
 
-    return sorted(jsonl_files)
 
+DEFAULT_PROJECTS_DIR = Path.home() / '.claude' / 'projects'
+DEFAULT_INDEX_DB = Path.home() / '.claude' / 'claude_parse' / 'sessions.db'
 
-def process_single_file(input_file: str, output_dir: str, output_format: str) -> dict:
+
+def scan_project_files(root: str, exclude: Iterable[str] = DEFAULT_EXCLUDE) -> List[Tuple[str, str, os.stat_result]]:
     """
-    处理单个文件
-    返回处理结果的统计信息
+    递归扫描会话根目录（~/.claude/projects 的布局：每个项目一个子目录）
+    返回 (项目名, 文件路径, stat结果) 列表，项目名为第一级子目录名，根目录下的文件项目名为空
     """
-    result = {
-        'input_file': input_file,
-        'success': False,
-        'output_file': None,
-        'error': None
-    }
+    results = []
+    for path, st in discover_session_files(root, recursive=True, exclude=exclude):
+        rel_parts = Path(path).relative_to(root).parts
+        results.append((rel_parts[0] if len(rel_parts) > 1 else '', path, st))
+    return results
 
-    try:
-        restorer = ChatRestorer(input_file, output_format)
-        output = restorer.restore()
 
-        # 生成输出文件名
-        input_path = Path(input_file)
-        base_name = input_path.stem  # 不包含扩展名的文件名
+def message_text(msg: Message, limit: Optional[int] = None) -> str:
+    """提取聚合消息中的文本内容（不含思考过程和工具调用）"""
+    texts = [item.text for item in msg.content if item.type == 'text']
+    text = '\n'.join(t for t in texts if t)
+    return text[:limit] if limit else text
+
+
+def first_user_prompt(grouped_messages: Iterable[Message]) -> str:
+    """会话标题：第一条真正的用户输入（跳过 <ide_opened_file> 等系统注入的内容）"""
+    for msg in grouped_messages:
+        if msg.role != 'user':
+            continue
+        for item in msg.content:
+            text = item.text.strip() if item.type == 'text' else ''
+            if text and not text.startswith('<'):
+                return text
+    return ''
+
 
-        if output_format == 'markdown':
-            output_file = Path(output_dir) / f"{base_name}_restored.md"
+class SessionIndex:
+    """
+    会话的本地SQLite索引
+    每个会话一行元数据（首条提问、cwd、gitBranch、版本、token合计、时间范围），
+    每条聚合消息一行摘要。按文件大小和mtime增量更新，list/show 无需重新解析JSONL。
+    用户文本、助手回复、思考过程、工具参数和工具结果另外写入FTS5全文索引，供 search 使用。
+    """
+
+    SCHEMA_VERSION = 2
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            id INTEGER PRIMARY KEY,
+            path TEXT UNIQUE NOT NULL,
+            session_id TEXT,
+            project TEXT,
+            size INTEGER,
+            mtime_ns INTEGER,
+            first_prompt TEXT,
+            cwd TEXT,
+            git_branch TEXT,
+            version TEXT,
+            started_at TEXT,
+            ended_at TEXT,
+            message_count INTEGER,
+            user_count INTEGER,
+            assistant_count INTEGER,
+            tool_use_count INTEGER,
+            input_tokens INTEGER,
+            output_tokens INTEGER,
+            cache_read_tokens INTEGER,
+            cache_creation_tokens INTEGER,
+            indexed_at TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_sessions_session_id ON sessions(session_id);
+        CREATE INDEX IF NOT EXISTS idx_sessions_started_at ON sessions(started_at);
+        CREATE TABLE IF NOT EXISTS messages (
+            session INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+            seq INTEGER NOT NULL,
+            role TEXT,
+            message_id TEXT,
+            timestamp TEXT,
+            text_preview TEXT,
+            thinking_blocks INTEGER,
+            tool_names TEXT,
+            input_tokens INTEGER,
+            output_tokens INTEGER,
+            cache_read_tokens INTEGER,
+            cache_creation_tokens INTEGER,
+            PRIMARY KEY (session, seq)
+        );
+        CREATE TABLE IF NOT EXISTS search_docs (
+            id INTEGER PRIMARY KEY,
+            session INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+            seq INTEGER NOT NULL,
+            kind TEXT,
+            timestamp TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_search_docs_session ON search_docs(session);
+    """
+
+    PREVIEW_CHARS = 200
+    SEARCH_CHARS = 32 * 1024  # 单个内容块写入全文索引的最大字符数（超大的工具结果只索引开头）
+
+    def __init__(self, db_path: str):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA foreign_keys=ON')
+        self.conn.executescript(self.SCHEMA)
+        self._create_search_table()
+
+        if self.conn.execute('PRAGMA user_version').fetchone()[0] < self.SCHEMA_VERSION:
+            # 旧版本索引缺少新增的数据，下次 update 时全部重新解析
+            self.conn.execute('UPDATE sessions SET mtime_ns = NULL')
+            self.conn.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+            self.conn.commit()
+
+    def _create_search_table(self) -> None:
+        """
+        创建FTS5全文索引表，rowid 与 search_docs.id 对应
+        优先使用 trigram 分词器（支持中文等无空格语言的子串检索），不可用时退回 unicode61
+        """
+        exists = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'search_fts'").fetchone()
+        if exists:
+            return
+        try:
+            self.conn.execute("CREATE VIRTUAL TABLE search_fts USING fts5(text, tokenize='trigram')")
+        except sqlite3.OperationalError:
+            self.conn.execute("CREATE VIRTUAL TABLE search_fts USING fts5(text)")
+
+    @property
+    def uses_trigram(self) -> bool:
+        row = self.conn.execute("SELECT sql FROM sqlite_master WHERE name = 'search_fts'").fetchone()
+        return 'trigram' in row[0]
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def update(self, root: str) -> Dict[str, int]:
+        """增量更新 root 下的所有会话，返回 新增/更新/删除/未变化 的数量"""
+        counts = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0, 'failed': 0}
+        root_path = str(Path(root).resolve())
+        known = {
+            row['path']: (row['size'], row['mtime_ns'])
+            for row in self.conn.execute('SELECT path, size, mtime_ns FROM sessions')
+        }
+
+        seen = set()
+        for project, file_path, st in scan_project_files(root):
+            path = str(Path(file_path).resolve())
+            seen.add(path)
+            if known.get(path) == (st.st_size, st.st_mtime_ns):
+                counts['unchanged'] += 1
+                continue
+            try:
+                self._index_file(path, project, st)
+            except Exception as e:
+                print(f"⚠️  索引失败: {path}: {e}", file=sys.stderr)
+                counts['failed'] += 1
+                continue
+            counts['updated' if path in known else 'added'] += 1
+
+        # 清理已删除的会话文件
+        for path in known:
+            if path not in seen and path.startswith(root_path + os.sep) and not os.path.exists(path):
+                self._delete_session(path)
+                counts['removed'] += 1
+        self.conn.commit()
+        return counts
+
+    def _delete_session(self, path: str) -> None:
+        """删除会话及其消息和全文索引条目"""
+        self.conn.execute(
+            'DELETE FROM search_fts WHERE rowid IN'
+            ' (SELECT search_docs.id FROM search_docs JOIN sessions ON sessions.id = search_docs.session'
+            '  WHERE sessions.path = ?)', (path,))
+        self.conn.execute('DELETE FROM sessions WHERE path = ?', (path,))
+
+    def _search_entries(self, restorer: 'ChatRestorer', seq: int,
+                        msg: Message) -> Iterator[Tuple[int, str, str, str]]:
+        """提取一条聚合消息中需要全文索引的内容: (seq, kind, timestamp, text)"""
+        timestamp = msg.timestamp
+        for item in msg.content:
+            if item.type == 'text':
+                yield seq, msg.role, timestamp, item.text
+            elif item.type == 'thinking':
+                yield seq, 'thinking', timestamp, item.text
+            elif item.type == 'tool_use':
+                if item.input:
+                    yield seq, 'tool_input', timestamp, f"{item.name} {json.dumps(item.input, ensure_ascii=False)}"
+                tool_result = restorer.tool_results.get(item.id)
+                if tool_result:
+                    yield seq, 'tool_result', tool_result.timestamp or timestamp, str(tool_result.content)
+
+    def _index_file(self, path: str, project: str, st: os.stat_result) -> None:
+        restorer = ChatRestorer(path)
+        restorer.load_data()
+        grouped = restorer.group_messages()
+
+        meta = {}
+        for record in restorer.messages:
+            for key in ('sessionId', 'cwd', 'gitBranch', 'version'):
+                if key not in meta and record.get(key) is not None:
+                    meta[key] = record[key]
+            if len(meta) == 4:
+                break
+
+        totals = defaultdict(int)
+        message_rows = []
+        for seq, msg in enumerate(grouped):
+            usage = msg.usage or {}
+            tool_names = [tool.name for tool in msg.tool_calls()]
+            totals[msg.role] += 1
+            totals['tool_uses'] += len(tool_names)
+            for key in ('input_tokens', 'output_tokens', 'cache_read_input_tokens', 'cache_creation_input_tokens'):
+                totals[key] += usage.get(key, 0) or 0
+            message_rows.append((
+                seq,
+                msg.role,
+                msg.id,
+                msg.timestamp,
+                message_text(msg, self.PREVIEW_CHARS),
+                sum(1 for item in msg.content if item.type == 'thinking'),
+                ','.join(tool_names),
+                usage.get('input_tokens', 0),
+                usage.get('output_tokens', 0),
+                usage.get('cache_read_input_tokens', 0),
+                usage.get('cache_creation_input_tokens', 0),
+            ))
+
+        search_rows = [
+            entry
+            for seq, msg in enumerate(grouped)
+            for entry in self._search_entries(restorer, seq, msg)
+            if entry[3].strip()
+        ]
+
+        timestamps = [msg.timestamp for msg in grouped if msg.timestamp]
+        with self.conn:
+            self._delete_session(path)
+            cursor = self.conn.execute(
+                'INSERT INTO sessions (path, session_id, project, size, mtime_ns, first_prompt, cwd, git_branch,'
+                ' version, started_at, ended_at, message_count, user_count, assistant_count, tool_use_count,'
+                ' input_tokens, output_tokens, cache_read_tokens, cache_creation_tokens, indexed_at)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    path, meta.get('sessionId') or Path(path).stem, project, st.st_size, st.st_mtime_ns,
+                    first_user_prompt(grouped)[:self.PREVIEW_CHARS], meta.get('cwd'), meta.get('gitBranch'),
+                    meta.get('version'), min(timestamps, default=None), max(timestamps, default=None),
+                    len(grouped), totals['user'], totals['assistant'], totals['tool_uses'],
+                    totals['input_tokens'], totals['output_tokens'],
+                    totals['cache_read_input_tokens'], totals['cache_creation_input_tokens'],
+                    datetime.now().isoformat(timespec='seconds'),
+                ))
+            session = cursor.lastrowid
+            self.conn.executemany(
+                'INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(session,) + row for row in message_rows])
+
+            for seq, kind, timestamp, text in search_rows:
+                doc = self.conn.execute(
+                    'INSERT INTO search_docs (session, seq, kind, timestamp) VALUES (?, ?, ?, ?)',
+                    (session, seq, kind, timestamp)).lastrowid
+                self.conn.execute('INSERT INTO search_fts (rowid, text) VALUES (?, ?)',
+                                  (doc, text[:self.SEARCH_CHARS]))
+
+    def list_sessions(self, project: Optional[str] = None, limit: Optional[int] = None) -> List[sqlite3.Row]:
+        sql = 'SELECT * FROM sessions'
+        params = []
+        if project:
+            sql += ' WHERE project LIKE ?'
+            params.append(f'%{project}%')
+        sql += ' ORDER BY started_at DESC'
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return self.conn.execute(sql, params).fetchall()
+
+    def find_session(self, key: str) -> List[sqlite3.Row]:
+        """按会话ID前缀或文件路径查找会话"""
+        path = str(Path(key).resolve()) if os.path.exists(key) else key
+        return self.conn.execute(
+            'SELECT * FROM sessions WHERE path = ? OR session_id LIKE ? OR path LIKE ? ORDER BY started_at DESC',
+            (path, f'{key}%', f'%{os.sep}{key}%')).fetchall()
+
+    def get_messages(self, session: int) -> List[sqlite3.Row]:
+        return self.conn.execute('SELECT * FROM messages WHERE session = ? ORDER BY seq', (session,)).fetchall()
+
+    def search(self, query: str, limit: int = 20, project: Optional[str] = None,
+               kind: Optional[str] = None, raw: bool = False) -> List[sqlite3.Row]:
+        """
+        全文检索，按相关度排序返回 会话ID、时间、内容类型、片段
+        默认把查询拆成空格分隔的词、全部匹配（AND）；raw=True 时直接使用FTS5查询语法。
+        trigram 分词器无法索引少于3个字符的词，这类词退回逐行子串匹配。
+        """
+        terms = query.split()
+        conditions = []
+        params = []
+        if raw:
+            conditions.append('search_fts MATCH ?')
+            params.append(query)
+        else:
+            short = self.uses_trigram
+            fts_terms = [t for t in terms if not (short and len(t) < 3)]
+            like_terms = [t for t in terms if short and len(t) < 3]
+            if fts_terms:
+                conditions.append('search_fts MATCH ?')
+                params.append(' '.join('"' + t.replace('"', '""') + '"' for t in fts_terms))
+            for term in like_terms:
+                conditions.append('instr(lower(search_fts.text), ?) > 0')
+                params.append(term.lower())
+        if not conditions:
+            return []
+        if project:
+            conditions.append('sessions.project LIKE ?')
+            params.append(f'%{project}%')
+        if kind:
+            conditions.append('search_docs.kind = ?')
+            params.append(kind)
+
+        sql = (
+            "SELECT sessions.session_id, sessions.project, sessions.path, search_docs.seq, search_docs.kind,"
+            " search_docs.timestamp, snippet(search_fts, 0, '«', '»', '…', 48) AS snippet"
+            " FROM search_fts"
+            " JOIN search_docs ON search_docs.id = search_fts.rowid"
+            " JOIN sessions ON sessions.id = search_docs.session"
+            " WHERE " + ' AND '.join(conditions) +
+            (" ORDER BY rank" if any(c.startswith('search_fts MATCH') for c in conditions)
+             else " ORDER BY search_docs.timestamp DESC") +
+            " LIMIT ?"
+        )
+        params.append(limit)
+        return self.conn.execute(sql, params).fetchall()
+
+    def iter_texts(self, kinds: Iterable[str]) -> Iterator[Tuple[int, str]]:
+        """按会话顺序产出全文索引中指定类型的内容: (会话行ID, 文本)"""
+        kinds = list(kinds)
+        placeholders = ', '.join('?' * len(kinds))
+        cursor = self.conn.execute(
+            'SELECT search_docs.session, search_fts.text FROM search_docs'
+            ' JOIN search_fts ON search_fts.rowid = search_docs.id'
+            f' WHERE search_docs.kind IN ({placeholders}) ORDER BY search_docs.session', kinds)
+        for row in cursor:
+            yield row[0], row[1]
+
+
+CJK_CHARS = '぀-ヿ㐀-䶿一-鿿豈-﫿가-힯'  # 假名、汉字、谚文
+SEARCH_TOKEN_RE = re.compile(f'([{CJK_CHARS}]+)|([^\\W_{CJK_CHARS}]+)')
+MAX_TOKEN_CHARS = 32  # 更长的“词”（哈希、base64等）不进入静态站点的检索索引
+
+
+def search_tokens(text: str) -> set:
+    """
+    静态站点检索的分词（与页面中的JavaScript分词规则一致）
+    字母数字连续段按小写整词索引（至少2个字符）；中日韩文字按相邻两字（bigram）和单字索引，
+    单字查询（如“码”）也能匹配多字的词（如“代码”）
+    """
+    tokens = set()
+    for cjk, word in set(SEARCH_TOKEN_RE.findall(text.lower())):
+        if word:
+            if 2 <= len(word) <= MAX_TOKEN_CHARS:
+                tokens.add(word)
         else:
-            output_file = Path(output_dir) / f"{base_name}_restored.txt"
+            tokens.update(cjk)
+            tokens.update(cjk[i:i + 2] for i in range(len(cjk) - 1))
+    return tokens
 
-        # 写入文件
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write(output)
 
-        result['success'] = True
-        result['output_file'] = str(output_file)
+def token_shard(token: str, shards: int) -> int:
+    """
+    按词的前两个字符（FNV-1a哈希）分片，同一前缀的词总在同一分片中，
+    浏览器只需加载一个分片即可完成前缀匹配
+    """
+    h = 2166136261
+    for ch in token[:2]:
+        h = ((h ^ ord(ch)) * 16777619) & 0xffffffff
+    return h % shards
 
-    except Exception as e:
-        result['error'] = str(e)
 
-    return result
+class StaticSite:
+    """
+    多会话静态站点（site 子命令）
+    index.html 按项目列出所有会话（标题、时间范围、消息数、token合计），链接到各会话的HTML页面；
+    检索索引是按词分片、gzip压缩的倒排表（search/shard-N.js），浏览器只在检索时加载查询词所在的分片，
+    页面直接从本地文件打开即可检索，不需要服务器
+    """
+
+    SEARCH_DIR_NAME = 'search'
+    SEARCH_KINDS = ('user', 'assistant', 'thinking', 'tool_input')  # 工具结果体积大且噪声多，不进入站点索引
+    SHARD_POSTINGS = 50000  # 每个分片的目标倒排项数
+    MAX_SHARDS = 4096
+    TITLE_CHARS = 120
 
+    def __init__(self, output_dir: str):
+        self.output_dir = Path(output_dir)
 
-def batch_process_directory(directory: str, output_format: str = 'txt') -> None:
+    def build(self, sessions: List[Dict[str, Any]], texts: Iterable[Tuple[int, str]]) -> Dict[str, int]:
+        """
+        生成 index.html 和检索分片
+        sessions 为已按显示顺序排列的会话（含 key、project、page 等字段），
+        texts 产出 (会话key, 文本)，同一会话的文本应连续出现
+        """
+        docs = {session['key']: doc for doc, session in enumerate(sessions)}
+        postings = defaultdict(lambda: array('I'))
+        for session in sessions:
+            for token in search_tokens(' '.join(filter(None, (session['project'], session['cwd'],
+                                                               session['git_branch'])))):
+                postings[token].append(docs[session['key']])
+
+        # 同一会话的文本连续出现，合并后每个会话只分词一次
+        for key, group in itertools.groupby(texts, key=lambda item: item[0]):
+            doc = docs.get(key)
+            if doc is None:
+                continue
+            for token in search_tokens('\n'.join(text for _, text in group)):
+                postings[token].append(doc)
+
+        build_id, shards = self._write_search_index(postings)
+        with open(self.output_dir / 'index.html', 'w', encoding='utf-8') as f:
+            write_parts(f, self._index_html(sessions, build_id, shards))
+        return {'sessions': len(sessions), 'tokens': len(postings), 'shards': shards}
+
+    def _write_search_index(self, postings: Dict[str, array]) -> Tuple[str, int]:
+        """
+        写出检索分片，返回 (构建ID, 分片数)
+        每个分片是 {词: 倒排表} 的JSON，倒排表为升序会话编号的差值（16进制，以 . 分隔），
+        gzip压缩后以base64嵌入 .js 文件，通过 <script> 加载，从 file:// 打开时同样可用
+        """
+        total = sum(len(docs) for docs in postings.values())
+        shards = 1
+        while shards < self.MAX_SHARDS and shards * self.SHARD_POSTINGS < total:
+            shards *= 2
+
+        buckets = [{} for _ in range(shards)]
+        for token, docs in postings.items():
+            docs = sorted(set(docs))
+            deltas = [docs[0]] + [doc - previous for previous, doc in zip(docs, docs[1:])]
+            buckets[token_shard(token, shards)][token] = '.'.join([format(delta, 'x') for delta in deltas])
+
+        search_dir = self.output_dir / self.SEARCH_DIR_NAME
+        search_dir.mkdir(parents=True, exist_ok=True)
+        build = hashlib.blake2b(digest_size=6)
+        for number, bucket in enumerate(buckets):
+            data = json.dumps(bucket, ensure_ascii=False, sort_keys=True, separators=(',', ':')).encode('utf-8')
+            payload = base64.b64encode(gzip.compress(data, mtime=0)).decode('ascii')
+            build.update(payload.encode('ascii'))
+            with open(search_dir / f'shard-{number}.js', 'w', encoding='utf-8') as f:
+                f.write(f'SiteSearch.loaded({number},"{payload}");\n')
+
+        # 清理上次构建遗留的多余分片
+        for path in search_dir.glob('shard-*.js'):
+            number = path.stem.partition('-')[2]
+            if not number.isdigit() or int(number) >= shards:
+                path.unlink()
+        return build.hexdigest(), shards
+
+    def _index_html(self, sessions: List[Dict[str, Any]], build_id: str, shards: int) -> Iterator[str]:
+        """站点首页：按项目分组的会话表格和检索框"""
+        esc = html_module.escape
+        totals = defaultdict(int)
+        for session in sessions:
+            for key in ('input_tokens', 'output_tokens', 'cache_read_tokens', 'cache_creation_tokens'):
+                totals[key] += session[key] or 0
+
+        yield '<!DOCTYPE html>\n<html lang="zh-CN">\n<head>\n'
+        yield '  <meta charset="UTF-8">\n'
+        yield '  <meta name="viewport" content="width=device-width, initial-scale=1.0">\n'
+        yield '  <title>Claude Code 会话归档</title>\n'
+        yield self.SITE_CSS
+        yield '</head>\n<body>\n  <div class="container">\n'
+        yield '    <div class="header">\n      <h1>Claude Code 会话归档</h1>\n'
+        yield (f'      <div class="subtitle">{len(sessions)} 个会话 · 输入 {totals["input_tokens"]:,} · '
+               f'输出 {totals["output_tokens"]:,} · 缓存读取 {totals["cache_read_tokens"]:,} · '
+               f'缓存写入 {totals["cache_creation_tokens"]:,} tokens</div>\n')
+        yield '    </div>\n'
+        yield '    <div class="search">\n'
+        yield '      <input id="search-input" type="search" placeholder="检索会话内容（多个词以空格分隔，全部匹配）" autofocus>\n'
+        yield '      <div id="search-status"></div>\n'
+        yield '    </div>\n'
+
+        project = None
+        for doc, session in enumerate(sessions):
+            if session['project'] != project:
+                if project is not None:
+                    yield '      </tbody>\n    </table>\n    </section>\n'
+                project = session['project']
+                yield '    <section class="project">\n'
+                yield f'    <h2>{esc(project or "（根目录）")}</h2>\n'
+                yield '    <table>\n'
+                yield ('      <thead><tr><th>会话</th><th>时间</th><th>消息</th><th>输入</th><th>输出</th>'
+                       '<th>缓存读取</th><th>缓存写入</th></tr></thead>\n      <tbody>\n')
+            title = one_line(session['first_prompt'], self.TITLE_CHARS) or session['session_id']
+            started, ended = format_time(session['started_at']), format_time(session['ended_at'])
+            if not ended or ended == started:
+                time_range = started
+            elif started[:10] == ended[:10]:
+                time_range = f'{started} ~ {ended[11:]}'
+            else:
+                time_range = f'{started} ~ {ended}'
+            yield (f'        <tr data-doc="{doc}"><td class="title"><a href="{esc(session["page"])}">{esc(title)}</a>'
+                   f'<div class="session-id">{esc(session["session_id"] or "")}'
+                   f'{" · " + esc(session["git_branch"]) if session["git_branch"] else ""}</div></td>'
+                   f'<td class="time">{esc(time_range)}</td>'
+                   f'<td class="num">{session["message_count"] or 0:,}</td>'
+                   f'<td class="num">{session["input_tokens"] or 0:,}</td>'
+                   f'<td class="num">{session["output_tokens"] or 0:,}</td>'
+                   f'<td class="num">{session["cache_read_tokens"] or 0:,}</td>'
+                   f'<td class="num">{session["cache_creation_tokens"] or 0:,}</td></tr>\n')
+        if project is not None:
+            yield '      </tbody>\n    </table>\n    </section>\n'
+        yield '  </div>\n'
+
+        config = json.dumps({'shards': shards, 'build': build_id, 'dir': self.SEARCH_DIR_NAME,
+                             'cjk': CJK_CHARS, 'maxToken': MAX_TOKEN_CHARS})
+        yield f'  <script>\n    const SITE = {config};\n{self.SITE_SCRIPT}  </script>\n'
+        yield '</body>\n</html>\n'
+
+    SITE_CSS = """  <style>
+    * { margin: 0; padding: 0; box-sizing: border-box; }
+    body {
+      font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', 'Roboto', 'Helvetica Neue', sans-serif;
+      background: #1a1a1a; color: #e0e0e0; line-height: 1.6; padding: 20px;
+    }
+    .container { max-width: 1200px; margin: 0 auto; background: #2a2a2a; border-radius: 12px; overflow: hidden; }
+    .header { background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 30px; text-align: center; color: white; }
+    .header h1 { font-size: 28px; font-weight: 600; margin-bottom: 5px; }
+    .header .subtitle { opacity: 0.9; font-size: 14px; }
+    .search { padding: 20px; border-bottom: 2px solid #3a3a3a; }
+    #search-input {
+      width: 100%; padding: 10px 14px; font-size: 16px; border-radius: 8px;
+      border: 1px solid #444; background: #1f1f1f; color: #e0e0e0;
+    }
+    #search-status { margin-top: 8px; font-size: 13px; color: #999; min-height: 1.4em; }
+    .project { padding: 10px 20px 20px; }
+    .project h2 { font-size: 18px; color: #8fa4ff; margin: 10px 0; word-break: break-all; }
+    table { width: 100%; border-collapse: collapse; font-size: 13px; }
+    th { text-align: left; color: #999; font-weight: 500; border-bottom: 1px solid #444; padding: 6px 8px; }
+    td { border-bottom: 1px solid #333; padding: 6px 8px; vertical-align: top; }
+    td.title a { color: #e0e0e0; text-decoration: none; }
+    td.title a:hover { color: #8fa4ff; text-decoration: underline; }
+    .session-id { font-size: 11px; color: #777; font-family: monospace; }
+    td.time { white-space: nowrap; color: #aaa; }
+    td.num, th:nth-child(n+3) { text-align: right; white-space: nowrap; font-variant-numeric: tabular-nums; }
+    .hidden { display: none; }
+  </style>
+"""
+
+    SITE_SCRIPT = """
+    // 检索分片按需加载：shard-N.js 调用 SiteSearch.loaded(N, base64(gzip(JSON)))
+    const shardPromises = {};
+    const shardCallbacks = {};
+    window.SiteSearch = {
+      loaded: function(number, payload) {
+        if (shardCallbacks[number]) {
+          shardCallbacks[number](payload);
+        }
+      }
+    };
+
+    async function inflate(payload) {
+      const bytes = Uint8Array.from(atob(payload), function(c) { return c.charCodeAt(0); });
+      const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream("gzip"));
+      return JSON.parse(await new Response(stream).text());
+    }
+
+    function loadShard(number) {
+      if (!shardPromises[number]) {
+        shardPromises[number] = new Promise(function(resolve, reject) {
+          shardCallbacks[number] = resolve;
+          const script = document.createElement("script");
+          script.src = SITE.dir + "/shard-" + number + ".js?v=" + SITE.build;
+          script.onerror = function() {
+            delete shardPromises[number];
+            reject(new Error("无法加载检索分片 " + number));
+          };
+          document.head.appendChild(script);
+        }).then(inflate);
+      }
+      return shardPromises[number];
+    }
+
+    // 与导出时的分词规则一致：字母数字整词（小写，至少2个字符），中日韩文字按相邻两字
+    const tokenPattern = new RegExp("([" + SITE.cjk + "]+)|((?:(?![" + SITE.cjk + "])[\\\\p{L}\\\\p{N}])+)", "gu");
+
+    function tokenize(query) {
+      const terms = [];
+      const text = query.toLowerCase();
+      let match;
+      tokenPattern.lastIndex = 0;
+      while ((match = tokenPattern.exec(text)) !== null) {
+        const atEnd = tokenPattern.lastIndex === text.length;
+        if (match[1]) {
+          const cjk = Array.from(match[1]);
+          if (cjk.length === 1) {
+            terms.push({ token: cjk[0], prefix: false });
+          }
+          for (let i = 0; i + 1 < cjk.length; i++) {
+            terms.push({ token: cjk[i] + cjk[i + 1], prefix: false });
+          }
+        } else if (match[2].length >= 2 && match[2].length <= SITE.maxToken) {
+          // 正在输入的最后一个词按前缀匹配
+          terms.push({ token: match[2], prefix: atEnd });
+        }
+      }
+      return terms;
+    }
+
+    function tokenShard(token) {
+      let h = 2166136261;
+      for (const ch of Array.from(token).slice(0, 2)) {
+        h = Math.imul(h ^ ch.codePointAt(0), 16777619) >>> 0;
+      }
+      return h % SITE.shards;
+    }
+
+    function decodePostings(text, docs) {
+      let doc = 0;
+      for (const delta of text.split(".")) {
+        doc += parseInt(delta, 16);
+        docs.add(doc);
+      }
+    }
+
+    async function search(query) {
+      const terms = tokenize(query);
+      if (!terms.length) {
+        return null;
+      }
+      const shards = await Promise.all(terms.map(function(term) { return loadShard(tokenShard(term.token)); }));
+      let result = null;
+      terms.forEach(function(term, i) {
+        const docs = new Set();
+        const shard = shards[i];
+        if (term.prefix) {
+          for (const token in shard) {
+            if (token.startsWith(term.token)) {
+              decodePostings(shard[token], docs);
+            }
+          }
+        } else if (shard[term.token] !== undefined) {
+          decodePostings(shard[term.token], docs);
+        }
+        result = result === null ? docs : new Set(Array.from(result).filter(function(doc) { return docs.has(doc); }));
+      });
+      return result;
+    }
+
+    const input = document.getElementById("search-input");
+    const status = document.getElementById("search-status");
+    const rows = Array.from(document.querySelectorAll("tr[data-doc]"));
+    const sections = Array.from(document.querySelectorAll(".project"));
+    let generation = 0;
+    let timer = null;
+
+    function apply(result) {
+      let shown = 0;
+      rows.forEach(function(row) {
+        const visible = result === null || result.has(Number(row.dataset.doc));
+        row.classList.toggle("hidden", !visible);
+        shown += visible ? 1 : 0;
+      });
+      sections.forEach(function(section) {
+        section.classList.toggle("hidden", !section.querySelector("tr[data-doc]:not(.hidden)"));
+      });
+      status.textContent = result === null ? "" : "找到 " + shown + " 个会话";
+    }
+
+    async function run() {
+      const current = ++generation;
+      const started = performance.now();
+      try {
+        const result = await search(input.value);
+        if (current !== generation) {
+          return;
+        }
+        apply(result);
+        if (result !== null) {
+          status.textContent += "（" + Math.round(performance.now() - started) + " ms）";
+        }
+      } catch (err) {
+        if (current === generation) {
+          status.textContent = typeof DecompressionStream === "undefined"
+            ? "当前浏览器不支持 DecompressionStream，无法检索" : String(err.message || err);
+        }
+      }
+    }
+
+    input.addEventListener("input", function() {
+      clearTimeout(timer);
+      timer = setTimeout(run, 80);
+    });
+    if (input.value) {
+      run();
+    }
+"""
+
+
+class UsageTable:
     """
-    批量处理目录中的所有JSONL文件
+    按列存储的去重token用量表（analytics 子命令）
+    每个助手消息（message.id）一行：维度列用字典编码（取值表 + array('I') 编号），
+    用量列为 array('q')。Claude Code 在同一消息的每个流式记录上重复写入 usage，
+    同一消息也会随会话恢复/分叉出现在多个文件中，因此按 message.id 全局去重，各用量取最大值。
     """
-    print(f"📁 正在扫描目录: {directory}")
 
-    # 扫描文件
+    DIMENSIONS = ('project', 'session', 'cwd', 'git_branch', 'version', 'model', 'day')
+
+    def __init__(self):
+        self.values = {dim: [] for dim in self.DIMENSIONS}  # 维度取值表
+        self.lookup = {dim: {} for dim in self.DIMENSIONS}  # 取值 -> 编号
+        self.codes = {dim: array('I') for dim in self.DIMENSIONS}
+        self.metrics = {name: array('q') for name in USAGE_FIELDS}
+        self.row_of = {}  # message.id -> 行号
+        self.duplicates = 0  # 被去重合并的记录数
+
+    def __len__(self) -> int:
+        return len(self.codes['project'])
+
+    def add(self, message_id: Optional[str], dims: Tuple[str, ...], usage: Dict[str, Any]) -> None:
+        """添加一条带 usage 的助手记录（dims 按 DIMENSIONS 的顺序），已出现的消息只合并用量"""
+        row = self.row_of.get(message_id) if message_id else None
+        if row is not None:
+            self.duplicates += 1
+            for name, column in self.metrics.items():
+                value = usage.get(name) or 0
+                if value > column[row]:
+                    column[row] = value
+            return
+
+        if message_id:
+            self.row_of[message_id] = len(self)
+        for dim, value in zip(self.DIMENSIONS, dims):
+            lookup = self.lookup[dim]
+            code = lookup.get(value)
+            if code is None:
+                code = lookup[value] = len(self.values[dim])
+                self.values[dim].append(value)
+            self.codes[dim].append(code)
+        for name, column in self.metrics.items():
+            column.append(usage.get(name) or 0)
+
+    def merge(self, other: 'UsageTable') -> None:
+        """合并另一张表（如并行扫描的单个文件），跨文件同样按 message.id 去重"""
+        ids = [None] * len(other)
+        for message_id, row in other.row_of.items():
+            ids[row] = message_id
+        columns = [other.codes[dim] for dim in self.DIMENSIONS]
+        metrics = [other.metrics[name] for name in USAGE_FIELDS]
+        for row, message_id in enumerate(ids):
+            dims = tuple(other.values[dim][column[row]] for dim, column in zip(self.DIMENSIONS, columns))
+            self.add(message_id, dims, {name: column[row] for name, column in zip(USAGE_FIELDS, metrics)})
+        self.duplicates += other.duplicates
+
+    def group_by(self, dims: List[str]) -> Dict[Tuple[str, ...], Dict[str, Any]]:
+        """按维度聚合: 维度取值 -> {messages, sessions, 各用量合计}"""
+        groups = {}
+        sessions = {}
+        key_columns = [self.codes[dim] for dim in dims]
+        session_column = self.codes['session']
+        metrics = [self.metrics[name] for name in USAGE_FIELDS]
+        for row, key in enumerate(zip(*key_columns) if dims else itertools.repeat((), len(self))):
+            totals = groups.get(key)
+            if totals is None:
+                totals = groups[key] = [0] * (len(USAGE_FIELDS) + 1)
+                sessions[key] = set()
+            totals[0] += 1
+            for i, column in enumerate(metrics, 1):
+                totals[i] += column[row]
+            sessions[key].add(session_column[row])
+
+        result = {}
+        for key, totals in groups.items():
+            values = tuple(self.values[dim][code] for dim, code in zip(dims, key))
+            result[values] = {'messages': totals[0], 'sessions': len(sessions[key]),
+                              **dict(zip(USAGE_FIELDS, totals[1:]))}
+        return result
+
+
+def scan_usage(path: str, project: str, table: Optional[UsageTable] = None) -> UsageTable:
+    """
+    扫描单个会话文件中助手消息的 usage，追加到 table（默认新建）并返回
+    只解码包含 "usage" 的行，体积占大头的工具结果等记录直接跳过
+    """
+    table = UsageTable() if table is None else table
+    session = Path(path).stem
+    with open(path, 'rb') as f:
+        for line in f:
+            if b'"usage"' not in line:
+                continue
+            try:
+                obj = json_decode(line)
+            except JSON_DECODE_ERRORS:
+                continue
+            message = obj.get('message')
+            if obj.get('type') != 'assistant' or not isinstance(message, dict):
+                continue
+            usage = message.get('usage')
+            if not isinstance(usage, dict):
+                continue
+            table.add(message.get('id'), (
+                project,
+                obj.get('sessionId') or session,
+                obj.get('cwd') or '',
+                obj.get('gitBranch') or '',
+                obj.get('version') or '',
+                message.get('model') or '',
+                (obj.get('timestamp') or '')[:10],  # UTC日期
+            ), usage)
+    return table
+
+
+def load_pricing(path: str) -> Dict[str, Dict[str, float]]:
+    """
+    读取价格表（JSON，美元/百万tokens），键为模型名或模型名前缀:
+    {"claude-sonnet-4": {"input": 3, "output": 15, "cache_read": 0.3, "cache_creation": 3.75}}
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        pricing = json.load(f)
+    if not isinstance(pricing, dict) or not all(isinstance(v, dict) for v in pricing.values()):
+        raise ValueError(f"价格表格式错误: {path}")
+    return pricing
+
+
+def usage_cost(model: str, usage: Dict[str, int], pricing: Dict[str, Dict[str, float]]) -> Optional[float]:
+    """按最长匹配的模型前缀计算费用（美元），价格表中没有该模型时返回None"""
+    matches = [key for key in pricing if model.startswith(key)]
+    if not matches:
+        return None
+    prices = pricing[max(matches, key=len)]
+    return sum(usage[field] * (prices.get(price) or 0) for field, price in (
+        ('input_tokens', 'input'),
+        ('output_tokens', 'output'),
+        ('cache_read_input_tokens', 'cache_read'),
+        ('cache_creation_input_tokens', 'cache_creation'),
+    )) / 1_000_000
+
+
+def format_time(timestamp: Optional[str]) -> str:
+    """将ISO时间戳格式化为 YYYY-MM-DD HH:MM:SS"""
+    if not timestamp:
+        return ''
     try:
-        jsonl_files = scan_jsonl_files(directory)
-    except Exception as e:
-        print(f"❌ 错误: {e}", file=sys.stderr)
+        dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+        return dt.strftime('%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return timestamp
+
+
+def one_line(text: Optional[str], width: int) -> str:
+    """压缩为单行并截断到指定宽度"""
+    text = ' '.join((text or '').split())
+    return text if len(text) <= width else text[:width - 1] + '…'
+
+
+def index_command(argv: List[str]) -> None:
+    """index 子命令：建立或增量更新会话索引"""
+    parser = argparse.ArgumentParser(prog='restore_chat.py index', description='建立或增量更新会话SQLite索引')
+    parser.add_argument('-d', '--dir', dest='directory', default=str(DEFAULT_PROJECTS_DIR),
+                        help=f'会话根目录（默认: {DEFAULT_PROJECTS_DIR}）')
+    parser.add_argument('--db', default=str(DEFAULT_INDEX_DB), help=f'索引数据库路径（默认: {DEFAULT_INDEX_DB}）')
+    args = parser.parse_args(argv)
+
+    if not Path(args.directory).is_dir():
+        print(f"❌ 错误: 目录不存在: {args.directory}", file=sys.stderr)
         sys.exit(1)
 
-    if not jsonl_files:
-        print("⚠️  未找到符合条件的JSONL文件（排除了agent-前缀和空文件）")
-        return
+    start = time.perf_counter()
+    index = SessionIndex(args.db)
+    try:
+        counts = index.update(args.directory)
+    finally:
+        index.close()
 
-    print(f"✅ 找到 {len(jsonl_files)} 个符合条件的文件")
+    print(f"✅ 索引已更新: {args.db}")
+    print(f"  新增: {counts['added']}  更新: {counts['updated']}  删除: {counts['removed']}  "
+          f"未变化: {counts['unchanged']}  失败: {counts['failed']}")
+    print(f"  耗时: {time.perf_counter() - start:.2f}s")
 
-    # 创建输出目录
-    output_dir = Path(directory) / 'claude_parse'
-    output_dir.mkdir(exist_ok=True)
-    print(f"📂 输出目录: {output_dir}")
-    print(f"📄 输出格式: {output_format.upper()}")
-    print("")
 
-    # 批量处理
-    success_count = 0
-    failed_count = 0
+def list_command(argv: List[str]) -> None:
+    """list 子命令：从索引列出会话"""
+    parser = argparse.ArgumentParser(prog='restore_chat.py list', description='从索引中列出会话')
+    parser.add_argument('--db', default=str(DEFAULT_INDEX_DB), help=f'索引数据库路径（默认: {DEFAULT_INDEX_DB}）')
+    parser.add_argument('-p', '--project', help='按项目名过滤（子串匹配）')
+    parser.add_argument('-n', '--limit', type=int, default=50, help='最多显示的会话数，0 表示全部（默认: 50）')
+    args = parser.parse_args(argv)
 
-    for i, input_file in enumerate(jsonl_files, 1):
-        file_name = Path(input_file).name
-        print(f"[{i}/{len(jsonl_files)}] 处理中: {file_name} ... ", end='', flush=True)
+    index = SessionIndex(args.db)
+    try:
+        rows = index.list_sessions(args.project, args.limit)
+    finally:
+        index.close()
 
-        result = process_single_file(input_file, str(output_dir), output_format)
+    if not rows:
+        print("⚠️  索引中没有会话，请先运行: python3 restore_chat.py index")
+        return
 
-        if result['success']:
-            print(f"✅ 成功")
-            success_count += 1
-        else:
-            print(f"❌ 失败: {result['error']}")
-            failed_count += 1
+    print(f"{'会话ID':<10} {'开始时间':<19} {'消息':>5} {'输出tokens':>10}  {'项目':<24} 首条提问")
+    for row in rows:
+        print(f"{(row['session_id'] or '')[:8]:<10} {format_time(row['started_at']):<19} "
+              f"{row['message_count']:>5} {row['output_tokens']:>10}  {one_line(row['project'], 24):<24} "
+              f"{one_line(row['first_prompt'], 60)}")
+
+
+def show_command(argv: List[str]) -> None:
+    """show 子命令：从索引显示单个会话的元数据和消息列表"""
+    parser = argparse.ArgumentParser(prog='restore_chat.py show', description='显示索引中某个会话的详情')
+    parser.add_argument('session', help='会话ID（可用前缀）或会话文件路径')
+    parser.add_argument('--db', default=str(DEFAULT_INDEX_DB), help=f'索引数据库路径（默认: {DEFAULT_INDEX_DB}）')
+    args = parser.parse_args(argv)
+
+    index = SessionIndex(args.db)
+    try:
+        rows = index.find_session(args.session)
+        if not rows:
+            print(f"❌ 错误: 索引中找不到会话 '{args.session}'", file=sys.stderr)
+            sys.exit(1)
+        if len(rows) > 1:
+            print(f"⚠️  匹配到 {len(rows)} 个会话，显示最近的一个")
+        row = rows[0]
+        messages = index.get_messages(row['id'])
+    finally:
+        index.close()
 
-    # 输出统计信息
-    print("")
     print("=" * 80)
-    print(f"批量处理完成！")
-    print(f"  成功: {success_count} 个文件")
-    print(f"  失败: {failed_count} 个文件")
-    print(f"  输出目录: {output_dir}")
+    print(f"会话: {row['session_id']}")
+    print(f"文件: {row['path']}")
+    print(f"项目: {row['project']}")
+    print(f"工作目录: {row['cwd']}  分支: {row['git_branch']}  版本: {row['version']}")
+    print(f"时间: {format_time(row['started_at'])} ~ {format_time(row['ended_at'])}")
+    print(f"消息: {row['message_count']}（用户 {row['user_count']}，助手 {row['assistant_count']}，"
+          f"工具调用 {row['tool_use_count']}）")
+    print(f"Tokens: 输入={row['input_tokens']:,}, 输出={row['output_tokens']:,}, "
+          f"缓存读取={row['cache_read_tokens']:,}, 缓存写入={row['cache_creation_tokens']:,}")
     print("=" * 80)
+    for msg in messages:
+        icon = '👤' if msg['role'] == 'user' else '🤖'
+        tools = f" 🔧{msg['tool_names']}" if msg['tool_names'] else ''
+        print(f"{msg['seq']:>4} {format_time(msg['timestamp'])} {icon} {one_line(msg['text_preview'], 70)}{tools}")
+
+
+def search_command(argv: List[str]) -> None:
+    """search 子命令：在索引中全文检索会话内容"""
+    parser = argparse.ArgumentParser(prog='restore_chat.py search', description='全文检索所有已索引会话的内容')
+    parser.add_argument('query', help='检索词，多个词以空格分隔（全部匹配）')
+    parser.add_argument('--db', default=str(DEFAULT_INDEX_DB), help=f'索引数据库路径（默认: {DEFAULT_INDEX_DB}）')
+    parser.add_argument('-p', '--project', help='按项目名过滤（子串匹配）')
+    parser.add_argument('-k', '--kind', choices=['user', 'assistant', 'thinking', 'tool_input', 'tool_result'],
+                        help='只检索某一类内容')
+    parser.add_argument('-n', '--limit', type=int, default=20, help='最多显示的结果数（默认: 20）')
+    parser.add_argument('--raw', action='store_true', help='直接使用SQLite FTS5查询语法（如 OR、NEAR、前缀*）')
+    args = parser.parse_args(argv)
+
+    index = SessionIndex(args.db)
+    try:
+        start = time.perf_counter()
+        try:
+            rows = index.search(args.query, args.limit, args.project, args.kind, args.raw)
+        except sqlite3.OperationalError as e:
+            print(f"❌ 错误: 无效的查询: {e}", file=sys.stderr)
+            sys.exit(1)
+        elapsed = time.perf_counter() - start
+    finally:
+        index.close()
+
+    if not rows:
+        print(f"🔍 没有找到匹配 '{args.query}' 的内容")
+        return
+
+    print(f"🔍 找到 {len(rows)} 条结果（{elapsed * 1000:.0f} ms）")
+    for row in rows:
+        print("")
+        print(f"{(row['session_id'] or '')[:8]}  {format_time(row['timestamp'])}  [{row['kind']}]  "
+              f"#{row['seq']}  {row['project']}")
+        print(f"  {one_line(row['snippet'], 160)}")
+
+
+def site_command(argv: List[str]) -> None:
+    """site 子命令：把目录树中的所有会话导出为带首页和离线检索的静态站点"""
+    parser = argparse.ArgumentParser(prog='restore_chat.py site',
+                                     description='导出多会话静态HTML站点（会话列表首页 + 浏览器端全文检索）')
+    parser.add_argument('-d', '--dir', dest='directory', default=str(DEFAULT_PROJECTS_DIR),
+                        help=f'会话根目录（默认: {DEFAULT_PROJECTS_DIR}），站点输出到其下的 {OUTPUT_DIR_NAME}/')
+    parser.add_argument('--db', default=str(DEFAULT_INDEX_DB), help=f'索引数据库路径（默认: {DEFAULT_INDEX_DB}）')
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='导出会话页面的并行进程数，0 表示使用全部CPU核心（默认: 0）')
+    parser.add_argument('--force', action='store_true', help='忽略增量清单，重新生成所有会话页面')
+    parser.add_argument('--prerender', action='store_true', help='导出时渲染Markdown，站点完全离线可用')
+    args = parser.parse_args(argv)
+
+    directory = str(Path(args.directory).resolve())
+    if not Path(directory).is_dir():
+        print(f"❌ 错误: 目录不存在: {args.directory}", file=sys.stderr)
+        sys.exit(1)
+    if args.jobs < 0:
+        parser.error('--jobs 不能为负数')
+
+    # 1. 增量导出会话页面（共用 claude_parse/assets/ 中的样式和脚本）
+    output_dir = Path(directory) / OUTPUT_DIR_NAME
+    render_options = {'stitch_subagents': True, 'page_size': 0, 'prerender': args.prerender,
+                      'assets_dir': str(output_dir / ASSETS_DIR_NAME)}
+    batch_process_directory(directory, 'html', jobs=args.jobs or os.cpu_count() or 1, force=args.force,
+                            recursive=True, render_options=render_options)
+
+    # 2. 增量更新会话索引，从中取得元数据和检索文本，生成首页和检索分片
+    start = time.perf_counter()
+    index = SessionIndex(args.db)
+    try:
+        index.update(directory)
+        sessions = []
+        for row in index.list_sessions():
+            path = row['path']
+            if not path.startswith(directory + os.sep):
+                continue
+            page = output_file_for(path, mirrored_output_dir(path, directory, str(output_dir)), 'html')
+            if not page.exists():
+                continue
+            rel_parts = Path(path).relative_to(directory).parts
+            session = dict(row)
+            session['key'] = row['id']
+            session['project'] = rel_parts[0] if len(rel_parts) > 1 else ''
+            session['page'] = quote(page.relative_to(output_dir).as_posix())
+            sessions.append(session)
+
+        # 项目按最近开始的会话排序，项目内按开始时间倒序
+        project_rank = {}
+        for session in sessions:
+            project_rank.setdefault(session['project'], len(project_rank))
+        sessions.sort(key=lambda session: project_rank[session['project']])
+
+        stats = StaticSite(str(output_dir)).build(sessions, index.iter_texts(StaticSite.SEARCH_KINDS))
+    finally:
+        index.close()
+
+    print(f"🌐 站点已生成: {output_dir / 'index.html'}")
+    print(f"  会话: {stats['sessions']}  检索词: {stats['tokens']:,}  分片: {stats['shards']}  "
+          f"耗时: {time.perf_counter() - start:.2f}s")
+
+
+def analytics_command(argv: List[str]) -> None:
+    """analytics 子命令：汇总目录树中所有会话去重后的token用量"""
+    parser = argparse.ArgumentParser(prog='restore_chat.py analytics',
+                                     description='按项目、目录、分支、版本、模型、日期汇总去重后的token用量')
+    parser.add_argument('-d', '--dir', dest='directory', default=str(DEFAULT_PROJECTS_DIR),
+                        help=f'会话根目录（默认: {DEFAULT_PROJECTS_DIR}），包含子代理的 agent-*.jsonl')
+    parser.add_argument('-g', '--group-by', default='project',
+                        help=f'聚合维度，逗号分隔，可选 {", ".join(UsageTable.DIMENSIONS)}'
+                             '（默认: project；空字符串表示只输出总计）')
+    parser.add_argument('-f', '--format', choices=['table', 'csv', 'json'], default='table',
+                        help='输出格式（默认: table）')
+    parser.add_argument('-o', '--output', help='输出文件（默认: 标准输出）')
+    parser.add_argument('--sort', choices=['tokens', 'key'], default='tokens',
+                        help='排序方式：tokens 按token合计降序，key 按维度取值升序（默认: tokens）')
+    parser.add_argument('--pricing', help='价格表JSON（美元/百万tokens，键为模型名前缀），提供时输出费用列')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='并行进程数，0 表示使用全部CPU核心（默认: 1）')
+    args = parser.parse_args(argv)
+
+    dims = [dim.strip() for dim in args.group_by.split(',') if dim.strip()]
+    invalid = [dim for dim in dims if dim not in UsageTable.DIMENSIONS]
+    if invalid:
+        parser.error(f"未知的聚合维度: {', '.join(invalid)}（可选: {', '.join(UsageTable.DIMENSIONS)}）")
+    if args.jobs < 0:
+        parser.error('--jobs 不能为负数')
+    if not Path(args.directory).is_dir():
+        print(f"❌ 错误: 目录不存在: {args.directory}", file=sys.stderr)
+        sys.exit(1)
+    try:
+        pricing = load_pricing(args.pricing) if args.pricing else None
+    except (OSError, ValueError) as e:
+        print(f"❌ 错误: 无法读取价格表: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    start = time.perf_counter()
+    files = scan_project_files(args.directory, exclude=())
+    table = UsageTable()
+    jobs = min(args.jobs or os.cpu_count() or 1, max(len(files), 1))
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for part in executor.map(scan_usage, [path for _, path, _ in files],
+                                     [project for project, _, _ in files], chunksize=16):
+                table.merge(part)
+    else:
+        for project, path, _ in files:
+            scan_usage(path, project, table)
+
+    rows = []
+    for key, totals in table.group_by(dims).items():
+        row = dict(zip(dims, key))
+        row.update(totals)
+        row['total_tokens'] = sum(totals[field] for field in USAGE_FIELDS)
+        rows.append(row)
+
+    unpriced = set()
+    if pricing is not None:
+        # 费用按模型计算，再汇总到所选维度
+        costs = defaultdict(float)
+        for key, totals in table.group_by(dims + ['model']).items():
+            cost = usage_cost(key[-1], totals, pricing)
+            if cost is None:
+                unpriced.add(key[-1])
+            else:
+                costs[key[:-1]] += cost
+        for row in rows:
+            row['cost_usd'] = round(costs[tuple(row[dim] for dim in dims)], 6)
+
+    if args.sort == 'tokens':
+        rows.sort(key=lambda row: row['total_tokens'], reverse=True)
+    else:
+        rows.sort(key=lambda row: tuple(row[dim] for dim in dims))
+
+    columns = dims + ['sessions', 'messages', *USAGE_FIELDS, 'total_tokens'] + (['cost_usd'] if pricing else [])
+    out = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    info = sys.stdout if args.format == 'table' and not args.output else sys.stderr
+    try:
+        if args.format == 'json':
+            grand_total = {name: sum(row[name] for row in rows) for name in columns[len(dims) + 1:]}
+            json.dump({'group_by': dims, 'totals': grand_total, 'rows': rows,
+                       'unpriced_models': sorted(unpriced)}, out, ensure_ascii=False, indent=1)
+            out.write('\n')
+        elif args.format == 'csv':
+            writer = csv.DictWriter(out, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            headers = {'project': '项目', 'session': '会话', 'cwd': '工作目录', 'git_branch': '分支',
+                       'version': '版本', 'model': '模型', 'day': '日期', 'sessions': '会话数', 'messages': '消息',
+                       'input_tokens': '输入', 'output_tokens': '输出', 'cache_read_input_tokens': '缓存读取',
+                       'cache_creation_input_tokens': '缓存写入', 'total_tokens': '合计', 'cost_usd': '费用($)'}
+            widths = {dim: min(max([len(str(row[dim])) for row in rows] + [len(headers[dim]) * 2]), 40)
+                      for dim in dims}
+            print('  '.join([f"{headers[dim]:<{widths[dim] - len(headers[dim])}}" for dim in dims] +
+                            [f"{headers[name]:>{14 - len(headers[name])}}" for name in columns[len(dims):]]),
+                  file=out)
+            for row in rows:
+                cells = [f"{one_line(str(row[dim]), widths[dim]):<{widths[dim]}}" for dim in dims]
+                cells += [f"{row[name]:>14,.2f}" if name == 'cost_usd' else f"{row[name]:>14,}"
+                          for name in columns[len(dims):]]
+                print('  '.join(cells), file=out)
+    finally:
+        if args.output:
+            out.close()
+
+    print(f"📊 {len(files)} 个文件，{len(table)} 条助手消息（合并重复记录 {table.duplicates} 条），"
+          f"{len(rows)} 个分组，耗时 {time.perf_counter() - start:.2f}s", file=info)
+    if unpriced:
+        print(f"⚠️  价格表中没有以下模型，未计入费用: {', '.join(sorted(unpriced))}", file=info)
+    if args.output:
+        print(f"✅ 已写入: {args.output}", file=info)
+
+
+SUBCOMMANDS = {
+    'index': index_command,
+    'list': list_command,
+    'show': show_command,
+    'search': search_command,
+    'site': site_command,
+    'analytics': analytics_command,
+}
+
+
+FORMAT_ALIASES = {'txt': 'txt', 'markdown': 'markdown', 'md': 'markdown', 'html': 'html',
+                  'parquet': 'parquet', 'arrow': 'arrow'}
+
+
+def parse_formats(text: str) -> List[str]:
+    """解析 --format 参数：单个格式或逗号分隔的多个格式（如 txt,md,html），返回去重后的格式名列表"""
+    formats = []
+    for name in text.split(','):
+        fmt = FORMAT_ALIASES.get(name.strip().lower())
+        if fmt is None:
+            raise argparse.ArgumentTypeError(
+                f"无效的输出格式: {name}（可选: txt、markdown/md、html、parquet、arrow，多个格式以逗号分隔）")
+        if fmt not in formats:
+            formats.append(fmt)
+    if len(formats) > 1 and any(fmt in TABLE_FORMATS for fmt in formats):
+        raise argparse.ArgumentTypeError('parquet / arrow 不能与其它格式同时输出')
+    return formats
+
+
+def parse_seconds(text: str) -> float:
+    """解析 --interval / --debounce 等秒数参数，必须大于0"""
+    try:
+        seconds = float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"无效的秒数: {text}")
+    if not seconds > 0:
+        raise argparse.ArgumentTypeError(f"秒数必须大于0: {text}")
+    return seconds
+
+
+def parse_range(text: str) -> Tuple[Optional[int], Optional[int]]:
+    """解析 --range 参数 START:END（同Python切片，可省略任一端，支持负数）；单个数字表示一条消息"""
+    try:
+        if ':' not in text:
+            index = int(text)
+            return index, (index + 1) or None
+        start, stop = text.split(':', 1)
+        return (int(start) if start.strip() else None), (int(stop) if stop.strip() else None)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"无效的消息范围: {text}（格式: START:END，如 100:200、-50:）")
 
 
 def main():
+    # 子命令（index/list/show 等）使用各自的参数解析器
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(
         description='Claude Code 会话还原工具 - 将JSONL格式的会话数据转换为可读格式',
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -1306,6 +5465,73 @@ def main():
 
   # 批量处理目录并输出为HTML格式
   python3 restore_chat.py --dir /path/to/chats --format html
+
+  # 使用8个进程并行批量处理（-j 0 表示使用全部CPU核心）
+  python3 restore_chat.py --dir /path/to/chats -j 8
+
+  # 递归处理整个项目树（如 ~/.claude/projects），输出按项目目录结构存放
+  python3 restore_chat.py --dir ~/.claude/projects -r --format html
+
+  # 自定义包含/排除规则（替代默认的 agent-* 排除规则）
+  python3 restore_chat.py --dir ~/.claude/projects -r --include '*.jsonl' --exclude 'agent-*' --exclude 'tmp/*'
+
+  # 忽略增量清单，强制重新生成全部文件
+  python3 restore_chat.py --dir /path/to/chats --force
+
+  # 增量刷新正在增长的会话导出（只解析新追加的内容）
+  python3 restore_chat.py live_chat.jsonl --format html --tail
+
+  # 监视会话文件，有新内容时自动增量刷新HTML导出
+  python3 restore_chat.py live_chat.jsonl --format html --watch
+  python3 restore_chat.py --dir ~/.claude/projects/my-project --format html --watch
+
+  # 建立/增量更新会话索引，然后秒级列出和查看会话
+  python3 restore_chat.py index --dir ~/.claude/projects
+  python3 restore_chat.py list --project my-project
+  python3 restore_chat.py show 519f7c08
+
+  # 全文检索所有会话（用户输入、回复、思考过程、工具参数和结果）
+  python3 restore_chat.py search "left padding"
+
+  # 导出静态站点：会话列表首页 + 浏览器端离线检索（claude_parse/index.html）
+  python3 restore_chat.py site --dir ~/.claude/projects
+
+  # 按项目和日期汇总去重后的token用量，输出CSV
+  python3 restore_chat.py analytics --group-by project,day --format csv -o usage.csv
+
+  # 不嵌入子代理（Task工具）的会话
+  python3 restore_chat.py my_chat.jsonl --no-subagents
+
+  # 导出时渲染Markdown，离线环境中无需JavaScript/CDN即可阅读
+  python3 restore_chat.py my_chat.jsonl --format html --prerender
+
+  # 一次解析同时导出文本、Markdown和HTML，并写出统计结果（*_stats.json）
+  python3 restore_chat.py my_chat.jsonl --format txt,md,html --stats
+
+  # 批量导出HTML，所有页面共用 claude_parse/assets/ 中的样式和脚本
+  python3 restore_chat.py --dir ~/.claude/projects/my-project --format html --shared-assets
+
+  # 超长会话分页导出为HTML，每页500条消息
+  python3 restore_chat.py huge_chat.jsonl --format html --page-size 500
+
+  # 只导出最后50条消息（行偏移索引缓存在会话文件旁，再次导出无需重新扫描）
+  python3 restore_chat.py huge_chat.jsonl --range=-50:
+
+  # 直接读取压缩的会话和tar归档（不解压到磁盘，.zst 需要安装 zstandard）
+  python3 restore_chat.py old_chat.jsonl.gz --format html
+  python3 restore_chat.py archive/2025-10.tar.zst --format html
+
+  # 流式处理超大会话（边读边写，内存占用与文件大小无关）
+  python3 restore_chat.py huge_chat.jsonl --stream
+
+  # 压缩输出 *.html.gz，可由静态服务器直接以预压缩方式提供
+  python3 restore_chat.py --dir ~/.claude/projects -r --format html --compress gzip
+
+  # 导出为按项目和月份分区的 parquet 数据集（需要安装 pyarrow），供 DuckDB / pandas 查询
+  python3 restore_chat.py --dir ~/.claude/projects -r -j 8 --format parquet
+
+  # 分阶段计时：找出批量处理中最慢的会话和阶段，并导出 Chrome trace
+  python3 restore_chat.py --dir ~/.claude/projects -r -j 8 --force --profile --profile-trace trace.json
         """
     )
 
@@ -1324,55 +5550,325 @@ def main():
 
     parser.add_argument(
         '-f', '--format',
-        choices=['txt', 'markdown', 'md', 'html'],
+        type=parse_formats,
         default='txt',
-        help='输出格式: txt（文本）、markdown/md（Markdown）或 html（HTML网页）（默认: txt）'
+        help='输出格式: txt（文本）、markdown/md（Markdown）或 html（HTML网页）（默认: txt）；'
+             '多个格式以逗号分隔（如 txt,md,html），只解析一次会话即可写出全部格式；'
+             'parquet / arrow 导出每个内容块一行的表格（需要安装 pyarrow），批量处理时写入按项目和月份分区的数据集'
     )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='流式模式：逐条聚合渲染并直接写入文件，峰值内存只取决于最大的单条消息（按文件顺序输出）'
+    )
 
-    # 统一处理格式参数
-    if args.format in ['markdown', 'md']:
-        output_format = 'markdown'
-    elif args.format == 'html':
-        output_format = 'html'
-    else:
-        output_format = 'txt'
+    parser.add_argument(
+        '--tail',
+        action='store_true',
+        help='增量刷新模式：记住上次解析的位置，只解析会话文件新追加的内容并追加到已有输出（输出顺序同 --stream）'
+    )
+
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='监视模式：持续轮询会话文件（或 --dir 目录），变化稳定后只增量渲染新增的消息'
+    )
+
+    parser.add_argument(
+        '--interval',
+        type=parse_seconds,
+        default=1.0,
+        help='监视模式的轮询间隔秒数（默认: 1.0）'
+    )
+
+    parser.add_argument(
+        '--debounce',
+        type=parse_seconds,
+        default=2.0,
+        help=f'监视模式的防抖秒数：文件停止变化这么久之后才重新渲染，持续变化时最多等待 {WATCH_MAX_WAIT} 倍（默认: 2.0）'
+    )
+
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='批量处理时的并行进程数，0 表示使用全部CPU核心（默认: 1，串行处理）'
+    )
+
+    parser.add_argument(
+        '-r', '--recursive',
+        action='store_true',
+        help='批量处理时递归扫描所有子目录，输出文件按源目录结构存放在 claude_parse 下'
+    )
+
+    parser.add_argument(
+        '--include',
+        action='append',
+        metavar='PATTERN',
+        help=f'批量处理时包含的文件通配符，可多次指定；含 / 的模式匹配相对路径'
+             f'（默认: {" ".join(DEFAULT_INCLUDE + COMPRESSED_INCLUDE)}）'
+    )
+
+    parser.add_argument(
+        '--exclude',
+        action='append',
+        metavar='PATTERN',
+        help=f'批量处理时排除的文件或目录通配符，可多次指定，指定后替代默认规则（默认: {" ".join(DEFAULT_EXCLUDE)}）'
+    )
+
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='批量处理时忽略增量清单，重新生成所有文件'
+    )
+
+    parser.add_argument(
+        '--range',
+        type=parse_range,
+        metavar='START:END',
+        help='只导出第 START 到 END-1 条消息（从0开始按文件顺序编号，同Python切片，负数写作 --range=-50:）；'
+             '通过缓存在会话文件旁的行偏移索引（*.lineidx）只解码需要的行'
+    )
+
+    parser.add_argument(
+        '--page-size',
+        type=int,
+        default=0,
+        metavar='N',
+        help='HTML分页导出：每页最多 N 条消息，页面之间有导航链接（第2页起为 *_restored_p2.html 等），'
+             '超长会话也能秒开（默认: 0，不分页）'
+    )
 
-    # 判断是批量处理还是单文件处理
-    if args.directory:
+    parser.add_argument(
+        '--prerender',
+        action='store_true',
+        help='HTML导出时在本地把Markdown渲染为HTML（相同内容只渲染一次），页面无需JavaScript和CDN即可阅读；'
+             '安装 pygments 后代码块带语法高亮'
+    )
+
+    parser.add_argument(
+        '--shared-assets',
+        action='store_true',
+        help='HTML导出时把样式和脚本写入共享资源目录 assets/（批量模式为 claude_parse/assets/），'
+             '所有页面引用同一份带版本号的资源，体积更小且可被浏览器缓存；'
+             '脚本旁 vendor/ 目录中的第三方库文件会一并复制，页面可离线打开'
+    )
+
+    parser.add_argument(
+        '--stats',
+        action='store_true',
+        help='在还原的同一次解析中统计会话（消息、内容块、按 message.id 去重的token用量），'
+             '写入 <文件名>_stats.json'
+    )
+
+    parser.add_argument(
+        '--compress',
+        choices=sorted(OUTPUT_COMPRESSION),
+        help='压缩输出文件：边渲染边压缩写入 *.gz（gzip）或 *.zst（zstd，需要安装 zstandard），'
+             '如 my_chat_restored.html.gz 可由静态服务器直接以预压缩方式提供；页面之间的链接仍使用未压缩的文件名'
+    )
+
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='分阶段计时：文件发现、读取与JSON解码、关联tool_result、消息聚合、各格式渲染、写入，'
+             '结束时打印各阶段的耗时、字节数和记录数，以及耗时最多的会话文件'
+    )
+
+    parser.add_argument(
+        '--profile-json',
+        metavar='FILE',
+        help='把分阶段计时（各阶段合计和每个会话文件的明细）写入JSON文件（隐含 --profile）'
+    )
+
+    parser.add_argument(
+        '--profile-trace',
+        metavar='FILE',
+        help='把计时区间写为 Chrome trace 文件，可在 chrome://tracing 或 Perfetto 中查看（隐含 --profile）'
+    )
+
+    parser.add_argument(
+        '--no-subagents',
+        dest='subagents',
+        action='store_false',
+        help='不把子代理（Task工具）的会话嵌入到对应的工具调用下'
+    )
+
+    args = parser.parse_args()
+
+    if args.jobs < 0:
+        parser.error('--jobs 不能为负数')
+    if args.range and (args.directory or args.watch or args.tail):
+        parser.error('--range 只能用于单文件导出')
+    if args.jsonl_file and not args.directory and not is_plain_file(args.jsonl_file) and \
+            (args.range or args.tail or args.watch):
+        parser.error('压缩文件和tar归档只能完整导出（不支持 --range/--tail/--watch）')
+    if args.page_size < 0:
+        parser.error('--page-size 不能为负数')
+    if args.page_size and (args.format != ['html'] or args.watch or args.tail):
+        parser.error('--page-size 只能用于HTML格式的完整导出（不支持 --tail/--watch）')
+    if args.prerender and 'html' not in args.format:
+        parser.error('--prerender 只能用于HTML格式')
+    if args.shared_assets and 'html' not in args.format:
+        parser.error('--shared-assets 只能用于HTML格式')
+    if (len(args.format) > 1 or args.stats) and (args.tail or args.watch or args.range):
+        parser.error('多格式输出和 --stats 只能用于完整导出（不支持 --tail/--watch/--range）')
+    if args.format[0] in TABLE_FORMATS:
+        if args.stream or args.tail or args.watch or args.range or args.page_size or args.compress or args.stats:
+            parser.error('parquet / arrow 只能用于完整导出，不支持 --stream/--tail/--watch/--range/--page-size/'
+                         '--compress/--stats（列式文件自带压缩，表格中已包含usage）')
+        if pyarrow is None:
+            parser.error('parquet / arrow 导出需要安装 pyarrow（pip install pyarrow）')
+    if args.compress and (args.tail or args.watch):
+        parser.error('--compress 只能用于完整导出（增量刷新需要改写已有输出，不支持 --tail/--watch）')
+    if args.compress == 'zstd' and zstandard is None:
+        parser.error('--compress zstd 需要安装 zstandard（pip install zstandard）')
+    if args.profile_json or args.profile_trace:
+        args.profile = True
+    if args.profile and args.watch:
+        parser.error('--profile 不能用于 --watch')
+    profiler = Profiler() if args.profile else None
+    jobs = args.jobs or os.cpu_count() or 1
+    include = args.include or DEFAULT_INCLUDE + COMPRESSED_INCLUDE
+    exclude = DEFAULT_EXCLUDE if args.exclude is None else args.exclude
+    render_options = {'stitch_subagents': args.subagents, 'page_size': args.page_size, 'prerender': args.prerender}
+    if args.compress:
+        render_options['compress'] = args.compress
+    if args.shared_assets:
+        # 批量模式所有输出共用 claude_parse/assets/，单文件模式放在会话文件旁
+        if args.directory:
+            render_options['assets_dir'] = str(Path(args.directory) / OUTPUT_DIR_NAME / ASSETS_DIR_NAME)
+        else:
+            render_options['assets_dir'] = str(Path(args.jsonl_file or 'case.jsonl').parent / ASSETS_DIR_NAME)
+
+    # 格式参数已统一为 txt / markdown / html / parquet / arrow；单一格式时沿用原有的各导出路径
+    output_formats = args.format
+    output_format = output_formats[0]
+
+    # 判断是监视、批量处理还是单文件处理
+    if args.watch:
+        if args.directory:
+            def list_files() -> List[str]:
+                # 压缩文件和归档不会再增长，监视模式只处理普通会话文件
+                return [path for path, _ in discover_session_files(args.directory, args.recursive, include, exclude)
+                        if is_plain_file(path)]
+
+            def output_dir_for(path: str) -> str:
+                target = mirrored_output_dir(path, args.directory, str(output_dir))
+                Path(target).mkdir(parents=True, exist_ok=True)
+                return target
+
+            try:
+                list_files()
+            except Exception as e:
+                print(f"❌ 错误: {e}", file=sys.stderr)
+                sys.exit(1)
+            output_dir = Path(args.directory) / OUTPUT_DIR_NAME
+            output_dir.mkdir(exist_ok=True)
+            watch_sessions(list_files, output_dir_for, output_format, args.interval, args.debounce,
+                           render_options)
+        else:
+            jsonl_file = args.jsonl_file or 'case.jsonl'
+            if not os.path.isfile(jsonl_file):
+                print(f"❌ 错误: 找不到文件 '{jsonl_file}'", file=sys.stderr)
+                sys.exit(1)
+            watch_sessions(lambda: [jsonl_file], lambda path: str(Path(path).parent),
+                           output_format, args.interval, args.debounce, render_options)
+    elif args.directory:
         # 批量处理目录
-        batch_process_directory(args.directory, output_format)
+        batch_process_directory(args.directory, output_formats if len(output_formats) > 1 else output_format,
+                                args.stream, jobs, args.force, args.tail, args.recursive, include, exclude,
+                                render_options, args.stats, profiler)
+    elif args.jsonl_file and is_archive(args.jsonl_file):
+        # tar归档：还原其中的全部会话，输出到归档旁的 claude_parse/<归档名>/（列式导出写入 claude_parse/dataset/）
+        jsonl_file = args.jsonl_file
+        if not os.path.isfile(jsonl_file):
+            print(f"❌ 错误: 找不到文件 '{jsonl_file}'", file=sys.stderr)
+            sys.exit(1)
+        archive_output = Path(jsonl_file).parent / OUTPUT_DIR_NAME
+        if output_format in TABLE_FORMATS:
+            archive_output /= DATASET_DIR_NAME
+        result = process_archive(jsonl_file, str(archive_output),
+                                 output_formats if len(output_formats) > 1 else output_format,
+                                 args.stream, render_options, args.stats, args.profile, exclude)
+        if profiler is not None and result.get('profile'):
+            profiler.merge(result['profile'])
+        print(f"📦 归档: {jsonl_file}（{result['sessions']} 个会话）")
+        print(f"📂 输出目录: {result['output_file']}")
+        if not result['success']:
+            print(f"❌ 失败: {result['error']}", file=sys.stderr)
+            sys.exit(1)
+        print(f"✅ 会话已成功还原！")
     else:
         # 单文件处理
         jsonl_file = args.jsonl_file or 'case.jsonl'
 
         try:
-            restorer = ChatRestorer(jsonl_file, output_format)
-            output = restorer.restore()
-
-            # 根据格式选择输出文件扩展名
-            input_path = Path(jsonl_file)
-            base_name = input_path.stem
-
-            if output_format == 'markdown':
-                output_file = str(input_path.parent / f"{base_name}_restored.md")
-            elif output_format == 'html':
-                output_file = str(input_path.parent / f"{base_name}_restored.html")
-            else:
-                output_file = str(input_path.parent / f"{base_name}_restored.txt")
-
-            with open(output_file, 'w', encoding='utf-8') as f:
-                f.write(output)
+            with profile_span(profiler, jsonl_file, 'file') as span:
+                if profiler is not None:
+                    span.bytes = os.path.getsize(jsonl_file)
+                stats = SessionStats() if args.stats else None
+                restorer = ChatRestorer(jsonl_file, output_format, observers=[stats] if stats else None,
+                                        profiler=profiler, **render_options)
+
+                # 根据格式选择输出文件扩展名
+                output_file = str(output_file_for(jsonl_file, str(Path(jsonl_file).parent), output_format))
+                outputs = {fmt: str(output_file_for(jsonl_file, str(Path(jsonl_file).parent), fmt))
+                           for fmt in output_formats}
+
+                if args.range:
+                    index = SessionLineIndex.load(jsonl_file)
+                    total = len(index.message_starts(restorer.stitch_subagents))
+                    start, stop, _ = slice(*args.range).indices(total)
+                    stop = max(start, stop)
+                    output_file = str(output_file_for(jsonl_file, str(Path(jsonl_file).parent), output_format,
+                                                      f"_{start}-{stop}"))
+                    messages = restorer.iter_message_range(start, stop, index)
+                    if args.page_size:
+                        pages = restorer.write_pages(output_file, messages)
+                    else:
+                        restorer.write_messages(output_file, messages)
+                    print(f"📑 消息范围: {start}:{stop}（共 {total} 条消息）")
+                elif args.tail:
+                    new_count = restorer.restore_incremental(output_file)
+                    print(f"🔄 增量刷新: 新增 {new_count} 条完整消息")
+                elif len(outputs) > 1:
+                    restorer.write_outputs(outputs, args.stream)
+                elif args.page_size:
+                    pages = restorer.restore_pages(output_file, args.stream)
+                elif args.stream:
+                    restorer.restore_to_file(output_file)
+                else:
+                    restorer.write_document(output_file)
 
             print(f"✅ 会话已成功还原！")
-            print(f"📄 输出格式: {output_format.upper()}")
-            print(f"📄 输出文件: {output_file}")
-
-            if output_format != 'html':
+            print(f"📄 输出格式: {'+'.join(fmt.upper() for fmt in outputs)}")
+            for path in outputs.values() if len(outputs) > 1 else [output_file]:
+                print(f"📄 输出文件: {compressed_path(path, args.compress)}")
+            if args.page_size:
+                print(f"📚 分页: 共 {pages} 页，每页最多 {args.page_size} 条消息")
+            if stats is not None:
+                stats_file = stats_file_for(jsonl_file, str(Path(jsonl_file).parent))
+                write_stats(stats_file, stats)
+                summary = stats.to_dict()
+                print(f"📊 统计: {stats_file}（助手消息 {summary['unique_message_ids']} 条，"
+                      f"工具调用 {summary['tool_uses']} 次，输出 {summary['total_output_tokens']:,} tokens）")
+
+            if output_format == 'parquet':
+                print(f"\n💡 提示: 可用 DuckDB 查询，如 SELECT role, type, count(*) FROM read_parquet('{output_file}') GROUP BY ALL")
+            elif output_format == 'arrow':
+                print(f"\n💡 提示: 可用 pyarrow.ipc.open_file('{output_file}').read_pandas() 读入 pandas")
+            elif args.compress:
+                print(f"\n💡 提示: 压缩的输出可由静态服务器直接提供（如 nginx gzip_static），本地查看前需先解压")
+            elif len(outputs) > 1:
+                if 'html' in outputs:
+                    print(f"\n💡 提示: 请在浏览器中打开HTML文件以查看完整的交互式界面")
+            elif output_format != 'html':
                 print(f"\n预览前50行:")
                 print("=" * 80)
-                print('\n'.join(output.split('\n')[:50]))
+                with open(output_file, 'r', encoding='utf-8') as f:
+                    print(''.join(line for _, line in zip(range(50), f)).rstrip('\n'))
             else:
                 print(f"\n💡 提示: 请在浏览器中打开HTML文件以查看完整的交互式界面")
 
@@ -1385,6 +5881,15 @@ def main():
             traceback.print_exc()
             sys.exit(1)
 
+    if profiler is not None:
+        profiler.print_summary()
+        if args.profile_json:
+            profiler.write_json(args.profile_json)
+            print(f"⏱️  计时明细: {args.profile_json}")
+        if args.profile_trace:
+            profiler.write_trace(args.profile_trace)
+            print(f"⏱️  Chrome trace: {args.profile_trace}")
+
 
 if __name__ == '__main__':
     main()
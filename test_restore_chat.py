@@ -0,0 +1,49 @@
+"""restore_chat 回归测试：目录扫描不能把本工具写在会话旁的附属文件当作会话"""
+
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+from restore_chat import SessionIndex, discover_session_files
+
+SCRIPT = Path(__file__).with_name('restore_chat.py')
+SAMPLE = Path(__file__).with_name('case.jsonl')
+
+
+def run(*args, cwd):
+    return subprocess.run([sys.executable, str(SCRIPT), *args], cwd=cwd, capture_output=True,
+                          text=True, encoding='utf-8', check=True)
+
+
+def indexed_sessions(directory, tmp_path):
+    index = SessionIndex(str(tmp_path / 'index.db'))
+    try:
+        index.update(str(directory))
+        return [Path(row['path']).name for row in index.list_sessions(None, 0)]
+    finally:
+        index.close()
+
+
+def test_tail_state_is_not_a_session(tmp_path):
+    sessions = tmp_path / 'project'
+    sessions.mkdir()
+    shutil.copy(SAMPLE, sessions / 's.jsonl')
+    run('s.jsonl', '--format', 'markdown', '--tail', cwd=sessions)
+    assert (sessions / 's_restored.md.tailstate.json').exists()
+
+    assert [Path(path).name for path, _ in discover_session_files(str(sessions))] == ['s.jsonl']
+    assert indexed_sessions(sessions, tmp_path) == ['s.jsonl']
+    assert '成功: 1 个文件' in run('-d', str(sessions), cwd=tmp_path).stdout
+
+
+def test_stats_output_is_not_a_session(tmp_path):
+    sessions = tmp_path / 'project'
+    sessions.mkdir()
+    shutil.copy(SAMPLE, sessions / 'a.jsonl')
+    run('a.jsonl', '--format', 'txt', '--stats', cwd=sessions)
+    assert (sessions / 'a_stats.json').exists()
+
+    assert [Path(path).name for path, _ in discover_session_files(str(sessions))] == ['a.jsonl']
+    assert indexed_sessions(sessions, tmp_path) == ['a.jsonl']
+    assert '成功: 1 个文件' in run('-d', str(sessions), cwd=tmp_path).stdout